@@ -2,7 +2,8 @@
 
 from .train import train_classifier
 from .eval import eval_classifier
+from .ptq import ptq_classifier
 from .env import init_environment, finish_environment, build_cfg
 
-__all__ = ["train_classifier", "eval_classifier", "init_environment",
+__all__ = ["train_classifier", "eval_classifier", "ptq_classifier", "init_environment",
            "build_cfg", "finish_environment"]
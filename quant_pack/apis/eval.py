@@ -1,16 +1,27 @@
 # -*- coding: utf-8 -*-
 
 import torch
+import torch.distributed as dist
 from torch.utils.data import DataLoader, DistributedSampler
 
 import quant_pack.core.wrapper as wrapper
 import quant_pack.core.runner as runner
-from quant_pack.datasets import build_dataset
+from quant_pack.datasets import build_dataset, build_calibration_store
 from quant_pack.models import build_model
 
 from .utils import load_pre_trained
 
 
+def _reestimate_bn_stats(model, cfg, rank=0, world_size=1):
+    # e.g. `reestimate_bn: {quant_mode: quant, num_batches: 50, calibration_data: {num_samples: 3200}}`
+    bn_cfg = cfg.eval.get("reestimate_bn")
+    if bn_cfg:
+        bn_cfg = dict(bn_cfg)
+        store = build_calibration_store(cfg.dataset.name, rank=rank, world_size=world_size, **cfg.dataset.args,
+                                        **bn_cfg.pop("calibration_data", {}))
+        model.reestimate_bn_stats(store.batches(cfg.device), cfg.device, **bn_cfg)
+
+
 def _dist_eval(cfg):
     eval_set = build_dataset(cfg.dataset.name, eval_only=True, **cfg.dataset.args)
     eval_loader = DataLoader(eval_set, sampler=DistributedSampler(eval_set), **cfg.eval.data_loader.args)
@@ -31,6 +42,7 @@ def _dist_eval(cfg):
         evaluator.register_logger_hooks(cfg.log)
     if cfg.resume:
         evaluator.resume(cfg.resume, resume_optimizer=False)
+    _reestimate_bn_stats(model, cfg, dist.get_rank(), dist.get_world_size())
 
     model.to_ddp()
     evaluator.call_hook("before_run")
@@ -59,6 +71,7 @@ def _local_eval(cfg):
         evaluator.register_logger_hooks(cfg.log)
     if cfg.resume:
         evaluator.resume(cfg.resume, resume_optimizer=False)
+    _reestimate_bn_stats(model, cfg)
 
     evaluator.call_hook("before_run")
     evaluator.val(eval_loader, device=cfg.device, quant_mode=cfg.eval.quant_mode, runtime_hook=runtime_hook_updater)
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import torch
+from torch.utils.data import DataLoader
+from mmcv.runner import save_checkpoint
+
+import quant_pack.core.wrapper as wrapper
+import quant_pack.core.runner as runner
+from quant_pack.core.ptq import calibrate_activations, reconstruct_blocks
+from quant_pack.datasets import build_dataset, build_calibration_store
+from quant_pack.models import build_model
+
+from .utils import load_pre_trained
+
+
+def ptq_classifier(cfg):
+    """Post-training quantization of a pre-trained model, configured by the `ptq` entry:
+
+        ptq:
+          calibration_data: {num_samples: 2048, batch_size: 64, cache_file: ...}  # see `CalibrationStore`
+          weight: {method: mse}            # see `ParametrizedQuantWrapper.calibrate_weights`
+          activation: {observer: histogram, method: mse}  # see `ActivationCalibrationBuilder`
+          reconstruction: {iters: 500}     # see `reconstruct_blocks`, skipped if not given
+
+    The quantized model is saved to `{work_dir}/ptq.pth` and evaluated with the `eval` entry.
+    """
+    assert not cfg.distributed, "PTQ only runs locally"
+    eval_set = build_dataset(cfg.dataset.name, eval_only=True, **cfg.dataset.args)
+    eval_loader = DataLoader(eval_set, **cfg.eval.data_loader.args)
+
+    model = build_model(cfg.model)
+    if cfg.pre_trained:
+        load_pre_trained(model, cfg.pre_trained)
+    bn_folding_mapping = wrapper.track_bn_folding_mapping(model, torch.randn(*cfg.model.input_size))
+    model = wrapper.__dict__[cfg.wrapper.name](model, bn_folding_mapping=bn_folding_mapping, **cfg.wrapper.args)
+    model.module.to(cfg.device)
+    model.eval()
+
+    evaluator = runner.MultiOptimRunner(model, model.batch_processor, work_dir=cfg.work_dir)
+    evaluator.register_eval_hooks(cfg.eval.metrics)
+    if cfg.log:
+        evaluator.register_logger_hooks(cfg.log)
+
+    # batches are moved to the device by `calibrate_activations` and `reconstruct_blocks`
+    calibration_store = build_calibration_store(cfg.dataset.name, **cfg.dataset.args, **cfg.ptq.calibration_data)
+    model.calibrate_weights(**cfg.ptq.get("weight", {}))
+    calibrate_activations(model, calibration_store, cfg.device, **cfg.ptq.get("activation", {}))
+    if cfg.ptq.get("reconstruction") is not None:
+        reconstruct_blocks(model, calibration_store, cfg.device, os.path.join(cfg.work_dir, "ptq_cache"),
+                           logger=evaluator.logger, **cfg.ptq.reconstruction)
+    save_checkpoint(model, os.path.join(cfg.work_dir, "ptq.pth"))
+
+    evaluator.call_hook("before_run")
+    evaluator.val(eval_loader, device=cfg.device, quant_mode=cfg.eval.quant_mode)
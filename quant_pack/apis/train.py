@@ -1,16 +1,25 @@
 # -*- coding: utf-8 -*-
 
 import torch
+import torch.distributed as dist
 from torch.utils.data import DataLoader, DistributedSampler
 
 import quant_pack.core.wrapper as wrapper
 import quant_pack.core.runner as runner
-from quant_pack.datasets import build_dataset
+from quant_pack.datasets import build_dataset, build_calibration_store
 from quant_pack.models import build_model
 
 from .utils import load_pre_trained, fresh_resume, item_to_tuple
 
 
+def _setup_calibration_store(trainer, cfg, rank=0, world_size=1):
+    # calibration is fed from a subset decoded once, instead of the training loader
+    store_cfg = cfg.train.get("calibration_data")
+    if store_cfg:
+        trainer.calibration_store = build_calibration_store(cfg.dataset.name, rank=rank, world_size=world_size,
+                                                            **cfg.dataset.args, **store_cfg)
+
+
 def _dist_train(cfg):
     train_set, eval_set = build_dataset(cfg.dataset.name, eval_only=False, **cfg.dataset.args)
     train_loader = DataLoader(train_set, sampler=DistributedSampler(train_set), **cfg.train.data_loader.args)
@@ -34,6 +43,7 @@ def _dist_train(cfg):
         trainer.register_logger_hooks(cfg.log)
     if cfg.resume:
         trainer.resume(cfg.resume)
+    _setup_calibration_store(trainer, cfg, dist.get_rank(), dist.get_world_size())
 
     trainer.model.to_ddp()
     trainer.run([train_loader, eval_loader], item_to_tuple(*cfg.work_flow), cfg.epochs,
@@ -65,6 +75,7 @@ def _local_train(cfg):
         trainer.register_logger_hooks(cfg.log)
     if cfg.resume:
         trainer.resume(cfg.resume)
+    _setup_calibration_store(trainer, cfg)
 
     trainer.run([train_loader, eval_loader], item_to_tuple(*cfg.work_flow), cfg.epochs,
                 device=cfg.device, runtime_hook=trainer.runtime_hook)
@@ -7,6 +7,8 @@ import torch.nn.functional as F
 import torch.distributed as dist
 from torch.nn.modules._functions import SyncBatchNorm as sync_batch_norm
 
+import quant_pack.core.quant.functional as quant_f
+
 __all__ = ["fused_conv_bn_forward", "fused_bn_forward", "fused_fc_bn_forward"]
 
 
@@ -33,19 +35,42 @@ def detach_vars(*args):
     return ret
 
 
+# shapes to broadcast per-channel vectors to Conv/FC weights (C_out, ...) and outputs (N, C_out, ...)
+def _weight_view(weight):
+    return (-1, ) + (1, ) * (weight.dim() - 1)
+
+
+def _output_view(output):
+    return (1, -1) + (1, ) * (output.dim() - 2)
+
+
+def _channel_var_mean(output):
+    return var_mean(output.transpose(0, 1).reshape(output.size(1), -1), dim=1)
+
+
 def fused_conv_bn_forward(module, input):
-    if module.input_transform is not None:
-        input = module.input_transform(input)
+    return _fused_bn_forward(module, input, quant_f.conv2d)
+
+
+def fused_fc_bn_forward(module, input):
+    return _fused_bn_forward(module, input, quant_f.linear)
+
+
+def _fused_bn_forward(module, input, layer_f):
+    # `layer_f(module, input, weight, bias)` is the Conv/FC operator of `module`
+    input_transform = module.input_qconf.transform
+    if input_transform is not None:
+        input = input_transform(input)
 
     weight, bias, alpha, beta = module.weight, module.bias, module.alpha, module.beta
+    weight_transform = module.weight_qconf.transform
 
     if not module.fold_bn:
-        if module.weight_transform is not None:
-            weight = module.weight_transform(weight)
+        if weight_transform is not None:
+            weight = quant_f.cached_weight(module, lambda: weight_transform(weight), weight)
         elif module.weight_qconf.retain_fp:
             weight, bias, alpha, beta = detach_vars(weight, bias, alpha, beta)
-        pre_activation = F.conv2d(input, weight, bias, module.stride,
-                                  module.padding, module.dilation, module.groups)
+        pre_activation = layer_f(module, input, weight, bias)
         if module.sync_bn:
             process_group = dist.group.WORLD
             world_size = dist.get_world_size(process_group)
@@ -62,18 +87,64 @@ def fused_conv_bn_forward(module, input):
                     module.gather_buffer[name] = locals()[name].detach()
         return normed_activation
 
+    if module.training and getattr(module, "fold_bn_mode", "two_pass") == "single_pass":
+        return _single_pass_fused_bn_forward(module, input, layer_f, weight, bias, alpha, beta)
+
     with torch.no_grad():
         if module.training:
-            pre_activation = F.conv2d(input, weight, bias, module.stride,
-                                      module.padding, module.dilation, module.groups)
-            pre_activation = pre_activation.permute(1, 0, 2, 3).reshape(module.out_channels, -1)
-            var, mean = var_mean(pre_activation, dim=1)
-            module.running_mean.mul_(1. - module.bn_momentum).add_(module.bn_momentum, mean)
-            module.running_var.mul_(1. - module.bn_momentum).add_(module.bn_momentum, var)
+            var, mean = _channel_var_mean(layer_f(module, input, weight, bias))
+            _update_running_stats(module, mean, var)
         else:
             var, mean = module.running_var, module.running_mean
+
+    if module.training:
+        weight, bias = _fold_bn(module, weight, bias, alpha, beta, mean, var)
+    else:
+        # running statistics are fixed in eval mode, so is the folded weight
+        weight, bias = quant_f.cached_weight(module, lambda: _fold_bn(module, weight, bias, alpha, beta, mean, var),
+                                             weight, bias, alpha, beta, mean, var)
+
+    return layer_f(module, input, weight, bias)
+
+
+def _update_running_stats(module, mean, var):
+    module.running_mean.mul_(1. - module.bn_momentum).add_(mean, alpha=module.bn_momentum)
+    module.running_var.mul_(1. - module.bn_momentum).add_(var, alpha=module.bn_momentum)
+
+
+def _single_pass_fused_bn_forward(module, input, layer_f, weight, bias, alpha, beta):
+    # fold BN with running statistics so that only one conv is needed, then rescale
+    # outputs to batch statistics, which are estimated from the very outputs
+    with torch.no_grad():
+        running_std = torch.sqrt(module.running_var + module.bn_eps)
+    scale = alpha / running_std if module.affine else running_std.reciprocal()
+    weight = weight * scale.view(_weight_view(weight))
+    weight_transform = module.weight_qconf.transform
+    if weight_transform is not None:
+        weight = weight_transform(weight)
+    output = layer_f(module, input, weight, None)
+
+    with torch.no_grad():
+        # outputs are `scale` times the unfolded conv outputs (up to quantization error)
+        scale = scale.detach().masked_fill(scale == 0, 1.)
+        var, mean = _channel_var_mean(output)
+        mean = mean / scale
+        var = var / scale.pow(2)
+        _update_running_stats(module, mean if bias is None else mean + bias, var)
+        batch_std = torch.sqrt(var + module.bn_eps)
+
+    c_view = _output_view(output)
+    if module.affine:
+        shift = beta - alpha * mean / batch_std
+    else:
+        shift = -mean / batch_std
+    return output * (running_std / batch_std).view(c_view) + shift.view(c_view)
+
+
+def _fold_bn(module, weight, bias, alpha, beta, mean, var):
+    with torch.no_grad():
         safe_std = torch.sqrt(var + module.bn_eps)
-        w_view = (module.out_channels, 1, 1, 1)
+        w_view = _weight_view(weight)
 
     if module.affine:
         weight = weight * (alpha / safe_std).view(w_view)
@@ -90,16 +161,13 @@ def fused_conv_bn_forward(module, input):
         else:
             bias = beta
 
-    if module.weight_transform is not None:
-        weight = module.weight_transform(weight)
+    weight_transform = module.weight_qconf.transform
+    if weight_transform is not None:
+        weight = weight_transform(weight)
 
-    return F.conv2d(input, weight, bias, module.stride,
-                    module.padding, module.dilation, module.groups)
+    return weight, bias
 
 
 def fused_bn_forward(module, input):
     return input
 
-
-def fused_fc_bn_forward(module, input):
-    raise NotImplementedError()
@@ -0,0 +1,5 @@
+# -*- coding: utf-8 -*-
+
+from .block_reconstruction import ActivationCache, calibrate_activations, find_blocks, reconstruct_blocks
+
+__all__ = ["ActivationCache", "calibrate_activations", "find_blocks", "reconstruct_blocks"]
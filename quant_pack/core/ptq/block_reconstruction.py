@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from quant_pack.core.wrapper.hook.calibration_builder import ActivationCalibrationBuilder
+
+__all__ = ["ActivationCache", "calibrate_activations", "find_blocks", "reconstruct_blocks"]
+
+
+class ActivationCache:
+    """Activations of `num_samples` inputs in a memory-mapped .npy file at `path`, appended batch by
+    batch and read at random indices, so that host memory stays bounded by a batch.
+    """
+
+    def __init__(self, path, num_samples, dtype=np.float32):
+        self.path = path
+        self.num_samples = num_samples
+        self.dtype = dtype
+        self.array = None
+        self.size = 0
+
+    def append(self, t):
+        t = t.detach().cpu().numpy()
+        if self.array is None:
+            self.array = np.lib.format.open_memmap(self.path, mode="w+", dtype=self.dtype,
+                                                   shape=(self.num_samples, ) + t.shape[1:])
+        self.array[self.size:self.size + len(t)] = t
+        self.size += len(t)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, indices):
+        # sorted indices for sequential reads
+        return torch.from_numpy(np.ascontiguousarray(self.array[np.sort(indices)]))
+
+    def close(self):
+        if self.array is not None:
+            del self.array
+            self.array = None
+            os.remove(self.path)
+
+
+class _StopForward(Exception):
+    pass
+
+
+def _capture(wrapper, module, input):
+    # input and output of `module` when `wrapper` forwards `input`, layers after `module` are skipped
+    captured = {}
+
+    def hook(m, args, output):
+        captured["input"], captured["output"] = args[0], output
+        raise _StopForward()
+
+    handle = module.register_forward_hook(hook)
+    try:
+        wrapper(input)
+    except _StopForward:
+        pass
+    finally:
+        handle.remove()
+    return captured["input"], captured["output"]
+
+
+def _set_quant(wrapper, enabled):
+    wrapper.quant_w(enabled)
+    wrapper.quant_a(enabled)
+
+
+@torch.no_grad()
+def calibrate_activations(wrapper, data, device, **calibration_args):
+    """`a_lb` / `a_ub` of all quantized layers from QWFA forwards of `data`, by `ActivationCalibrationBuilder`
+    with `calibration_args`. Quantized-domain BN statistics are reset to the FP ones.
+    """
+    builder = ActivationCalibrationBuilder(None, None, **calibration_args)
+    handles = [m.register_forward_hook(builder.forward_hook) for m in wrapper._quant_submodules]
+    wrapper.quant_w()
+    wrapper.fp_a()
+    try:
+        for img, _ in data:
+            wrapper(img.to(device, non_blocking=True))
+    finally:
+        for h in handles:
+            h.remove()
+    builder.update_bounds()
+    for m in wrapper._fused_submodules:
+        if not isinstance(m, (nn.BatchNorm1d, nn.BatchNorm2d, nn.SyncBatchNorm)):
+            m._running_mean_q = m._running_mean_fp.clone()
+            m._running_var_q = m._running_var_fp.clone()
+
+
+def find_blocks(wrapper, input, block_types=r"(BasicBlock|Bottleneck)$"):
+    """Units reconstructed one at a time, in forward order: modules whose class names match `block_types`,
+    and quantized layers outside of them (e.g. the stem conv and the classifier). Returns [(name, module)].
+    """
+    block_types = re.compile(block_types)
+    units = []
+    for n, m in wrapper.module.named_modules():
+        if any(n.startswith(f"{u}.") for u, _ in units):
+            continue
+        if block_types.match(m.__class__.__name__) or m in wrapper._quant_submodules:
+            units.append((n, m))
+
+    order = []
+    handles = [m.register_forward_pre_hook(lambda m, args: order.append(m)) for _, m in units]
+    try:
+        with torch.no_grad():
+            wrapper(input)
+    finally:
+        for h in handles:
+            h.remove()
+    rank = {m: i for i, m in reversed(list(enumerate(order)))}
+    return sorted([u for u in units if u[1] in rank], key=lambda u: rank[u[1]])
+
+
+@torch.no_grad()
+def _cache_block_data(wrapper, block, data, device, cache_dir, num_samples):
+    # inputs from the quantized model so far, targets from the FP model
+    inputs = ActivationCache(os.path.join(cache_dir, "inputs.npy"), num_samples)
+    targets = ActivationCache(os.path.join(cache_dir, "targets.npy"), num_samples)
+    for img, _ in data:
+        img = img.to(device, non_blocking=True)
+        _set_quant(wrapper, True)
+        inputs.append(_capture(wrapper, block, img)[0])
+        _set_quant(wrapper, False)
+        targets.append(_capture(wrapper, block, img)[1])
+    return inputs, targets
+
+
+def _bn_scale(m):
+    std = torch.sqrt(m.running_var + m.bn_eps)
+    return m.alpha / std if m.affine else std.reciprocal()
+
+
+@torch.no_grad()
+def _bake_rounding_offset(wrapper, m):
+    # offsets are added to weights as quantized, i.e. BN-folded ones if `fold_bn`
+    offset = m.weight_qconf._clamped_rounding_offset()
+    if m in wrapper._fused_submodules and m.fold_bn:
+        scale = _bn_scale(m)
+        scale = scale.masked_fill(scale == 0, 1.).view((-1, ) + (1, ) * (offset.dim() - 1))
+        offset = offset / scale
+    m.weight.add_(offset)
+    m.weight_qconf.rounding_offset = None
+
+
+def reconstruct_blocks(wrapper, data, device, cache_dir, block_types=r"(BasicBlock|Bottleneck)$", iters=500,
+                       batch_size=32, bound_lr=1e-3, rounding_lr=1e-3, logger=None):
+    """Block-wise post-training quantization: for each unit of `find_blocks`, `w_lb` / `w_ub` and rounding
+    offsets of weights of its quantized layers are tuned by Adam for `iters` steps, to minimize MSE between
+    outputs of the QWQA unit on inputs from preceding quantized units and outputs of the FP unit. Inputs and
+    targets of all `data` batches are cached in memory-mapped files under `cache_dir`, one unit at a time.
+    Learned rounding offsets are added to FP weights at the end of each unit.
+
+    `data` is iterated once per unit, thus should be re-iterable, e.g. a `CalibrationStore`.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    wrapper.eval()
+    num_samples = sum(len(label) for _, label in data)
+    units = find_blocks(wrapper, next(iter(data))[0].to(device), block_types)
+
+    for name, block in units:
+        layers = [m for m in block.modules() if m in wrapper._quant_submodules and not m.weight_qconf.retain_fp]
+        if not layers:
+            continue
+        inputs, targets = _cache_block_data(wrapper, block, data, device, cache_dir, num_samples)
+
+        requires_grad = {p: p.requires_grad for p in wrapper.parameters()}
+        wrapper.requires_grad_(False)
+        bounds, offsets = [], []
+        for m in layers:
+            m.w_lb.requires_grad_(True)
+            m.w_ub.requires_grad_(True)
+            bounds += [m.w_lb, m.w_ub]
+            m.weight_qconf.rounding_offset = torch.zeros_like(m.weight, requires_grad=True)
+            offsets.append(m.weight_qconf.rounding_offset)
+        optimizer = torch.optim.Adam([dict(params=bounds, lr=bound_lr), dict(params=offsets, lr=rounding_lr)])
+
+        _set_quant(wrapper, True)
+        try:
+            for step in range(iters):
+                if wrapper._transform_cache is not None:
+                    wrapper._transform_cache.next_step()
+                indices = np.random.choice(len(inputs), min(batch_size, len(inputs)), replace=False)
+                x, y = inputs[indices].to(device), targets[indices].to(device)
+                loss = F.mse_loss(block(x), y)
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+                if logger is not None and (step + 1) % 100 == 0:
+                    logger.info(f"reconstructing {name}: step {step + 1}/{iters}, loss {loss.item():.6f}")
+            for m in layers:
+                _bake_rounding_offset(wrapper, m)
+        finally:
+            for m in layers:
+                m.weight_qconf.rounding_offset = None
+            for p, flag in requires_grad.items():
+                p.requires_grad_(flag)
+            inputs.close()
+            targets.close()
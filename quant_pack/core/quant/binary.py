@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+__all__ = ["pack_bits", "popcount", "BinaryWeight", "binary_conv2d", "binary_linear"]
+
+WORD_BITS = 64
+# SWAR popcount constants, highest bits are all 0 thus right shifts of int64 need no care of signs
+_M1 = 0x5555555555555555
+_M2 = 0x3333333333333333
+_M4 = 0x0F0F0F0F0F0F0F0F
+_H01 = 0x0101010101010101
+
+
+def pack_bits(bits):
+    """Pack bool `bits` of shape (..., n) into 64-bit words (..., ceil(n / 64)), stored as int64."""
+    pad = -bits.size(-1) % WORD_BITS
+    bits = bits.to(torch.uint8)
+    if pad:
+        bits = F.pad(bits, (0, pad))
+    # bits -> bytes, then every 8 bytes are reinterpreted as a little-endian word, so that bit i of
+    # a row is still bit i % 64 of word i // 64, without (..., words, 64) int64 intermediates
+    bits = bits.view(bits.shape[:-1] + (-1, 8))
+    shifts = torch.arange(8, dtype=torch.uint8, device=bits.device)
+    return (bits << shifts).sum(dim=-1, dtype=torch.uint8).view(torch.int64)
+
+
+def popcount(x):
+    x = x - ((x >> 1) & _M1)
+    x = (x & _M2) + ((x >> 2) & _M2)
+    x = (x + (x >> 4)) & _M4
+    return (x * _H01) >> 56
+
+
+class BinaryWeight(nn.Module):
+    """Binarized Conv/FC weights `center + radius * (2 * bit - 1)` packed into 64-bit words of shape
+    (groups, C_out / groups, words), `center` and `radius` are scalars or of size C_out. Negative radii
+    (e.g. scaled by negative BN gammas) are stored as their absolute values, `bit` is always `weight > center`.
+    """
+
+    def __init__(self, weight, center, radius, groups=1):
+        super(BinaryWeight, self).__init__()
+        self.shape = weight.shape
+        self.groups = groups
+        self.row_numel = weight[0].numel()
+        center, radius = (torch.as_tensor(t, dtype=torch.float64, device=weight.device) for t in (center, radius))
+        with torch.no_grad():
+            rows = weight.detach().reshape(self.shape[0], -1).double()
+            # bits of `center + |radius| * (2 * bit - 1)`, whatever the sign of `radius`
+            bits = rows > (center.view(-1, 1) if center.dim() > 0 else center)
+            self.register_buffer("words", pack_bits(bits).view(groups, self.shape[0] // groups, -1))
+        radius = radius.abs()
+        self.register_buffer("center", center.view(groups, -1) if center.dim() > 0 else center)
+        self.register_buffer("radius", radius.view(groups, -1) if radius.dim() > 0 else radius)
+
+    def extra_repr(self):
+        return f"shape={tuple(self.shape)}, groups={self.groups}, per_channel={self.center.dim() > 0}"
+
+
+def _binary_dot(a_words, a_center, a_radius, weight, valid=None, n_valid=None, block_numel=2 ** 20):
+    # a_words: (B, L, G, W) activation words, `valid`: (L, G, W) words of non-padding positions,
+    # `n_valid`: (L, G) numbers of them; returns (B, L, G, O) dot products in float64, where
+    #   sum(a * w) = n * ca * cw + ca * dw * sum(s_w) + da * cw * sum(s_a) + da * dw * sum(s_a * s_w)
+    # in which a = ca + da * s_a, w = cw + dw * s_w, s = 2 * bit - 1, sum(s_a * s_w) = n - 2 * popcount(a ^ w)
+    batch, length, groups, _ = a_words.shape
+    w_words = weight.words
+    if valid is None:
+        n_valid = torch.full((1, groups), weight.row_numel, dtype=torch.int64, device=a_words.device)
+        w_count = popcount(w_words).sum(dim=-1).unsqueeze(0)  # (1, G, O)
+    else:
+        w_count = popcount(w_words.unsqueeze(0) & valid.unsqueeze(2)).sum(dim=-1)  # (L, G, O)
+    s_w = 2 * w_count - n_valid.unsqueeze(-1)
+    s_a = 2 * popcount(a_words).sum(dim=-1) - n_valid  # (B, L, G)
+
+    # XOR / popcount in blocks of positions, which bounds the (B, l, G, O, W) intermediates
+    step = max(block_numel // max(batch * groups * w_words.size(1) * w_words.size(2), 1), 1)
+    s_aw = []
+    for start in range(0, length, step):
+        end = min(start + step, length)
+        xor = a_words[:, start:end].unsqueeze(3) ^ w_words
+        if valid is not None:
+            xor &= valid[start:end].unsqueeze(2)
+        s_aw.append(popcount(xor).sum(dim=-1))
+    s_aw = n_valid.unsqueeze(-1) - 2 * torch.cat(s_aw, dim=1)
+
+    w_center, w_radius = weight.center, weight.radius
+    return n_valid.unsqueeze(-1).double() * (a_center * w_center) + (a_center * w_radius) * s_w.double() \
+        + (a_radius * s_a.double()).unsqueeze(-1) * w_center + (a_radius * w_radius) * s_aw.double()
+
+
+def _center_radius(lb, ub):
+    lb, ub = lb.detach().double(), ub.detach().double()
+    return (ub + lb) / 2, (ub - lb) / 2
+
+
+def binary_conv2d(input, lb, ub, weight, bias, stride, padding, dilation, valid_cache=None):
+    """`F.conv2d` of inputs binarized to {lb, ub} (by `input > 0`) and `BinaryWeight`, by XOR / popcount
+    on im2col-ed 64-bit words. Zero padding positions are excluded from dot products by `valid` masks,
+    which only depend on input sizes and are cached in `valid_cache` if given.
+    """
+    n, c, h, w = input.shape
+    groups = weight.groups
+    kernel_size = weight.shape[2:]
+    cols = F.unfold((input > 0).to(input.dtype), kernel_size, dilation, padding, stride)  # (N, C*k*k, L)
+    length = cols.size(2)
+    a_words = pack_bits(cols.transpose(1, 2).reshape(n, length, groups, -1) > 0.5)
+
+    valid = n_valid = None
+    if any(p > 0 for p in padding):
+        key = (c, h, w)
+        if valid_cache is not None and key in valid_cache:
+            valid, n_valid = valid_cache[key]
+        else:
+            ones = torch.ones(1, c, h, w, dtype=input.dtype, device=input.device)
+            valid_bits = F.unfold(ones, kernel_size, dilation, padding, stride)[0].t().reshape(length, groups, -1) > 0.5
+            valid, n_valid = pack_bits(valid_bits), valid_bits.sum(dim=-1)
+            if valid_cache is not None:
+                valid_cache[key] = (valid, n_valid)
+
+    output = _binary_dot(a_words, *_center_radius(lb, ub), weight, valid, n_valid)  # (N, L, G, O)
+    output = output.reshape(n, length, -1).transpose(1, 2).to(input.dtype)
+    if bias is not None:
+        output = output + bias.view(1, -1, 1)
+    h_out = (h + 2 * padding[0] - dilation[0] * (kernel_size[0] - 1) - 1) // stride[0] + 1
+    w_out = (w + 2 * padding[1] - dilation[1] * (kernel_size[1] - 1) - 1) // stride[1] + 1
+    return output.view(n, -1, h_out, w_out)
+
+
+def binary_linear(input, lb, ub, weight, bias):
+    """`F.linear` counterpart of `binary_conv2d`."""
+    a_words = pack_bits(input.reshape(-1, 1, 1, input.size(-1)) > 0)
+    output = _binary_dot(a_words, *_center_radius(lb, ub), weight)
+    output = output.view(input.shape[:-1] + (-1, )).to(input.dtype)
+    if bias is not None:
+        output = output + bias
+    return output
@@ -3,13 +3,15 @@
 import math
 from enum import Flag, auto
 
-from quant_pack.core.quant.functional import fake_linear_quant
+import torch
+
+from quant_pack.core.quant.functional import fake_linear_quant, tensor_key
 
 _registered_quantizers = {
     "linear": fake_linear_quant,
 }
 
-__all__ = ["QuantConfig", "QuantMode"]
+__all__ = ["QuantConfig", "QuantMode", "QuantSwitch"]
 
 
 class _SequentialLambdas:
@@ -33,6 +35,19 @@ def combine_optional_callables(*args):
         return _SequentialLambdas(*args)
 
 
+@torch.no_grad()
+def _prune_thresholds(lb, ub, bit_width):
+    # tensor version of `QuantConfig._host_prune_thresholds`, branches
+    # are replaced by `torch.where` so that they could stay on device
+    delta = (ub - lb) / (2 ** bit_width - 1)
+    inf = torch.full_like(lb, math.inf)
+    q0_minor = lb + torch.floor(lb.abs() / delta) * delta
+    q0_plus = lb + torch.ceil(lb.abs() / delta) * delta
+    p_lb = torch.where(0. < lb, -inf, torch.where(ub < 0., ub + delta / 2, q0_minor / 2))
+    p_ub = torch.where(0. < lb, lb - delta / 2, torch.where(ub < 0., inf, q0_plus / 2))
+    return p_lb, p_ub
+
+
 class QuantMode(Flag):
     QW = auto()
     QA = auto()
@@ -70,20 +85,35 @@ class QuantMode(Flag):
             return super(QuantMode, self).__str__()
 
 
+class QuantSwitch:
+    """Enables / disables a group of `QuantConfig` at once, e.g. all weight configs of a model."""
+
+    __slots__ = ("enabled", )
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+
+
 class QuantConfig:
 
-    def __init__(self, method, bit_width, lb, ub, align_zero, prune_to_zero=False):
+    def __init__(self, method, bit_width, lb, ub, align_zero, prune_to_zero=False, low_memory=False,
+                 sync_free=False, switch=None):
         self.method = method
         self.bit_width = bit_width
         self.lb = lb
         self.ub = ub
         self.align_zero = align_zero
         self.prune_to_zero = prune_to_zero
+        self.low_memory = low_memory
+        self.sync_free = sync_free
         self.retain_fp = False
 
         self._enabled = True
+        self._switch = switch if switch is not None else QuantSwitch()
         self._quantizer = _registered_quantizers[self.method]
         self._manual_bias = None  # experimental
+        self.rounding_offset = None  # learned by block reconstruction, see `quant_pack.core.ptq`
+        self._transforms = {}
 
     def quant(self, enabled=True):
         self._enabled = enabled
@@ -93,33 +123,101 @@ class QuantConfig:
 
     @property
     def transform(self):
-        if self._enabled and not self.retain_fp:
-            if self.prune_to_zero:
-                lb, ub = self.lb.item(), self.ub.item()
-                delta = (ub - lb) / (2 ** self.bit_width - 1)
-                if 0. < lb:
-                    p_lb = None
-                    p_ub = lb - delta / 2
-                elif ub < 0.:
-                    p_lb = ub + delta / 2
-                    p_ub = None
-                else:
-                    q0_minor = lb + math.floor(abs(lb) / delta) * delta
-                    q0_plus = lb + math.ceil(abs(lb) / delta) * delta
-                    p_lb = q0_minor / 2
-                    p_ub = q0_plus / 2
+        # transforms are built once per state and looked up afterwards, only thresholds of
+        # host-side `prune_to_zero` depend on bound values, thus also on their versions
+        enabled = self.enabled and not self.retain_fp
+        key = (enabled, self.prune_to_zero, self.sync_free, self._manual_bias is not None,
+               self.rounding_offset is not None)
+        if enabled and self.prune_to_zero and not self.sync_free:
+            version = (tensor_key(self.lb), tensor_key(self.ub))
+        else:
+            version = None
+        entry = self._transforms.get(key)
+        if entry is None or entry[0] != version:
+            entry = (version, self._build_transform(enabled))
+            self._transforms[key] = entry
+        return entry[1]
+
+    def _build_transform(self, enabled):
+        if enabled:
+            if self.prune_to_zero and self.sync_free:
+                q_f = lambda x: self._quantizer(x, self.lb, self.ub, self.bit_width, self.align_zero,
+                                                *_prune_thresholds(self.lb, self.ub, self.bit_width),
+                                                low_memory=self.low_memory, sync_free=True)
             else:
-                p_lb = p_ub = None
-            q_f = lambda x: self._quantizer(x, self.lb, self.ub, self.bit_width, self.align_zero, p_lb, p_ub)
+                if self.prune_to_zero:
+                    p_lb, p_ub = self._host_prune_thresholds()
+                else:
+                    p_lb = p_ub = None
+                q_f = lambda x: self._quantizer(x, self.lb, self.ub, self.bit_width, self.align_zero, p_lb, p_ub,
+                                                low_memory=self.low_memory, sync_free=self.sync_free)
         else:
             q_f = None
 
+        if enabled and self.rounding_offset is not None:
+            offset_f = lambda x: x + self._clamped_rounding_offset()
+        else:
+            offset_f = None
+
         if self._manual_bias is not None:
             bias_f = lambda x: x + x.detach().mul_(self._manual_bias)
         else:
             bias_f = None
 
-        return combine_optional_callables(q_f, bias_f)
+        return combine_optional_callables(offset_f, q_f, bias_f)
+
+    def _clamped_rounding_offset(self):
+        # offsets within half a step only change rounding directions
+        with torch.no_grad():
+            half_step = (self.ub - self.lb) / (2 * (2 ** self.bit_width - 1))
+            if half_step.dim() > 0:
+                half_step = half_step.view((-1, ) + (1, ) * (self.rounding_offset.dim() - 1))
+        return torch.max(torch.min(self.rounding_offset, half_step), -half_step)
+
+    def _host_prune_thresholds(self):
+        lb, ub = self.lb.item(), self.ub.item()
+        delta = (ub - lb) / (2 ** self.bit_width - 1)
+        if 0. < lb:
+            p_lb = None
+            p_ub = lb - delta / 2
+        elif ub < 0.:
+            p_lb = ub + delta / 2
+            p_ub = None
+        else:
+            q0_minor = lb + math.floor(abs(lb) / delta) * delta
+            q0_plus = lb + math.ceil(abs(lb) / delta) * delta
+            p_lb = q0_minor / 2
+            p_ub = q0_plus / 2
+        return p_lb, p_ub
+
+    @property
+    def cache_key(self):
+        # changes whenever `transform` may give a different result on the same input
+        return (self.method, self.bit_width, self.align_zero, self.prune_to_zero, self.sync_free, self.retain_fp,
+                self.enabled, tensor_key(self.lb), tensor_key(self.ub), tensor_key(self._manual_bias),
+                tensor_key(self.rounding_offset))
+
+    @torch.no_grad()
+    def grid_params(self):
+        # (scale, zero_point, offset) s.t. outputs of `transform` are `(i - zero_point) * scale + offset`,
+        # None if the outputs are not guaranteed to be on such a k-bit grid
+        if not self.enabled or self.retain_fp or self.prune_to_zero or self._manual_bias is not None:
+            return None
+        if self.method != "linear" or not 2 <= self.bit_width <= 8 or self.lb.dim() > 0:
+            return None
+        n = 2 ** self.bit_width - 1
+        lb, ub = self.lb.detach().double(), self.ub.detach().double()
+        if self.align_zero:
+            # same nudging as the quantizer kernels
+            ub = torch.max(lb + 1e-2, ub)
+            scale = (ub - lb) / n
+            zero_point = torch.round(lb.abs() / scale)
+            offset = torch.zeros_like(lb)
+        else:
+            scale = (ub - lb) / n
+            zero_point = torch.zeros_like(lb)
+            offset = lb
+        return tuple(t.to(self.lb.dtype) for t in (scale, zero_point, offset))
 
     @property
     def params(self):
@@ -133,4 +231,4 @@ class QuantConfig:
 
     @property
     def enabled(self):
-        return self._enabled
+        return self._enabled and self._switch.enabled
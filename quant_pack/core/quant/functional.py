@@ -4,8 +4,13 @@ import torch
 import torch.nn.functional as F
 
 import quant_pack.operators as q_op
+from .packing import PackedInputConv2dFunc, PackedInputLinearFunc
+from .binary import binary_conv2d, binary_linear
 
-__all__ = ["fake_linear_quant", "quant_conv2d_forward", "quant_linear_forward"]
+__all__ = ["fake_linear_quant", "quant_conv2d_forward", "quant_linear_forward", "packed_conv2d_forward",
+           "packed_linear_forward", "binary_conv2d_forward", "binary_linear_forward", "sparse_conv2d_forward",
+           "sparse_linear_forward", "conv2d", "linear",
+           "TransformCache", "cached_weight"]
 
 
 @torch.no_grad()
@@ -20,15 +25,16 @@ def prune_with_thresh_(x_f, x_q, prune_lb, prune_ub):
     x_q.masked_fill_(prune_mask, 0.)
 
 
-def fake_linear_quant(x, lb, ub, k, align_zero=False, prune_lb=None, prune_ub=None):
+def fake_linear_quant(x, lb, ub, k, align_zero=False, prune_lb=None, prune_ub=None, low_memory=False,
+                      sync_free=False):
     if k == 32:
         return x
     elif k == 1:
         quantizer = q_op.BinaryFunc.apply
-        qx = quantizer(x, lb, ub)
+        qx = quantizer(x, lb, ub, not sync_free)
     else:
         quantizer = q_op.LinearQuantFunc.apply
-        qx = quantizer(x, lb, ub, k, align_zero)
+        qx = quantizer(x, lb, ub, k, align_zero, low_memory, not sync_free)
     if prune_lb is not None or prune_ub is not None:
         prune_with_thresh_(x, qx, prune_lb, prune_ub)
     return qx
@@ -45,21 +51,172 @@ def detach_vars(*args):
     return ret
 
 
+def tensor_key(t):
+    # in-place updates (optimizer steps, `copy_`) bump `_version`, `.to()` changes `data_ptr`
+    if torch.is_tensor(t):
+        return t.data_ptr(), t._version
+    return t
+
+
+class TransformCache:
+    """Transformed (quantized, BN-folded) weights of each submodule, reused until any
+    tensor / config they are derived from changes. Shared by all submodules of a wrapper.
+    """
+
+    def __init__(self):
+        self.step = 0
+
+    def next_step(self):
+        # results built in grad mode carry autograd graphs, which could only be
+        # backwarded once, so they are only reused within the same step
+        self.step += 1
+
+    def get(self, module, key, fn):
+        if torch.is_grad_enabled():
+            key = key + (self.step, )
+        entry = module.__dict__.get("_transform_cache_entry")
+        if entry is not None and entry[0] == key:
+            return entry[1]
+        value = fn()
+        module._transform_cache_entry = (key, value)
+        return value
+
+
+def cached_weight(module, fn, *tensors):
+    # `fn()` transforms weight of `module` from `tensors`, results are cached if `module.transform_cache` is set
+    cache = getattr(module, "transform_cache", None)
+    if cache is None:
+        return fn()
+    key = (module.weight_qconf.cache_key, torch.is_grad_enabled()) + tuple(tensor_key(t) for t in tensors)
+    return cache.get(module, key, fn)
+
+
+def _packed_input_params(module, input, weight):
+    if not getattr(module, "compress_saved_input", False):
+        return None
+    if not torch.is_grad_enabled() or not weight.requires_grad:
+        return None
+    return module.input_qconf.grid_params()
+
+
+def conv2d(module, input, weight, bias):
+    # `F.conv2d` with the hyper-params of `module`, saves quantized input as packed codes if possible
+    params = _packed_input_params(module, input, weight)
+    if params is None:
+        return F.conv2d(input, weight, bias, module.stride, module.padding, module.dilation, module.groups)
+    return PackedInputConv2dFunc.apply(input, weight, bias, module.stride, module.padding, module.dilation,
+                                       module.groups, *params, module.input_qconf.bit_width)
+
+
+def linear(module, input, weight, bias):
+    params = _packed_input_params(module, input, weight)
+    if params is None:
+        return F.linear(input, weight, bias)
+    return PackedInputLinearFunc.apply(input, weight, bias, *params, module.input_qconf.bit_width)
+
+
 def quant_conv2d_forward(module, input):
-    raise NotImplementedError()
+    return _quant_forward(module, input, conv2d)
 
 
 def quant_linear_forward(module, input):
-    if module.input_transform is not None:
-        input = module.input_transform(input)
+    return _quant_forward(module, input, linear)
+
+
+def _quant_forward(module, input, layer_f):
+    input_transform = module.input_qconf.transform
+    if input_transform is not None:
+        input = input_transform(input)
     weight, bias = module.weight, module.bias
-    if module.weight_transform is not None:
-        weight = module.weight_transform(weight)
+    weight_transform = module.weight_qconf.transform
+    if weight_transform is not None:
+        weight = cached_weight(module, lambda: weight_transform(weight), weight)
     elif module.weight_qconf.retain_fp:
         weight, bias = detach_vars(weight, bias)
-    output = F.linear(input, weight, bias)
+    output = layer_f(module, input, weight, bias)
     if getattr(module, "gather_data", None):
         for name in module.gather_data:
             if name in locals():
                 module.gather_buffer[name] = locals()[name].detach()
     return output
+
+
+def _packed_blocks(module, units, rows_per_unit):
+    # [start, end) of units (output channels, or groups of grouped conv) unpacked at a time
+    step = max(module.packed_block_numel // (module.packed_weight.row_numel * rows_per_unit), 1)
+    for start in range(0, units, step):
+        yield start, min(start + step, units)
+
+
+def packed_conv2d_forward(module, input):
+    # weights are unpacked from `module.packed_weight` block by block, see `ParametrizedQuantWrapper.to_packed`
+    input_transform = module.input_qconf.transform
+    if input_transform is not None:
+        input = input_transform(input)
+    bias = module.bias
+    if module.groups == 1:
+        units, out_per_unit, in_per_unit = module.out_channels, 1, module.in_channels
+    else:
+        units = module.groups
+        out_per_unit, in_per_unit = module.out_channels // units, module.in_channels // units
+    outputs = []
+    for start, end in _packed_blocks(module, units, out_per_unit):
+        weight = module.packed_weight.unpack(start * out_per_unit, end * out_per_unit)
+        x = input if module.groups == 1 else input[:, start * in_per_unit:end * in_per_unit]
+        b = None if bias is None else bias[start * out_per_unit:end * out_per_unit]
+        groups = 1 if module.groups == 1 else end - start
+        outputs.append(F.conv2d(x, weight.to(input.dtype), b, module.stride, module.padding, module.dilation,
+                                groups))
+    return outputs[0] if len(outputs) == 1 else torch.cat(outputs, dim=1)
+
+
+def packed_linear_forward(module, input):
+    input_transform = module.input_qconf.transform
+    if input_transform is not None:
+        input = input_transform(input)
+    bias = module.bias
+    outputs = []
+    for start, end in _packed_blocks(module, module.out_features, 1):
+        weight = module.packed_weight.unpack(start, end)
+        outputs.append(F.linear(input, weight.to(input.dtype), None if bias is None else bias[start:end]))
+    return outputs[0] if len(outputs) == 1 else torch.cat(outputs, dim=-1)
+
+
+def binary_conv2d_forward(module, input):
+    # inputs are binarized by `input > 0` inside, as `BinaryFunc` does, see `ParametrizedQuantWrapper.to_packed`
+    return binary_conv2d(input, module.a_lb, module.a_ub, module.binary_weight, module.bias, module.stride,
+                         module.padding, module.dilation, module.binary_valid_cache)
+
+
+def binary_linear_forward(module, input):
+    return binary_linear(input, module.a_lb, module.a_ub, module.binary_weight, module.bias)
+
+
+def sparse_conv2d_forward(module, input):
+    # `module.sparse_weight` is a CSR matrix of (C_out, C_in * k * k), block-diagonal for grouped conv,
+    # multiplied with im2col-ed inputs, see `ParametrizedQuantWrapper.to_sparse`
+    input_transform = module.input_qconf.transform
+    if input_transform is not None:
+        input = input_transform(input)
+    n, _, h, w = input.shape
+    cols = F.unfold(input, module.kernel_size, module.dilation, module.padding, module.stride)  # (N, K, L)
+    length = cols.size(2)
+    output = torch.sparse.mm(module.sparse_weight, cols.transpose(0, 1).reshape(cols.size(1), -1))
+    output = output.view(-1, n, length).transpose(0, 1)
+    if module.bias is not None:
+        output = output + module.bias.view(1, -1, 1)
+    h_out = (h + 2 * module.padding[0] - module.dilation[0] * (module.kernel_size[0] - 1) - 1) \
+        // module.stride[0] + 1
+    w_out = (w + 2 * module.padding[1] - module.dilation[1] * (module.kernel_size[1] - 1) - 1) \
+        // module.stride[1] + 1
+    return output.reshape(n, -1, h_out, w_out)
+
+
+def sparse_linear_forward(module, input):
+    input_transform = module.input_qconf.transform
+    if input_transform is not None:
+        input = input_transform(input)
+    output = torch.sparse.mm(module.sparse_weight, input.reshape(-1, input.size(-1)).t()).t()
+    if module.bias is not None:
+        output = output + module.bias
+    return output.reshape(input.shape[:-1] + (-1, ))
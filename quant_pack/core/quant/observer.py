@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+
+import torch
+import torch.distributed as dist
+
+__all__ = ["MinMaxObserver", "EMAMinMaxObserver", "HistogramObserver", "OBSERVERS", "all_reduce_histograms",
+           "search_mse_bounds"]
+
+
+def _min_max(x):
+    x = x.detach()
+    return x.min().double(), x.max().double()
+
+
+class MinMaxObserver:
+    """Running min/max of all observed tensors, kept on device."""
+
+    def __init__(self, bit_width):
+        self.bit_width = bit_width
+        self.lb = self.ub = None
+
+    @torch.no_grad()
+    def update(self, x):
+        lb, ub = _min_max(x)
+        if self.lb is None:
+            self.lb, self.ub = lb, ub
+        else:
+            self.lb, self.ub = torch.min(self.lb, lb), torch.max(self.ub, ub)
+
+    def compute_bounds(self):
+        return self.lb, self.ub
+
+
+class EMAMinMaxObserver(MinMaxObserver):
+    """Exponential moving average of per-batch min/max."""
+
+    def __init__(self, bit_width, momentum=0.1):
+        super(EMAMinMaxObserver, self).__init__(bit_width)
+        self.momentum = momentum
+
+    @torch.no_grad()
+    def update(self, x):
+        lb, ub = _min_max(x)
+        if self.lb is None:
+            self.lb, self.ub = lb, ub
+        else:
+            self.lb = self.lb + (lb - self.lb) * self.momentum
+            self.ub = self.ub + (ub - self.ub) * self.momentum
+
+
+class HistogramObserver:
+    """Fixed-bin histogram of all observed tensors, bounds are searched on it once at the end by `method`:
+
+    - "percentile": `percentile` and `1 - percentile` quantiles;
+    - "mse": minimal expected k-bit quantization MSE, over all pairs of bin edges;
+    - "kl": minimal KL divergence between the clipped histogram and its k-bit quantized version,
+      over `num_candidates` x `num_candidates` pairs of bin edges.
+
+    The histogram stays on device and is updated without host syncs. Bin widths are powers of 2
+    and edges are their multiples, so that when inputs fall out of the range, it is widened by
+    merging every 2^k bins, and histograms of different ranks could be merged, both exactly.
+    """
+
+    def __init__(self, bit_width, method="percentile", bins=2048, percentile=0.99, num_candidates=64):
+        assert method in ("percentile", "mse", "kl"), f"unknown histogram calibration method: {method}"
+        self.bit_width = bit_width
+        self.method = method
+        self.bins = bins
+        self.percentile = percentile
+        self.num_candidates = num_candidates
+        self.hist = self.lo = self.exponent = None
+        self.x_min = self.x_max = None  # observed range, grid edges may lie beyond it
+
+    @property
+    def hi(self):
+        return self.lo + self.bins * torch.pow(2., self.exponent)
+
+    def _fit(self, x_min, x_max, exponent=None):
+        # the smallest bin width 2^e (>= 2^exponent) with which `bins` aligned bins cover [x_min, x_max]
+        span = (x_max - x_min).clamp(min=1e-12)
+        e = torch.log2(span / self.bins).ceil_()
+        if exponent is not None:
+            e = torch.max(e, exponent)
+        lo = torch.floor(x_min / torch.pow(2., e)) * torch.pow(2., e)
+        e = e + (lo + self.bins * torch.pow(2., e) < x_max).double()
+        return e, torch.floor(x_min / torch.pow(2., e)) * torch.pow(2., e)
+
+    def rebin_(self, exponent, lo):
+        # old bins are aligned to new ones, thus each of them falls into exactly one new bin
+        scale = torch.pow(2., exponent - self.exponent).long()
+        offset = torch.round((self.lo - lo) / torch.pow(2., self.exponent)).long()
+        index = (offset + torch.arange(self.bins, device=self.hist.device)) // scale
+        self.hist = torch.zeros_like(self.hist).index_add_(0, index.clamp_(0, self.bins - 1), self.hist)
+        self.exponent, self.lo = exponent, lo
+
+    @torch.no_grad()
+    def update(self, x):
+        x = x.detach().reshape(-1)
+        x_min, x_max = _min_max(x)
+        if self.hist is None:
+            self.hist = torch.zeros(self.bins, dtype=torch.float64, device=x.device)
+            self.exponent, self.lo = self._fit(x_min, x_max)
+            self.x_min, self.x_max = x_min, x_max
+        else:
+            # fitted to the observed range rather than to current edges, so that grids only depend on
+            # the range, not on the order of inputs, e.g. of ranks merged by `all_reduce_histograms`
+            self.x_min, self.x_max = torch.min(self.x_min, x_min), torch.max(self.x_max, x_max)
+            self.rebin_(*self._fit(self.x_min, self.x_max, self.exponent))
+        # exact in float64, so that inputs fall into the same bins on any aligned grid
+        index = ((x.double() - self.lo) / torch.pow(2., self.exponent)).floor_().clamp_(0, self.bins - 1).long()
+        self.hist.index_add_(0, index, self.hist.new_ones(1).expand(index.numel()))
+
+    def edges(self):
+        return torch.linspace(0., 1., self.bins + 1, dtype=torch.float64, device=self.hist.device) \
+            * (self.hi - self.lo) + self.lo
+
+    @torch.no_grad()
+    def compute_bounds(self):
+        # edges of the aligned grid may lie beyond the observed range
+        lb, ub = getattr(self, f"_{self.method}_bounds")()
+        return torch.max(lb, self.x_min), torch.min(ub, self.x_max)
+
+    def _quantile(self, q):
+        cdf = self.hist.cumsum(dim=0)
+        target = q * cdf[-1]
+        i = torch.searchsorted(cdf, target.view(1)).clamp_(max=self.bins - 1)
+        prev = torch.where(i > 0, cdf[(i - 1).clamp(min=0)], torch.zeros_like(target))
+        frac = ((target - prev) / self.hist[i].clamp(min=1.)).clamp_(0., 1.)
+        return (self.edges()[i] + frac * (self.hi - self.lo) / self.bins).squeeze(0)
+
+    def _percentile_bounds(self):
+        return self._quantile(1. - self.percentile), self._quantile(self.percentile)
+
+    def _mse_bounds(self):
+        # clipping at edges e_i, e_j, bins are either clipped or rounded with errors of step^2 / 12,
+        # squared clipping errors are expanded by prefix sums of n, n * c, n * c^2 of bin centers c
+        edges = self.edges()
+        centers = (edges[1:] + edges[:-1]) / 2
+        zero = self.hist.new_zeros(1)
+        n, s1, s2 = (torch.cat([zero, t.cumsum(dim=0)]) for t in
+                     (self.hist, self.hist * centers, self.hist * centers.pow(2)))
+        clip_low = edges.pow(2) * n - 2 * edges * s1 + s2
+        clip_high = (s2[-1] - s2) - 2 * edges * (s1[-1] - s1) + edges.pow(2) * (n[-1] - n)
+        step = (edges.view(1, -1) - edges.view(-1, 1)) / (2 ** self.bit_width - 1)
+        err = clip_low.view(-1, 1) + clip_high.view(1, -1) + (n.view(1, -1) - n.view(-1, 1)) * step.pow(2) / 12
+        err.masked_fill_(step <= 0, float("inf"))
+        i, j = divmod(err.argmin().item(), self.bins + 1)
+        return edges[i], edges[j]
+
+    def _kl_bounds(self):
+        levels = 2 ** self.bit_width
+        device = self.hist.device
+        grid = torch.linspace(0, self.bins, self.num_candidates, device=device).round_().long()
+        lower, upper = torch.meshgrid(grid, grid, indexing="ij")
+        # ranges should hold the mode, otherwise ones of a few outlier bins in a tail, with all the
+        # bulk folded into their edge bins, are as good as exact
+        mode = self.hist.argmax()
+        valid = (upper - lower >= min(levels, self.bins)) & (lower <= mode) & (mode < upper)
+        lower, upper = lower[valid], upper[valid]  # (C, ), candidate ranges [lower, upper) of bins
+        bins = torch.arange(self.bins, device=device).view(1, -1)
+        inside = (lower.view(-1, 1) <= bins) & (bins < upper.view(-1, 1))
+
+        # reference: histogram clipped to the range, outliers are added to the edge bins
+        cdf = torch.cat([self.hist.new_zeros(1), self.hist.cumsum(dim=0)])
+        p = self.hist.view(1, -1) * inside
+        p[torch.arange(len(lower), device=device), lower] += cdf[lower]
+        p[torch.arange(len(upper), device=device), upper - 1] += cdf[-1] - cdf[upper]
+
+        # candidate: the histogram within the range (without outliers, as TensorRT does, so that clipped
+        # mass is penalized) merged into k-bit levels, then expanded evenly over nonzero bins of each level
+        sliced = self.hist.view(1, -1) * inside
+        width = (upper - lower).view(-1, 1)
+        level = ((bins - lower.view(-1, 1)) * levels // width).clamp_(0, levels - 1)
+        level = level + torch.arange(len(lower), device=device).view(-1, 1) * levels
+        level_sum = p.new_zeros(len(lower) * levels).index_add_(0, level.flatten(), sliced.flatten())
+        level_nnz = p.new_zeros(len(lower) * levels).index_add_(0, level.flatten(),
+                                                                (sliced > 0).double().flatten())
+        q = torch.where(sliced > 0, level_sum[level] / level_nnz[level].clamp(min=1.), torch.zeros_like(p))
+
+        p = p / p.sum(dim=1, keepdim=True)
+        q = q / q.sum(dim=1, keepdim=True)
+        kl = torch.where(p > 0, p * torch.log(p / q.clamp(min=1e-30)), torch.zeros_like(p)).sum(dim=1)
+        # ranges holding no inputs at all (beyond the observed range) are invalid, rather than NaN
+        kl.masked_fill_(sliced.sum(dim=1) == 0, float("inf"))
+        best = kl.argmin()
+        edges = self.edges()
+        return edges[lower[best]], edges[upper[best]]
+
+
+OBSERVERS = {
+    "minmax": MinMaxObserver,
+    "ema_minmax": EMAMinMaxObserver,
+    "histogram": HistogramObserver,
+}
+
+
+@torch.no_grad()
+def all_reduce_histograms(observers, group=None):
+    """Merges `HistogramObserver`s of all ranks in place, observers should be of the same layers in the
+    same order on every rank. Takes two collectives for all of them, one for the common ranges and one
+    for the counts, after which every rank holds the exact histograms of all ranks' inputs.
+    """
+    if not observers:
+        return
+    ranges = torch.stack([torch.stack([o.exponent, -o.x_min, o.x_max]) for o in observers])
+    dist.all_reduce(ranges, dist.ReduceOp.MAX, group=group)
+    for o, (exponent, neg_x_min, x_max) in zip(observers, ranges):
+        o.x_min, o.x_max = -neg_x_min, x_max
+        o.rebin_(*o._fit(o.x_min, o.x_max, exponent))
+    counts = torch.cat([o.hist for o in observers])
+    dist.all_reduce(counts, dist.ReduceOp.SUM, group=group)
+    for o, hist in zip(observers, counts.split([o.bins for o in observers])):
+        o.hist = hist.clone()
+
+
+@torch.no_grad()
+def search_mse_bounds(x, bit_width, align_zero=False, per_channel=False, num_ratios=32, min_ratio=0.2,
+                      block_numel=2 ** 26):
+    """Bounds `ratio * (min, max)` of `x` (per channel along dim 0 if `per_channel`) with the minimal k-bit
+    quantization MSE, over `num_ratios` clipping ratios in [min_ratio, 1]. All ratios and channels are
+    evaluated at once as a (ratios, channels, numel) tensor, in blocks of ratios of at most `block_numel`.
+    """
+    rows = x.detach().reshape(x.size(0) if per_channel else 1, -1)
+    x_min, x_max = rows.min(dim=1)[0], rows.max(dim=1)[0]
+    ratios = torch.linspace(min_ratio, 1., num_ratios, dtype=x.dtype, device=x.device).view(-1, 1)
+    n = 2 ** bit_width - 1
+    step = max(block_numel // rows.numel(), 1)
+    errors = []
+    for start in range(0, num_ratios, step):
+        lb, ub = ratios[start:start + step] * x_min, ratios[start:start + step] * x_max  # (R, C)
+        delta = ((ub - lb) / n).clamp_(min=1e-8)
+        if align_zero:
+            # same as `AlignZeroSTE`, zero is exactly representable
+            lb = -(-lb / delta).round_().clamp_(0, n) * delta
+            ub = lb + delta * n
+        lb, ub, delta = lb.unsqueeze(-1), ub.unsqueeze(-1), delta.unsqueeze(-1)
+        q = torch.min(torch.max(rows, lb), ub).sub_(lb).div_(delta).round_().mul_(delta).add_(lb)
+        errors.append(q.sub_(rows).pow_(2).sum(dim=-1))
+    best = ratios.view(-1)[torch.cat(errors).argmin(dim=0)]
+    lb, ub = best * x_min, best * x_max
+    return (lb, ub) if per_channel else (lb[0], ub[0])
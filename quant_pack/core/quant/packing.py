@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.autograd import Function
+from torch.nn.grad import conv2d_input, conv2d_weight
+
+__all__ = ["pack_codes", "unpack_codes", "encode", "decode", "PackedInputConv2dFunc", "PackedInputLinearFunc",
+           "PackedWeight"]
+
+
+def container_bits(bit_width):
+    # codes are stored in 1/2/4/8-bit slots so that no code crosses a byte
+    for bits in (1, 2, 4, 8):
+        if bit_width <= bits:
+            return bits
+    raise ValueError(f"can not pack {bit_width}-bit codes into bytes")
+
+
+def pack_codes(codes, bit_width):
+    """Pack uint8 `codes` (each < 2 ** bit_width) into a flat uint8 tensor."""
+    bits = container_bits(bit_width)
+    codes_per_byte = 8 // bits
+    codes = codes.flatten()
+    pad = -codes.numel() % codes_per_byte
+    if pad:
+        codes = torch.cat([codes, codes.new_zeros(pad)])
+    codes = codes.view(-1, codes_per_byte)
+    packed = codes[:, 0].clone()
+    for i in range(1, codes_per_byte):
+        packed |= codes[:, i] << (i * bits)
+    return packed
+
+
+def unpack_codes(packed, bit_width, numel):
+    """Inverse of `pack_codes`, returns the first `numel` codes as a flat uint8 tensor."""
+    bits = container_bits(bit_width)
+    shifts = torch.arange(0, 8, bits, dtype=torch.uint8, device=packed.device)
+    codes = (packed.unsqueeze(1) >> shifts) & ((1 << bits) - 1)
+    return codes.flatten()[:numel]
+
+
+@torch.no_grad()
+def encode(qx, scale, zero_point, offset, bit_width):
+    # `qx` is on the grid of `(i - zero_point) * scale + offset`, i in [0, 2^k - 1]
+    codes = ((qx - offset) / scale + zero_point).round_().clamp_(0, 2 ** bit_width - 1)
+    return pack_codes(codes.to(torch.uint8), bit_width)
+
+
+@torch.no_grad()
+def decode(packed, scale, zero_point, offset, bit_width, shape):
+    codes = unpack_codes(packed, bit_width, shape.numel()).view(shape)
+    return (codes.to(scale.dtype) - zero_point) * scale + offset
+
+
+class PackedInputConv2dFunc(Function):
+    """`F.conv2d` on a quantized input, which is saved for backward as packed k-bit codes."""
+
+    @staticmethod
+    def forward(ctx, input, weight, bias, stride, padding, dilation, groups, scale, zero_point, offset, bit_width):
+        output = F.conv2d(input, weight, bias, stride, padding, dilation, groups)
+        ctx.save_for_backward(encode(input, scale, zero_point, offset, bit_width), weight, scale, zero_point, offset)
+        ctx.cfg = (input.shape, stride, padding, dilation, groups, bit_width, bias is not None)
+        return output
+
+    @staticmethod
+    def backward(ctx, dy):
+        packed, weight, scale, zero_point, offset = ctx.saved_tensors
+        input_shape, stride, padding, dilation, groups, bit_width, has_bias = ctx.cfg
+        d_input = d_weight = d_bias = None
+        if ctx.needs_input_grad[0]:
+            d_input = conv2d_input(input_shape, weight, dy, stride, padding, dilation, groups)
+        if ctx.needs_input_grad[1]:
+            input = decode(packed, scale, zero_point, offset, bit_width, input_shape).to(dy.dtype)
+            d_weight = conv2d_weight(input, weight.shape, dy, stride, padding, dilation, groups)
+        if has_bias and ctx.needs_input_grad[2]:
+            d_bias = dy.sum(dim=(0, 2, 3))
+        return d_input, d_weight, d_bias, None, None, None, None, None, None, None, None
+
+
+class PackedInputLinearFunc(Function):
+    """`F.linear` on a quantized input, which is saved for backward as packed k-bit codes."""
+
+    @staticmethod
+    def forward(ctx, input, weight, bias, scale, zero_point, offset, bit_width):
+        output = F.linear(input, weight, bias)
+        ctx.save_for_backward(encode(input, scale, zero_point, offset, bit_width), weight, scale, zero_point, offset)
+        ctx.cfg = (input.shape, bit_width, bias is not None)
+        return output
+
+    @staticmethod
+    def backward(ctx, dy):
+        packed, weight, scale, zero_point, offset = ctx.saved_tensors
+        input_shape, bit_width, has_bias = ctx.cfg
+        d_input = d_weight = d_bias = None
+        if ctx.needs_input_grad[0]:
+            d_input = dy.matmul(weight)
+        if ctx.needs_input_grad[1]:
+            input = decode(packed, scale, zero_point, offset, bit_width, input_shape).to(dy.dtype)
+            d_weight = dy.reshape(-1, dy.size(-1)).t().mm(input.reshape(-1, input.size(-1)))
+        if has_bias and ctx.needs_input_grad[2]:
+            d_bias = dy.reshape(-1, dy.size(-1)).sum(dim=0)
+        return d_input, d_weight, d_bias, None, None, None, None
+
+
+class PackedWeight(nn.Module):
+    """k-bit weight codes packed into bytes row by row (a row per output channel), so that blocks
+    of output channels could be unpacked separately. Weights are `(code - zero_point) * scale + offset`,
+    where `scale`, `zero_point` and `offset` are scalars (per-tensor) or of size C_out (per-channel).
+    """
+
+    def __init__(self, weight, scale, zero_point, offset, bit_width):
+        super(PackedWeight, self).__init__()
+        self.shape = weight.shape
+        self.bit_width = bit_width
+        self.row_numel = weight[0].numel()
+        self.codes_per_byte = 8 // container_bits(bit_width)
+        bytes_per_row = -(-self.row_numel // self.codes_per_byte)
+        scale, zero_point, offset = (torch.as_tensor(t, dtype=torch.float32, device=weight.device)
+                                     for t in (scale, zero_point, offset))
+        with torch.no_grad():
+            rows = weight.detach().reshape(self.shape[0], -1).float()
+            codes = (rows - self._per_row(offset)) / self._per_row(scale) + self._per_row(zero_point)
+            # rows with zero scales (e.g. BN with zero gamma folded in) could take any code
+            codes = codes.nan_to_num_(0.).round_().clamp_(0, 2 ** bit_width - 1).to(torch.uint8)
+            pad = bytes_per_row * self.codes_per_byte - self.row_numel
+            if pad:
+                codes = F.pad(codes, (0, pad))
+            self.register_buffer("codes", pack_codes(codes, bit_width).view(self.shape[0], -1))
+        self.register_buffer("scale", scale)
+        self.register_buffer("zero_point", zero_point)
+        self.register_buffer("offset", offset)
+
+    @staticmethod
+    def _per_row(t):
+        return t.view(-1, 1) if t.dim() > 0 else t
+
+    def _row_param(self, t, start, end):
+        return t[start:end].view(-1, 1) if t.dim() > 0 else t
+
+    def unpack(self, start=0, end=None):
+        """Float weights of output channels in [start, end)."""
+        end = self.shape[0] if end is None else end
+        packed = self.codes[start:end]
+        codes = unpack_codes(packed.flatten(), self.bit_width, packed.numel() * self.codes_per_byte)
+        codes = codes.view(end - start, -1)[:, :self.row_numel].float()
+        weight = (codes - self._row_param(self.zero_point, start, end)) * self._row_param(self.scale, start, end) \
+            + self._row_param(self.offset, start, end)
+        return weight.view((end - start, ) + tuple(self.shape[1:]))
+
+    def extra_repr(self):
+        return f"shape={tuple(self.shape)}, bit_width={self.bit_width}, per_channel={self.scale.dim() > 0}"
@@ -207,3 +207,32 @@ class HijackModuleOutput(Hook):
     def after_train_iter(self, runner):
         if self.hook_name in runner.model.runtime_hooks:
             runner.model.runtime_hooks.pop(self.hook_name)
+
+
+class ValidateQuantBounds(Hook):
+
+    def __init__(self, interval=100):
+        # pairs with `sync_free` quant configs, which skip per-layer checks
+        self.interval = interval
+
+    def after_train_iter(self, runner):
+        if self.every_n_iters(runner, self.interval):
+            runner.model.validate_quant_bounds()
+
+
+class ReestimateBNStats(Hook):
+
+    def __init__(self, quant_mode="quant", num_batches=50, interval=1):
+        # refreshes BN statistics of `quant_mode` before validation, see `reestimate_bn_stats`
+        self.quant_mode = quant_mode
+        self.num_batches = num_batches
+        self.interval = interval
+
+    def after_train_epoch(self, runner):
+        if self.every_n_epochs(runner, self.interval):
+            device = torch.device(f"cuda:{torch.cuda.current_device()}")
+            # training data is still loaded after the epoch, unless a calibration subset is available
+            calibration_store = getattr(runner, "calibration_store", None)
+            data = calibration_store.batches(device) if calibration_store is not None else runner.data_loader
+            num_batches = runner.model.reestimate_bn_stats(data, device, self.quant_mode, self.num_batches)
+            runner.logger.info(f"BN statistics of {self.quant_mode} re-estimated with {num_batches} batches")
@@ -5,16 +5,33 @@ import torch.nn as nn
 import quant_pack.core.fuse.functional as fused_f
 import quant_pack.core.quant.functional as quant_f
 
-__all__ = ["FUSED_FORWARD_FUNCTIONS", "QUANT_FORWARD_FUNCTIONS"]
+__all__ = ["FUSED_FORWARD_FUNCTIONS", "QUANT_FORWARD_FUNCTIONS", "PACKED_FORWARD_FUNCTIONS",
+           "BINARY_FORWARD_FUNCTIONS", "SPARSE_FORWARD_FUNCTIONS"]
 
 FUSED_FORWARD_FUNCTIONS = {
     nn.Conv2d: fused_f.fused_conv_bn_forward,
+    nn.Linear: fused_f.fused_fc_bn_forward,
+    nn.BatchNorm1d: fused_f.fused_bn_forward,
     nn.BatchNorm2d: fused_f.fused_bn_forward,
     nn.SyncBatchNorm: fused_f.fused_bn_forward,
-    nn.Linear: fused_f.fused_conv_bn_forward,
 }
 
 QUANT_FORWARD_FUNCTIONS = {
     nn.Conv2d: quant_f.quant_conv2d_forward,
     nn.Linear: quant_f.quant_linear_forward,
 }
+
+PACKED_FORWARD_FUNCTIONS = {
+    nn.Conv2d: quant_f.packed_conv2d_forward,
+    nn.Linear: quant_f.packed_linear_forward,
+}
+
+BINARY_FORWARD_FUNCTIONS = {
+    nn.Conv2d: quant_f.binary_conv2d_forward,
+    nn.Linear: quant_f.binary_linear_forward,
+}
+
+SPARSE_FORWARD_FUNCTIONS = {
+    nn.Conv2d: quant_f.sparse_conv2d_forward,
+    nn.Linear: quant_f.sparse_linear_forward,
+}
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
 from .runtime_hook import RuntimeHook, WithPostprocessRuntimeHook
+from .activation_store import ActivationStore
 
-__all__ = ["RuntimeHook", "WithPostprocessRuntimeHook"]
+__all__ = ["RuntimeHook", "WithPostprocessRuntimeHook", "ActivationStore"]
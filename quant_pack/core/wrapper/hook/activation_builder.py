@@ -1,12 +1,17 @@
 # -*- coding: utf-8 -*-
 
+import os
 import re
 from collections import OrderedDict
+from functools import partial
 
 import torch
 import torch.nn as nn
+import torch.distributed as dist
 
 from .base_builder import HookBuilder
+from .offload import AsyncOffloader
+from .activation_store import ActivationStore
 from quant_pack.core.quant.config import QuantMode
 
 
@@ -17,12 +22,26 @@ def copy_to_cpu(x):
 
 class SaveActivationBuilder(HookBuilder):
 
-    def __init__(self, hook_reg, enable_reg, target_cls, inject_at_mode, var_names):
+    def __init__(self, hook_reg, enable_reg, target_cls, inject_at_mode, var_names, async_offload=False,
+                 offload_slots=8, offload_slot_mb=64, store_dir=None, store_chunk_mb=64):
+        """With `async_offload`, captured CUDA tensors are copied to CPU in background through
+        `offload_slots` pinned buffers of `offload_slot_mb` MB, see `AsyncOffloader`, and land in
+        `hook_reg` after `flush()`.
+
+        With `store_dir`, captured tensors are appended to an `ActivationStore` there across iterations,
+        under layer names (`{layer name}/{var name}` for `SaveAllValueBuilder`). Rows of each iteration
+        are read back into `hook_reg` (if given) at `flush()`, for post-processes reading it.
+        """
         super(SaveActivationBuilder, self).__init__(("forward_pre", "forward"), hook_reg, enable_reg)
         self.target_cls = re.compile(target_cls)
         self.inject_at_mode = QuantMode.get(inject_at_mode)
         self.var_names = var_names
         self.name_reg = {}
+        self.offloader = AsyncOffloader(offload_slots, offload_slot_mb * 2 ** 20) if async_offload else None
+        if store_dir is not None and dist.is_available() and dist.is_initialized():
+            store_dir = os.path.join(store_dir, f"rank{dist.get_rank()}")
+        self.store = ActivationStore(store_dir, chunk_mb=store_chunk_mb) if store_dir is not None else None
+        self._stored = OrderedDict()  # store key -> (reg, key) of captures at the current iteration
 
     def match(self, name, module):
         if self.target_cls.match(module.__class__.__name__):
@@ -38,31 +57,58 @@ class SaveActivationBuilder(HookBuilder):
         module.gather_data = self.var_names
         module.gather_buffer = OrderedDict()
 
+    def _save(self, reg, key, x, store_key):
+        if self.store is not None:
+            save = partial(self.store.append, store_key)
+            self._stored[store_key] = (reg, key)
+        else:
+            save = partial(reg.__setitem__, key)
+        if self.offloader is not None:
+            self.offloader.copy(x, save)
+        else:
+            save(copy_to_cpu(x))
+
+    def flush(self):
+        if self.offloader is not None:
+            self.offloader.flush()
+        if self.store is not None:
+            self.store.flush()
+            self._read_back()
+
+    def _read_back(self):
+        iteration = self.store.iteration
+        self.store.end_iteration()
+        for store_key, (reg, key) in self._stored.items():
+            if reg is not None:
+                rows = self.store[store_key]
+                reg[key] = torch.from_numpy(rows[rows.iteration_rows(iteration)])
+        self._stored.clear()
+
     def _runtime_forward_hook(self, module, input, output):
-        output = copy_to_cpu(output)
         name = self.name_reg[id(module)]
-        self._reg[name] = output
+        self._save(self._reg, name, output, name)
 
 
 class SaveAllValueBuilder(SaveActivationBuilder):
 
     def _runtime_forward_hook(self, module, input, output):
         name = self.name_reg[id(module)]
-        self._reg[name] = {
+        values = {
             "type": module.__class__.__name__,
             "input_qconf": module.input_qconf.params,
             "weight_qconf": module.weight_qconf.params,
         }
         if isinstance(module, nn.Conv2d):
-            self._reg[name]["param"] = {
+            values["param"] = {
                 "kernel_size": module.kernel_size,
                 "dilation": module.dilation,
                 "padding": module.padding,
                 "stride": module.stride,
             }
+        if self._reg is not None:
+            self._reg[name] = values
         for k, v in module.gather_buffer.items():
-            v = copy_to_cpu(v)
-            self._reg[name][k] = v
+            self._save(values, k, v, f"{name}/{k}")
         module.gather_buffer.clear()
         module.gather_data = False
 
@@ -35,42 +35,48 @@ def relative_error(x, x_ref, eps=1e-6):
     return torch.where(x_ref.abs() > eps, x_error, torch.zeros_like(x_ref))
 
 
+def _concat_mean_std(input_sum, input_sq_sum, weight_sum, weight_sq_sum, n):
+    # mean / std of rows concatenated from input and weight rows of `n` entries in total,
+    # from per-row sums and sums of squares, accumulated in float64 against cancellation
+    row_sum = input_sum + weight_sum
+    mean = row_sum / n
+    var = (input_sq_sum + weight_sq_sum - row_sum * mean) / (n - 1)
+    return mean, var.clamp_(min=0.).sqrt_()
+
+
 def conv2d_input_weight_analysis(input_err, weight_err, kernel_size,
                                  dilation=1, padding=0, stride=1):
     # unfold / img2col input -> (N, num_receptive, num_output_spatial_size)
     # unfold weight -> (num_kernels, num_receptive)
-    # the output shape is (N, num_kernels, num_output_spatial_size)
-    # so we concatenate the `num_receptive` dimension and do mean/std analysis
-    ie_unfold = F.unfold(input_err, kernel_size, dilation, padding, stride)
+    # the output shape is (N, num_kernels, num_output_spatial_size), whose entries are mean/std of
+    # the concatenated input and weight rows of `num_receptive` each, computed without expanding
+    # them to (N, num_kernels, num_output_spatial_size, num_receptive)
+    ie_unfold = F.unfold(input_err, kernel_size, dilation, padding, stride).double()
     batch_size, num_receptive, num_output_spatial = ie_unfold.shape
     num_channels = weight_err.size(0)
-    we_unfold = weight_err.reshape(num_channels, -1)
+    we_unfold = weight_err.reshape(num_channels, -1).double()
     assert we_unfold.size(1) == num_receptive
 
-    target_shape = (batch_size, num_channels, num_output_spatial, num_receptive)
-    ie_unfold = ie_unfold.permute(0, 2, 1) \
-        .reshape(batch_size, 1, num_output_spatial, num_receptive) \
-        .expand(*target_shape).contiguous()
-    we_unfold = we_unfold.reshape(1, num_channels, 1, num_receptive) \
-        .expand(*target_shape).contiguous()
-    error_unfold = torch.cat([ie_unfold, we_unfold], dim=-1)
-    error_mean = torch.mean(error_unfold, dim=-1)
-    error_std = torch.std(error_unfold, dim=-1)
-    return error_mean, error_std
+    input_sum = ie_unfold.sum(dim=1).unsqueeze(1)
+    input_sq_sum = ie_unfold.pow_(2).sum(dim=1).unsqueeze(1)
+    weight_sum = we_unfold.sum(dim=1).view(1, num_channels, 1)
+    weight_sq_sum = we_unfold.pow(2).sum(dim=1).view(1, num_channels, 1)
+    error_mean, error_std = _concat_mean_std(input_sum, input_sq_sum, weight_sum, weight_sq_sum,
+                                             2 * num_receptive)
+    return error_mean.to(input_err.dtype), error_std.to(input_err.dtype)
 
 
 def fc_input_weight_analysis(input_err, weight_err):
     batch_size, in_channels = input_err.shape
     out_channels, in_channels = weight_err.shape
-    target_shape = (batch_size, out_channels, in_channels)
-    input_err = input_err.reshape(batch_size, 1, in_channels) \
-        .expand(*target_shape)
-    weight_err = weight_err.reshape(1, out_channels, in_channels) \
-        .expand(*target_shape)
-    error_unfold = torch.cat([input_err, weight_err], dim=-1)
-    error_mean = torch.mean(error_unfold, dim=-1)
-    error_std = torch.std(error_unfold, dim=-1)
-    return error_mean, error_std
+    dtype = input_err.dtype
+    input_err, weight_err = input_err.double(), weight_err.double()
+    error_mean, error_std = _concat_mean_std(input_err.sum(dim=1, keepdim=True),
+                                             input_err.pow(2).sum(dim=1, keepdim=True),
+                                             weight_err.sum(dim=1).view(1, out_channels),
+                                             weight_err.pow(2).sum(dim=1).view(1, out_channels),
+                                             2 * in_channels)
+    return error_mean.to(dtype), error_std.to(dtype)
 
 
 def unpack_indices(indices):
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import re
+import threading
+
+import numpy as np
+import torch
+
+__all__ = ["ActivationStore"]
+
+INDEX_FILE = "index.json"
+
+
+class _LayerView:
+    """Rows of one key across all its chunks, read lazily from memory-mapped chunk files."""
+
+    def __init__(self, store, key):
+        self.store = store
+        self.key = key
+        entry = store.index[key]
+        self.shape = tuple(entry["shape"])
+        self.dtype = np.dtype(entry["dtype"])
+        self.offsets = np.cumsum([0] + entry["chunks"])
+        self.iterations = [tuple(i) for i in entry["iterations"]]  # (iteration, rows) of appends
+
+    def iteration_rows(self, iteration):
+        """Range of rows appended at `iteration`, as a slice."""
+        start = 0
+        for i, rows in self.iterations:
+            if i == iteration:
+                return slice(start, start + rows)
+            start += rows
+        raise KeyError(f"nothing appended to `{self.key}` at iteration {iteration}")
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            rows = np.arange(len(self))[item]
+        else:
+            rows = np.asarray(item)
+            if rows.ndim == 0:
+                return self[rows.reshape(1)][0]
+            rows = np.where(rows < 0, rows + len(self), rows)
+        out = np.empty((len(rows), ) + self.shape, dtype=self.dtype)
+        chunk_ids = np.searchsorted(self.offsets, rows, side="right") - 1
+        for c in np.unique(chunk_ids):
+            selected = chunk_ids == c
+            out[selected] = self.store._chunk(self.key, c)[rows[selected] - self.offsets[c]]
+        return out
+
+
+class ActivationStore:
+    """Append-only on-disk store of captured tensors under `root`, e.g. to dump activations of many
+    diagnosis iterations. Rows (along dim 0) appended to each key are buffered up to `chunk_mb` MB,
+    then written as one .npy chunk; `index.json` records dtype, row shape and chunk sizes of all keys.
+
+    Appends are counted in iterations, advanced by `end_iteration()`; the index also records rows of
+    each key appended at each iteration, see `store[key].iteration_rows(i)`.
+
+    Chunks are memory-mapped when read, `store[key][rows]` loads only chunks holding `rows`, either
+    while writing (with rows flushed by `flush()`) or offline by `ActivationStore(root, mode="r")`.
+    """
+
+    def __init__(self, root, mode="a", chunk_mb=64):
+        assert mode in ("a", "r"), f"unknown mode: {mode}"
+        self.root = root
+        self.mode = mode
+        self.chunk_bytes = chunk_mb * 2 ** 20
+        self.index = {}
+        self.iteration = 0
+        self._appended = False  # anything appended at the current iteration
+        self._buffers = {}  # key -> (list of arrays, number of bytes)
+        self._chunks = {}  # (key, chunk id) -> memory-mapped array
+        self._lock = threading.Lock()
+        index_file = os.path.join(root, INDEX_FILE)
+        if os.path.exists(index_file):
+            with open(index_file, "r") as f:
+                self.index = json.load(f)
+            # appending to an existing store continues after its last iteration
+            self.iteration = max((i for e in self.index.values() for i, _ in e["iterations"]), default=-1) + 1
+        else:
+            assert mode == "a", f"no activation store at {root}"
+            os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def _dir_name(key):
+        return re.sub(r"[^\w.-]", "_", key)
+
+    def _chunk_file(self, key, chunk_id):
+        return os.path.join(self.root, self.index[key]["dir"], f"{chunk_id:06d}.npy")
+
+    def append(self, key, x):
+        """Appends rows of `x` (a tensor or array of shape (N, ...)) to `key`."""
+        assert self.mode == "a", "activation store is opened read-only"
+        if torch.is_tensor(x):
+            x = x.detach().cpu().numpy()
+        x = np.ascontiguousarray(x)
+        if x.ndim == 0:
+            x = x.reshape(1)
+        with self._lock:
+            entry = self.index.get(key)
+            if entry is None:
+                entry = self.index[key] = dict(dir=self._dir_name(key), dtype=x.dtype.str, shape=x.shape[1:],
+                                               chunks=[], iterations=[])
+                os.makedirs(os.path.join(self.root, entry["dir"]), exist_ok=True)
+            assert tuple(entry["shape"]) == x.shape[1:] and entry["dtype"] == x.dtype.str, \
+                f"can not append {x.dtype.str} rows of {x.shape[1:]} to `{key}` of {entry['dtype']} " \
+                f"rows of {tuple(entry['shape'])}"
+            iterations = entry["iterations"]
+            if iterations and iterations[-1][0] == self.iteration:
+                iterations[-1][1] += len(x)
+            else:
+                iterations.append([self.iteration, len(x)])
+            self._appended = True
+            arrays, nbytes = self._buffers.get(key, ([], 0))
+            arrays.append(x)
+            nbytes += x.nbytes
+            self._buffers[key] = (arrays, nbytes)
+            if nbytes >= self.chunk_bytes:
+                self._write_chunk(key)
+
+    def _write_chunk(self, key):
+        arrays, _ = self._buffers.pop(key, ([], 0))
+        if not arrays:
+            return
+        entry = self.index[key]
+        chunk = np.concatenate(arrays)
+        np.save(self._chunk_file(key, len(entry["chunks"])), chunk)
+        entry["chunks"].append(len(chunk))
+
+    def end_iteration(self):
+        """Later appends belong to the next iteration, if anything is appended at the current one."""
+        with self._lock:
+            if self._appended:
+                self.iteration += 1
+                self._appended = False
+
+    def flush(self):
+        """Writes buffered rows of all keys as chunks, then the index."""
+        if self.mode != "a":
+            return
+        with self._lock:
+            for key in list(self._buffers):
+                self._write_chunk(key)
+            index_file = os.path.join(self.root, INDEX_FILE)
+            with open(f"{index_file}.tmp", "w") as f:
+                json.dump(self.index, f)
+            os.replace(f"{index_file}.tmp", index_file)
+
+    def _chunk(self, key, chunk_id):
+        chunk = self._chunks.get((key, chunk_id))
+        if chunk is None:
+            chunk = self._chunks[(key, chunk_id)] = np.load(self._chunk_file(key, chunk_id), mmap_mode="r")
+        return chunk
+
+    def keys(self):
+        return list(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __getitem__(self, key):
+        return _LayerView(self, key)
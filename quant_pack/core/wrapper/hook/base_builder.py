@@ -46,6 +46,10 @@ class HookBuilder:
         if self.enabled:
             return self._runtime_tensor_hook(tensor_grad)
 
+    def flush(self):
+        # waits for captures still in flight, called before `hook_reg` is read
+        pass
+
     def match(self, *args, **kwargs):
         raise NotImplementedError()
 
@@ -1,17 +1,34 @@
 # -*- coding: utf-8 -*-
 
+from collections import OrderedDict
+
 import torch
 import torch.distributed as dist
 
 from quant_pack.core.quant.config import QuantMode
+from quant_pack.core.quant.observer import OBSERVERS, HistogramObserver, all_reduce_histograms
 from .base_builder import HookBuilder
 
 
 class ActivationCalibrationBuilder(HookBuilder):
+    """Accumulates inputs of each quantized layer in an observer across calibration batches,
+    `update_bounds()` then searches `a_lb` / `a_ub` once from the observers.
+
+    Args:
+        observer (str): "minmax", "ema_minmax" or "histogram", see `quant_pack.core.quant.observer`
+        merge_histograms (bool): in distributed runs, merge histograms of all ranks before searching
+            bounds, instead of averaging bounds searched on each rank
+        observer_args: passed to the observer, e.g. `method` and `percentile` of "histogram"
+    """
 
-    def __init__(self, hook_reg, enable_reg, percentile=0.99):
+    def __init__(self, hook_reg, enable_reg, observer="histogram", merge_histograms=False, **observer_args):
         super(ActivationCalibrationBuilder, self).__init__("forward", hook_reg, enable_reg)
-        self.percentile = percentile
+        self.observer_cls = OBSERVERS[observer]
+        assert not merge_histograms or issubclass(self.observer_cls, HistogramObserver), \
+            f"`merge_histograms` requires histogram observers, got {observer}"
+        self.merge_histograms = merge_histograms
+        self.observer_args = observer_args
+        self.observers = OrderedDict()
 
     def match(self, name, module):
         return hasattr(module, "input_qconf")
@@ -22,15 +39,25 @@ class ActivationCalibrationBuilder(HookBuilder):
     def _runtime_forward_hook(self, module, input, output):
         if isinstance(input, tuple):
             input = input[0]
-        input, _ = input.reshape(-1).sort()
-        n = input.numel()
-        k = int(n * self.percentile)
-        if dist.is_available() and dist.is_initialized():
-            bounds = torch.tensor([input[k], input[n - k]], device=input.device).div_(dist.get_world_size())
+        observer = self.observers.get(module)
+        if observer is None:
+            observer = self.observer_cls(module.input_qconf.bit_width, **self.observer_args)
+            self.observers[module] = observer
+        observer.update(input)
+
+    @torch.no_grad()
+    def update_bounds(self):
+        if not self.observers:
+            return
+        distributed = dist.is_available() and dist.is_initialized()
+        if distributed and self.merge_histograms:
+            all_reduce_histograms(list(self.observers.values()))
+        bounds = torch.stack([torch.stack(observer.compute_bounds()) for observer in self.observers.values()])
+        if distributed and not self.merge_histograms:
+            # bounds of all layers are averaged over ranks at once
+            bounds.div_(dist.get_world_size())
             dist.all_reduce(bounds, dist.ReduceOp.SUM)
-            ub, lb = bounds
-        else:
-            ub, lb = input[k], input[n - k]
-        assert lb < ub, f"invalid calibration bounds: lb={lb.item():.5f}, ub={ub.item():.5f}"
-        module.a_lb.copy_(lb)
-        module.a_ub.copy_(ub)
+        for module, (lb, ub) in zip(self.observers, bounds):
+            assert lb < ub, f"invalid calibration bounds: lb={lb.item():.5f}, ub={ub.item():.5f}"
+            module.a_lb.copy_(lb)
+            module.a_ub.copy_(ub)
@@ -22,16 +22,12 @@ class ManualBiasCorrectionBuilder(HookBuilder):
         if self.target_conf == "input":
             assert hasattr(module, "input_qconf")
             module.input_qconf._manual_bias = self.relevant_bias
-            module.input_transform = module.input_qconf.transform
         elif self.target_conf == "weight":
             assert hasattr(module, "weight_qconf")
             module.weight_qconf._manual_bias = self.relevant_bias
-            module.weight_transform = module.weight_qconf.transform
 
     def _runtime_forward_hook(self, module, input, output):
         if hasattr(module, "input_qconf"):
             module.input_qconf._manual_bias = None
-        module.input_transform = module.input_qconf.transform
         if hasattr(module, "weight_qconf"):
             module.weight_qconf._manual_bias = None
-            module.weight_transform = module.weight_qconf.transform
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+import queue
+import threading
+
+import torch
+
+__all__ = ["AsyncOffloader"]
+
+
+class AsyncOffloader:
+    """Copies CUDA tensors to CPU without blocking forward: each tensor is copied on a side stream into
+    one of `num_slots` preallocated pinned staging buffers of `slot_bytes`, and a background thread
+    waits for the copy, moves it out of the slot and hands the CPU tensor to a callback. Tensors larger
+    than a slot are copied in pieces through multiple slots. Captures wait for free slots when the
+    thread falls behind, i.e. at most `num_slots` pieces are in flight.
+
+    CPU tensors are copied synchronously, unless `offload_cpu` (e.g. to test the asynchronous path
+    without CUDA). `flush()` returns once all callbacks of previous captures are done, and re-raises
+    the first exception raised by them since the last `flush()`.
+    """
+
+    def __init__(self, num_slots=8, slot_bytes=64 * 2 ** 20, offload_cpu=False):
+        self.num_slots = num_slots
+        self.slot_bytes = slot_bytes
+        self.offload_cpu = offload_cpu
+        self._slots = None  # allocated at the first asynchronous capture
+        self._free = queue.Queue()
+        self._pending = queue.Queue(maxsize=num_slots)
+        self._stream = None
+        self._thread = None
+        self._error = None
+
+    def _lazy_init(self, device):
+        is_cuda = device.type == "cuda"
+        if is_cuda:
+            self._stream = torch.cuda.Stream(device)
+        self._slots = [torch.empty(self.slot_bytes, dtype=torch.uint8, pin_memory=is_cuda)
+                       for _ in range(self.num_slots)]
+        for slot in self._slots:
+            self._free.put(slot)
+        self._thread = threading.Thread(target=self._drain, daemon=True)
+        self._thread.start()
+
+    def _drain(self):
+        while True:
+            event, staging, slot, out, result, callback = self._pending.get()
+            try:
+                if event is not None:
+                    event.synchronize()
+                out.copy_(staging)
+                # the last piece of a tensor carries its callback
+                if callback is not None:
+                    callback(result)
+            except Exception as e:
+                # keeps draining, otherwise `copy()` and `flush()` would wait forever
+                if self._error is None:
+                    self._error = e
+            finally:
+                self._free.put(slot)
+                self._pending.task_done()
+
+    def copy(self, x, callback):
+        x = x.detach()
+        if (not x.is_cuda and not self.offload_cpu) or x.numel() == 0:
+            callback(x.to("cpu").clone())
+            return
+        if self._thread is None:
+            self._lazy_init(x.device)
+
+        result = torch.empty(x.shape, dtype=x.dtype)
+        src, out = x.reshape(-1), result.view(-1)
+        piece = max(self.slot_bytes // x.element_size(), 1)
+        if self._stream is not None:
+            self._stream.wait_stream(torch.cuda.current_stream(x.device))
+        for start in range(0, src.numel(), piece):
+            src_piece = src[start:start + piece]
+            slot = self._free.get()  # back-pressure
+            staging = slot[:src_piece.numel() * x.element_size()].view(x.dtype)
+            if self._stream is not None:
+                with torch.cuda.stream(self._stream):
+                    staging.copy_(src_piece, non_blocking=True)
+                    event = torch.cuda.Event()
+                    event.record(self._stream)
+            else:
+                staging.copy_(src_piece)
+                event = None
+            last = start + piece >= src.numel()
+            self._pending.put((event, staging, slot, out[start:start + piece], result if last else None,
+                               callback if last else None))
+        if self._stream is not None:
+            # `x` may be freed by forward meanwhile, keep its memory until the copies are done
+            src.record_stream(self._stream)
+
+    def flush(self):
+        if self._thread is not None:
+            self._pending.join()
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
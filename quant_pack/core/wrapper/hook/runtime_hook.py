@@ -30,6 +30,10 @@ POST_PROCESS = {
 
 
 class RuntimeHook(Hook):
+    """Builders' hooks are attached to matched modules only at iterations of every `intervals`, and
+    detached after them, thus other iterations run without any per-layer hook. Under DDP, hooks are
+    injected into each forward by the wrapper, with builders returned by `update_hooks`.
+    """
 
     def __init__(self, intervals, hook_builders):
         self.intervals = intervals
@@ -39,6 +43,8 @@ class RuntimeHook(Hook):
         self.named_handles = OrderedDict()
         self.is_ddp = False
         self.enabled_at_this_iter = False
+        self._lazy_targets = []  # (builder name, handle name, module, register method, hook) of builders given at init
+        self._lazy_handles = []
 
         for builder_cfg in hook_builders:
             self.add_builder(builder_cfg)
@@ -49,21 +55,45 @@ class RuntimeHook(Hook):
             self.is_ddp = True
         else:
             self.is_ddp = False
+            # matched once, attached at enabled iterations only
+            self._lazy_targets = []
             for n, m in module.named_modules():
                 for builder_name, builder in self.named_builders.items():
                     if builder.match(n, m):
                         for register_method, hook in builder.get_hooks():
-                            handle = getattr(m, register_method)(hook)
-                            self.named_handles[f"{builder_name}_{register_method}_{n}"] = handle
+                            self._lazy_targets.append((builder_name, f"{builder_name}_{register_method}_{n}", m,
+                                                       register_method, hook))
+
+    def _attach(self):
+        for _, name, m, register_method, hook in self._lazy_targets:
+            handle = getattr(m, register_method)(hook)
+            self.named_handles[name] = handle
+            self._lazy_handles.append(name)
+
+    def _detach(self):
+        for name in self._lazy_handles:
+            handle = self.named_handles.pop(name, None)
+            if handle is not None:
+                handle.remove()
+        self._lazy_handles = []
 
     def before_iter(self, runner):
         if self.every_n_inner_iters(runner, self.intervals):
             self.enabled_at_this_iter = True
+            self._attach()
         else:
             self.enabled_at_this_iter = False
             for k in self.enable_reg.keys():
                 self.enable_reg[k] = False
 
+    def flush(self):
+        for builder in self.named_builders.values():
+            builder.flush()
+
+    def after_iter(self, runner):
+        self.flush()
+        self._detach()
+
     def update_hooks(self, quant_mode, force=False):
         activated_builders = []
         if self.enabled_at_this_iter or force:
@@ -102,11 +132,13 @@ class RuntimeHook(Hook):
     def remove_builder(self, builder_name):
         handles = []
         for k, h in self.named_handles.items():
-            if k.startswith(builder_name):
+            # handles are named `{builder name}_{register method}_{module name}`
+            if k.startswith(f"{builder_name}_register_"):
                 handles.append((k, h))
         for k, h in handles:
             h.remove()
             self.named_handles.pop(k)
+        self._lazy_targets = [t for t in self._lazy_targets if t[0] != builder_name]
         if builder_name in self.named_builders:
             builder = self.named_builders.pop(builder_name)
             self.enable_reg.pop(id(builder))
@@ -130,6 +162,7 @@ class WithPostprocessRuntimeHook(RuntimeHook):
 
     def after_iter(self, runner):
         if self.enabled_at_this_iter:
+            self.flush()
             plot_buffer = OrderedDict()
             plot_method = OrderedDict()
             for name, process in self.post_process.items():
@@ -140,3 +173,4 @@ class WithPostprocessRuntimeHook(RuntimeHook):
                 reg.clear()
             runner.log_buffer.output["plot_buffer"] = plot_buffer
             runner.log_buffer.output["plot_method"] = plot_method
+        super(WithPostprocessRuntimeHook, self).after_iter(runner)
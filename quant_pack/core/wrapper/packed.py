@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+from types import MethodType
+
+import torch
+import torch.nn as nn
+
+from quant_pack.core.fuse.functional import _fold_bn
+from quant_pack.core.quant.packing import PackedWeight
+from quant_pack.core.quant.binary import BinaryWeight
+from ._registries import PACKED_FORWARD_FUNCTIONS, BINARY_FORWARD_FUNCTIONS
+
+__all__ = ["convert_to_packed"]
+
+
+def _fold_output_bn(m, weight, bias):
+    # BN folded after weight quantization, returns scaled weight and bias, and per-channel BN scales
+    std = torch.sqrt(m.running_var + m.bn_eps)
+    bn_scale = m.alpha / std if m.affine else std.reciprocal()
+    weight = weight * bn_scale.view((-1, ) + (1, ) * (weight.dim() - 1))
+    bias = (0. if bias is None else bias) - m.running_mean
+    bias = bias * bn_scale + (m.beta if m.affine else 0.)
+    return weight, bias, bn_scale
+
+
+def _quantized_weight(m, fused):
+    # quantized weight and bias of `m` with BN folded in, as evaluated in the QW mode
+    weight, bias = m.weight, m.bias
+    if fused and m.fold_bn:
+        return _fold_bn(m, weight, bias, m.alpha, m.beta, m.running_mean, m.running_var)
+    weight = m.weight_qconf.transform(weight)
+    if fused:
+        weight, bias, _ = _fold_output_bn(m, weight, bias)
+    return weight, bias
+
+
+@torch.no_grad()
+def _pack_weight(m, fused):
+    grid = m.weight_qconf.grid_params()
+    if m.weight_qconf.retain_fp or grid is None:
+        return False
+    scale, zero_point, offset = grid
+    weight, bias = m.weight, m.bias
+    if fused and m.fold_bn:
+        weight, bias = _fold_bn(m, weight, bias, m.alpha, m.beta, m.running_mean, m.running_var)
+    else:
+        weight = m.weight_qconf.transform(weight)
+        if fused:
+            # BN on outputs is folded into per-channel grids, codes are the same as quantized weights'
+            weight, bias, bn_scale = _fold_output_bn(m, weight, bias)
+            scale, zero_point, offset = scale * bn_scale, zero_point.expand_as(bn_scale), offset * bn_scale
+
+    m.packed_weight = PackedWeight(weight, scale, zero_point, offset, m.weight_qconf.bit_width)
+    del m.weight
+    m.bias = None if bias is None else nn.Parameter(bias.detach().clone(), requires_grad=False)
+    return True
+
+
+def _binarizable(qconf):
+    # whether outputs of `transform` are `lb` / `ub` exactly, selected by `x > 0`
+    return qconf.enabled and not qconf.retain_fp and not qconf.prune_to_zero and qconf._manual_bias is None \
+        and qconf.method == "linear" and qconf.bit_width == 1 and qconf.lb.dim() == 0
+
+
+@torch.no_grad()
+def _binarize_weight(m, fused):
+    if not (_binarizable(m.weight_qconf) and _binarizable(m.input_qconf)):
+        return False
+    lb, ub = m.weight_qconf.lb.detach().double(), m.weight_qconf.ub.detach().double()
+    center, radius = (ub + lb) / 2, (ub - lb) / 2
+    weight, bias = m.weight, m.bias
+    if fused and m.fold_bn:
+        weight, bias = _fold_bn(m, weight, bias, m.alpha, m.beta, m.running_mean, m.running_var)
+    else:
+        weight = m.weight_qconf.transform(weight)
+        if fused:
+            # same as `_pack_weight`, negative radii of negative BN scales are handled by `BinaryWeight`
+            weight, bias, bn_scale = _fold_output_bn(m, weight, bias)
+            center, radius = center * bn_scale.double(), radius * bn_scale.double()
+
+    m.binary_weight = BinaryWeight(weight, center, radius, getattr(m, "groups", 1))
+    m.binary_valid_cache = {}
+    del m.weight
+    m.bias = None if bias is None else nn.Parameter(bias.detach().clone(), requires_grad=False)
+    return True
+
+
+def convert_to_packed(wrapper, block_numel, binary=False):
+    """See `ParametrizedQuantWrapper.to_packed`."""
+    w_enabled, a_enabled = wrapper._w_switch.enabled, wrapper._a_switch.enabled
+    wrapper.quant_w()
+    wrapper.quant_a()
+    try:
+        for m in wrapper.module.modules():
+            if m not in wrapper._quant_submodules:
+                continue
+            fused = m in wrapper._fused_submodules
+            if binary and _binarize_weight(m, fused):
+                m.forward = MethodType(BINARY_FORWARD_FUNCTIONS[m.__class__], m)
+            elif _pack_weight(m, fused):
+                m.packed_block_numel = block_numel
+                m.forward = MethodType(PACKED_FORWARD_FUNCTIONS[m.__class__], m)
+    finally:
+        wrapper.quant_w(w_enabled)
+        wrapper.quant_a(a_enabled)
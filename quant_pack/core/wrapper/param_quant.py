@@ -2,6 +2,7 @@
 
 import re
 import copy
+import weakref
 from types import MethodType
 from contextlib import contextmanager
 from collections import OrderedDict
@@ -11,7 +12,12 @@ import torch.nn as nn
 import torch.distributed as dist
 from torch.nn.parallel import DistributedDataParallel
 
-from quant_pack.core.quant.config import QuantConfig, QuantMode
+from quant_pack.core.quant.config import QuantConfig, QuantMode, QuantSwitch
+from quant_pack.core.quant.functional import TransformCache
+from quant_pack.core.quant.observer import search_mse_bounds
+from .torch_quant import convert_to_torch_quant
+from .packed import convert_to_packed
+from .sparse import convert_to_sparse
 from ._registries import FUSED_FORWARD_FUNCTIONS, \
     QUANT_FORWARD_FUNCTIONS
 
@@ -31,7 +37,8 @@ class ParametrizedQuantWrapper(nn.Module):
 
     _quantable_types = tuple(QUANT_FORWARD_FUNCTIONS.keys())
 
-    def __init__(self, module, quant_conf, bn_folding_mapping, do_fold_bn, fp_layers=None, sync_bn=False):
+    def __init__(self, module, quant_conf, bn_folding_mapping, do_fold_bn, fp_layers=None, sync_bn=False,
+                 compress_saved_input=False, cache_weight=False, fold_bn_mode="two_pass"):
         """Model wrapper for parameterized-quantized training/evaluation.
 
         Args:
@@ -41,10 +48,18 @@ class ParametrizedQuantWrapper(nn.Module):
                 - bit_width: int (for W/A both) or tuple (for kW/kA)
                 - align_zero:
             bn_folding_mapping (list[tuple]): mapping from `BN layer name` ->
-                `Conv/FC layer name`;
+                `Conv/FC layer name`, BatchNorm2d folds into Conv2d and
+                BatchNorm1d into Linear;
             do_fold_bn (bool): whether actually do BN folding training/inference
             fp_layers (list[str], optional):
             sync_bn (bool): whether sync BN statistics when forwarding
+            compress_saved_input (bool): save quantized inputs of Conv/FC layers
+                for backward as packed k-bit codes instead of float tensors
+            cache_weight (bool): reuse quantized (and BN-folded) weights until
+                weights, bounds or BN statistics change
+            fold_bn_mode (str): how BN is folded in training, "two_pass" folds
+                with batch statistics from an extra conv, "single_pass" folds
+                with running statistics and corrects outputs to batch statistics
         """
         super(ParametrizedQuantWrapper, self).__init__()
 
@@ -62,6 +77,11 @@ class ParametrizedQuantWrapper(nn.Module):
         self._module_forward = module.__class__.forward
         self._quant_submodules = set()
         self._fused_submodules = set()
+        self._transform_cache = TransformCache() if cache_weight else None
+        self._hook_targets = weakref.WeakKeyDictionary()  # runtime hook builder -> matched targets under DDP
+        # shared by all W/A configs, so that switching quant mode is O(1), disabled until mode is set
+        self._w_switch = QuantSwitch(enabled=False)
+        self._a_switch = QuantSwitch(enabled=False)
         if isinstance(quant_conf["bit_width"], (tuple, list)):
             self.w_quant_conf = copy.copy(quant_conf)
             self.w_quant_conf["bit_width"] = quant_conf["bit_width"][0]
@@ -70,11 +90,12 @@ class ParametrizedQuantWrapper(nn.Module):
         else:
             self.w_quant_conf = self.a_quant_conf = quant_conf
 
-        self._do_bn_folding(bn_folding_mapping, do_fold_bn)
-        self._register_quant_params(fp_layers)
+        self._do_bn_folding(bn_folding_mapping, do_fold_bn, fold_bn_mode)
+        self._register_quant_params(fp_layers, compress_saved_input)
 
-    def _do_bn_folding(self, bn_folding_mapping, do_fold_bn):
-        # decorate Conv2d such that its instances can get proper running statistics based on `input_qconf`
+    def _do_bn_folding(self, bn_folding_mapping, do_fold_bn, fold_bn_mode):
+        assert fold_bn_mode in ("two_pass", "single_pass")
+        # decorate Conv2d/Linear such that its instances can get proper running statistics based on `input_qconf`
         @property
         def running_mean(module):
             if hasattr(module, "input_qconf") and module.input_qconf.enabled:
@@ -89,13 +110,17 @@ class ParametrizedQuantWrapper(nn.Module):
             else:
                 return module._running_var_fp
 
-        nn.Conv2d.running_mean = running_mean
-        nn.Conv2d.running_var = running_var
+        for layer_type in (nn.Conv2d, nn.Linear):
+            layer_type.running_mean = running_mean
+            layer_type.running_var = running_var
 
         for (bn_name, conv_name) in bn_folding_mapping:
             bn_layer = _get_submodule(self.module, bn_name)
             conv_layer = _get_submodule(self.module, conv_name)
-            assert isinstance(bn_layer, (nn.BatchNorm2d, nn.SyncBatchNorm)) and isinstance(conv_layer, nn.Conv2d)
+            assert isinstance(bn_layer, (nn.BatchNorm2d, nn.SyncBatchNorm)) and isinstance(conv_layer, nn.Conv2d) \
+                or isinstance(bn_layer, (nn.BatchNorm1d, nn.SyncBatchNorm)) and isinstance(conv_layer, nn.Linear), \
+                f"can not fold {bn_layer.__class__.__name__} `{bn_name}` into " \
+                f"{conv_layer.__class__.__name__} `{conv_name}`"
             assert bn_layer._version >= 2, "deprecated BN implementation, please update to PyTorch>=1.1"
 
             conv_layer.register_parameter("alpha", bn_layer.weight)
@@ -117,9 +142,8 @@ class ParametrizedQuantWrapper(nn.Module):
             bn_layer._parameters.clear()
             bn_layer._buffers.clear()
 
-            # place holders, filled by pre_iter_hooks from m.*qconf later
-            conv_layer.weight_transform = conv_layer.input_transform = None
             conv_layer.fold_bn = do_fold_bn
+            conv_layer.fold_bn_mode = fold_bn_mode
             conv_layer.sync_bn = isinstance(bn_layer, nn.SyncBatchNorm)
             conv_layer.forward = MethodType(FUSED_FORWARD_FUNCTIONS[conv_layer.__class__], conv_layer)
             bn_layer.forward = MethodType(FUSED_FORWARD_FUNCTIONS[bn_layer.__class__], bn_layer)
@@ -127,7 +151,7 @@ class ParametrizedQuantWrapper(nn.Module):
             self._fused_submodules.add(conv_layer)
             self._fused_submodules.add(bn_layer)
 
-    def _register_quant_params(self, fp_layers):
+    def _register_quant_params(self, fp_layers, compress_saved_input):
         if fp_layers is not None:
             fp_layers = [re.compile(r) for r in fp_layers]
         for n, m in self.module.named_modules():
@@ -139,12 +163,13 @@ class ParametrizedQuantWrapper(nn.Module):
                     ("a_lb", nn.Parameter(torch.tensor(0.))),
                     ("a_ub", nn.Parameter(torch.tensor(1.))),
                 )
-                m.weight_qconf = QuantConfig(lb=m.w_lb, ub=m.w_ub, **self.w_quant_conf)
-                m.input_qconf = QuantConfig(lb=m.a_lb, ub=m.a_ub, **self.a_quant_conf)
+                m.weight_qconf = QuantConfig(lb=m.w_lb, ub=m.w_ub, switch=self._w_switch, **self.w_quant_conf)
+                m.input_qconf = QuantConfig(lb=m.a_lb, ub=m.a_ub, switch=self._a_switch, **self.a_quant_conf)
+                m.compress_saved_input = compress_saved_input
+                m.transform_cache = self._transform_cache
                 self._quant_submodules.add(m)
 
                 if m not in self._fused_submodules:
-                    m.weight_transform = m.input_transform = None
                     m.forward = MethodType(QUANT_FORWARD_FUNCTIONS[m.__class__], m)
 
                 if fp_layers is not None and any(reg.match(n) for reg in fp_layers):
@@ -157,8 +182,45 @@ class ParametrizedQuantWrapper(nn.Module):
                                               device_ids=[torch.cuda.current_device()],
                                               find_unused_parameters=find_unused_parameters)
 
-    def to_torch_quant(self):
-        raise NotImplementedError()
+    def to_torch_quant(self, calib_input=None, backend="fbgemm", requantize_outputs=False):
+        """Convert to a CPU model with integer Conv/FC kernels of PyTorch quantized engines.
+
+        Learned bounds and (folded) BN parameters are taken as in the QWQA evaluation. Layers whose
+        outputs reach the next quantized layer through ReLU only run integer kernels, if their weights
+        are exact in int8 and its input grid in quint8 (zero-aligned grids, or input grids starting at
+        0 even without `align_zero`), so that outputs are requantized onto it directly. Others (e.g. those feeding residual adds) compute k-bit inputs
+        and weights in float, unless `requantize_outputs`, with 8-bit output ranges calibrated on
+        `calib_input` (a batch or a list of batches). Returns a new `nn.Module` for inference, this
+        wrapper is kept untouched.
+        """
+        return convert_to_torch_quant(self, calib_input, backend, requantize_outputs)
+
+    def to_packed(self, block_numel=2 ** 20, binary=False):
+        """In-place conversion for inference, weights of quantized Conv/FC layers are replaced by
+        their k-bit codes packed into bytes (`PackedWeight`), with BN folded in.
+
+        Layers then unpack at most `block_numel` weights at a time during forward, instead of
+        holding FP32 copies. Layers in `fp_layers` or without a linear 2~8-bit weight quantizer
+        are left as is. Weights are always quantized afterwards, regardless of `fp_w()`.
+
+        With `binary`, layers with both weights and inputs binarized (1-bit) are converted to
+        `BinaryWeight` instead, whose dot products are computed by XOR / popcount on 64-bit words,
+        and whose inputs are always binarized afterwards, regardless of `fp_a()`. This is opt-in,
+        since the XOR / popcount path built from tensor ops is still slower than dense conv on CPU.
+        """
+        convert_to_packed(self, block_numel, binary)
+
+    def to_sparse(self, input, threshold=0.5, iters=10, min_speedup=1.):
+        """In-place conversion for inference, quantized Conv/FC layers whose weights (with BN
+        folded in) have at least `threshold` zeros, e.g. by `prune_to_zero`, are switched to
+        CSR matmuls on im2col-ed inputs, if faster than dense by at least `min_speedup`.
+
+        `input` is a sample batch, on which dense and sparse forwards of each candidate layer are
+        timed `iters` times. Returns a report of {layer name: dict(sparsity, sparse, dense_ms,
+        sparse_ms, speedup)}, timings are only given for candidate layers. Weights and inputs
+        of converted layers are always quantized afterwards, regardless of `fp_w()` / `fp_a()`.
+        """
+        return convert_to_sparse(self, input, threshold, iters, min_speedup)
 
     def get_optimizers(self, *optim_grops):
         ret = {}
@@ -183,38 +245,59 @@ class ParametrizedQuantWrapper(nn.Module):
         return ret
 
     def quant_w(self, enabled=True):
-        for m in self._quant_submodules:
-            m.weight_qconf.quant(enabled)
-            m.weight_transform = m.weight_qconf.transform
+        self._w_switch.enabled = enabled
 
     def fp_w(self):
         self.quant_w(enabled=False)
 
     def quant_a(self, enabled=True):
-        for m in self._quant_submodules:
-            m.input_qconf.quant(enabled)
-            m.input_transform = m.input_qconf.transform
+        self._a_switch.enabled = enabled
 
     def fp_a(self):
         self.quant_a(enabled=False)
 
+    @torch.no_grad()
+    def validate_quant_bounds(self):
+        # batched replacement of the per-call checks skipped by `sync_free` quantizers,
+        # only one device-to-host sync for the whole model
+        names, valid = [], []
+        for n, m in self.module.named_modules():
+            if m in self._quant_submodules:
+                names += [f"{n}.w", f"{n}.a"]
+                valid += [m.w_lb.lt(m.w_ub).all(), m.a_lb.lt(m.a_ub).all()]
+        if not valid:
+            return
+        valid = torch.stack(valid)
+        if not valid.all():
+            invalid = [names[i] for i in (~valid).nonzero().flatten().tolist()]
+            raise AssertionError(f"invalid quantization range in: {', '.join(invalid)}")
+
+    def _runtime_hook_targets(self, builder):
+        # register methods of modules matched by `builder`, matched once per builder, values hold
+        # no reference to builders so that removed ones are collected
+        targets = self._hook_targets.get(builder)
+        if targets is None:
+            targets = []
+            for n, m in self.module.module.named_modules():
+                if builder.match(n, m):
+                    targets.append(m)
+            self._hook_targets[builder] = targets
+        return [(getattr(m, method), hook) for m in targets for method, hook in builder.get_hooks()]
+
     @contextmanager
     def _inject_runtime_hooks(self, runtime_hooks):
         need_recover = False
         if runtime_hooks and isinstance(self.module, DistributedDataParallel):
             # 前方高能，套娃警告
+            targets = [t for builder in runtime_hooks for t in self._runtime_hook_targets(builder)]
+
             def _ddp_forward(_module, *_args, **_kwargs):
-                _handles = []
-                for _n, _m in _module.named_modules():
-                    for _hook in runtime_hooks:
-                        if _hook.match(_n, _m):
-                            for _method, _hook in _hook.get_hooks():
-                                _handle = getattr(_m, _method)(_hook)
-                                _handles.append(_handle)
-                _outputs = self._module_forward(_module, *_args, **_kwargs)
-                for _handle in _handles:
-                    _handle.remove()
-                return _outputs
+                _handles = [_register(_hook) for _register, _hook in targets]
+                try:
+                    return self._module_forward(_module, *_args, **_kwargs)
+                finally:
+                    for _handle in _handles:
+                        _handle.remove()
             self.module.module.forward = MethodType(_ddp_forward, self.module.module)
             need_recover = True
         try:
@@ -234,6 +317,8 @@ class ParametrizedQuantWrapper(nn.Module):
             quant_mode = model.quant_mode
         img, label = data_batch
         outputs = OrderedDict(label=label.to(device, non_blocking=True))
+        if model._transform_cache is not None:
+            model._transform_cache.next_step()
         for i, mode in enumerate(quant_mode):
             if isinstance(mode, str):
                 mode = QuantMode.get(mode)
@@ -252,25 +337,122 @@ class ParametrizedQuantWrapper(nn.Module):
             outputs[f"{mode}"] = model(img.to(device, non_blocking=True), runtime_hooks=runtime_hooks)
         return outputs
 
+    @torch.no_grad()
+    def calibrate_weights(self, method="minmax", per_channel=False, **search_args):
+        """Initializes `w_lb` / `w_ub` of all quantized layers, by min/max of weights or by minimizing
+        quantization MSE with `search_mse_bounds`, per-tensor or per-channel. The MSE search is done
+        on weights as quantized, i.e. with BN folded in if `do_fold_bn`.
+
+        Set by the "weight" entry of `calibrate_cfg`, e.g. `weight: {method: mse, per_channel: true}`.
+        """
+        assert method in ("minmax", "mse"), f"unknown weight calibration method: {method}"
+        # the align-zero kernel of `LinearQuantFunc` takes per-tensor bounds only
+        assert not (per_channel and any(m.weight_qconf.align_zero for m in self._quant_submodules)), \
+            "per-channel weight bounds do not support `align_zero`"
+        for m in self._quant_submodules:
+            if method == "minmax":
+                # TODO: handle BN-folding?
+                if per_channel:
+                    rows = m.weight.reshape(m.weight.size(0), -1)
+                    lb, ub = rows.min(dim=1)[0], rows.max(dim=1)[0]
+                else:
+                    lb, ub = m.weight.min(), m.weight.max()
+            else:
+                weight = m.weight
+                if m in self._fused_submodules and m.fold_bn:
+                    std = torch.sqrt(m.running_var + m.bn_eps)
+                    bn_scale = m.alpha / std if m.affine else std.reciprocal()
+                    weight = weight * bn_scale.view((-1, ) + (1, ) * (weight.dim() - 1))
+                lb, ub = search_mse_bounds(weight, m.weight_qconf.bit_width, m.weight_qconf.align_zero,
+                                           per_channel, **search_args)
+            # per-channel bounds replace data of the same parameters, so that optimizers still hold them
+            m.w_lb.data = lb.to(m.w_lb).clone()
+            m.w_ub.data = ub.to(m.w_ub).clone()
+
+    @torch.no_grad()
+    def reestimate_bn_stats(self, data, device, quant_mode="quant", num_batches=None):
+        """Replaces running statistics of all folded BN layers with exact averages of batch statistics
+        over `num_batches` batches of `data` (all if None) in `quant_mode`, one forward per batch. The
+        quantized-domain statistics are re-estimated if activations are quantized in `quant_mode`, FP
+        ones otherwise. Other layers run in eval mode. Without SyncBN, statistics are averaged over ranks.
+
+        Set by the "reestimate_bn" entry of `calibrate_cfg` or of the eval config, or by the
+        `ReestimateBNStats` policy, e.g. `reestimate_bn: {num_batches: 50}`.
+        """
+        if isinstance(quant_mode, str):
+            quant_mode = QuantMode.get(quant_mode)
+        layers = [m for m in self._fused_submodules if not isinstance(m, (nn.BatchNorm1d, nn.BatchNorm2d,
+                                                                            nn.SyncBatchNorm))]
+        training = {m: m.training for m in self.modules()}
+        momentum = {m: m.bn_momentum for m in layers}
+        w_enabled, a_enabled = self._w_switch.enabled, self._a_switch.enabled
+        self.quant_w(QuantMode.QW in quant_mode)
+        self.quant_a(QuantMode.QA in quant_mode)
+        # buffers of the domain selected by activation quantization
+        stats = [(m.running_mean, m.running_var) for m in layers]
+        # bypass DDP, which would broadcast buffers of rank 0 before each forward
+        module = self.module.module if isinstance(self.module, DistributedDataParallel) else self.module
+        self.eval()
+        for m in layers:
+            m.train()
+        count = 0
+        try:
+            for img, _ in data:
+                if num_batches is not None and count >= num_batches:
+                    break
+                # a momentum of 1/k keeps the cumulative average of k batches
+                count += 1
+                for m in layers:
+                    m.bn_momentum = 1. / count
+                if self._transform_cache is not None:
+                    self._transform_cache.next_step()
+                module(img.to(device, non_blocking=True))
+        finally:
+            for m, flag in training.items():
+                m.training = flag
+            for m, value in momentum.items():
+                m.bn_momentum = value
+            self.quant_w(w_enabled)
+            self.quant_a(a_enabled)
+
+        if dist.is_available() and dist.is_initialized():
+            # averages of equally many batches on each rank, averaged again in one all_reduce
+            stats = [s for m, pair in zip(layers, stats) if not m.sync_bn for s in pair]
+            if stats:
+                flat = torch.cat(stats).div_(dist.get_world_size())
+                dist.all_reduce(flat, dist.ReduceOp.SUM)
+                for s, value in zip(stats, flat.split([s.numel() for s in stats])):
+                    s.copy_(value)
+        return count
+
     @torch.no_grad()
     def do_calibration(self, runner, calibration_step, calibration_cfg, device, runtime_hook):
         runner.logger.info(f"start calibration at epoch {runner.epoch}, iter {runner.iter}")
-        for m in self._quant_submodules:
-            # TODO: handle BN-folding?
-            m.w_lb.copy_(m.weight.min())
-            m.w_ub.copy_(m.weight.max())
-        self.quant_w()
         self.fp_a()
+        self.calibrate_weights(**calibration_cfg.get("weight", {}))
+        self.quant_w()
         calib_hook_name = runtime_hook.add_builder(calibration_cfg, enabled=True, model=self)
         runtime_hooks = runtime_hook.update_hooks(QuantMode.QWFA | QuantMode.Calib, force=True)
-        for i, data_batch in enumerate(runner.data_loader):
+        # pre-decoded calibration data if available, see `CalibrationStore`
+        calibration_store = getattr(runner, "calibration_store", None)
+        if calibration_store is not None:
+            data = calibration_store.batches(device)
+        else:
+            data = runner.data_loader
+        for i, data_batch in enumerate(data):
             if i >= calibration_step:
                 break
             img, _ = data_batch
             _ = self(img.to(device, non_blocking=True), runtime_hooks=runtime_hooks)
+        runtime_hook.named_builders[calib_hook_name].update_bounds()
         runtime_hook.remove_builder(calib_hook_name)
         for m in self._fused_submodules:
-            if not isinstance(m, (nn.BatchNorm2d, nn.SyncBatchNorm)):
+            if not isinstance(m, (nn.BatchNorm1d, nn.BatchNorm2d, nn.SyncBatchNorm)):
                 m._running_mean_q = m._running_mean_fp.clone()
                 m._running_var_q = m._running_var_fp.clone()
+        bn_cfg = calibration_cfg.get("reestimate_bn")
+        if bn_cfg is not None:
+            data = calibration_store.batches(device) if calibration_store is not None else runner.data_loader
+            num_batches = self.reestimate_bn_stats(data, device, **bn_cfg)
+            runner.logger.info(f"BN statistics re-estimated with {num_batches} batches")
         runner.logger.info(f"calibration done with {i} steps")
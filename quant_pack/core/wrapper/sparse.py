@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+import time
+from types import MethodType
+
+import torch
+import torch.nn as nn
+
+from .packed import _quantized_weight
+from ._registries import SPARSE_FORWARD_FUNCTIONS
+
+__all__ = ["convert_to_sparse"]
+
+
+def _weight_matrix(m, weight):
+    # (C_out, C_in * k * k) matrix multiplied with im2col-ed inputs, block-diagonal for grouped conv
+    groups = getattr(m, "groups", 1)
+    rows = weight.reshape(weight.size(0), -1)
+    if groups == 1:
+        return rows
+    out_per_group, row_numel = rows.size(0) // groups, rows.size(1)
+    matrix = rows.new_zeros(rows.size(0), row_numel * groups)
+    for g in range(groups):
+        matrix[g * out_per_group:(g + 1) * out_per_group, g * row_numel:(g + 1) * row_numel] = \
+            rows[g * out_per_group:(g + 1) * out_per_group]
+    return matrix
+
+
+def _latency(f, iters):
+    f()  # warm up
+    start = time.perf_counter()
+    for _ in range(iters):
+        f()
+    return (time.perf_counter() - start) / iters
+
+
+@torch.no_grad()
+def _record_inputs(wrapper, input):
+    inputs = {}
+    handles = [m.register_forward_pre_hook(lambda m, args: inputs.setdefault(m, args[0]))
+               for m in wrapper._quant_submodules]
+    try:
+        wrapper(input)
+    finally:
+        for h in handles:
+            h.remove()
+    return inputs
+
+
+@torch.no_grad()
+def convert_to_sparse(wrapper, input, threshold, iters, min_speedup=1.):
+    """See `ParametrizedQuantWrapper.to_sparse`."""
+    w_enabled, a_enabled = wrapper._w_switch.enabled, wrapper._a_switch.enabled
+    wrapper.quant_w()
+    wrapper.quant_a()
+    report = {}
+    try:
+        layer_inputs = _record_inputs(wrapper, input)
+        for n, m in wrapper.module.named_modules():
+            if m not in wrapper._quant_submodules or m.weight_qconf.retain_fp:
+                continue
+            weight, bias = _quantized_weight(m, m in wrapper._fused_submodules)
+            sparsity = weight.eq(0.).float().mean().item()
+            report[n] = entry = dict(sparsity=sparsity, sparse=False)
+            if sparsity < threshold or m not in layer_inputs:
+                continue
+
+            dense_params, patched_forward = (m.weight, m.bias), m.__dict__.get("forward")
+            m.weight = nn.Parameter(weight.detach().clone(), requires_grad=False)
+            m.bias = None if bias is None else nn.Parameter(bias.detach().clone(), requires_grad=False)
+            layer_input = layer_inputs[m]
+            input_transform = m.input_qconf.transform
+            dense_forward = MethodType(m.__class__.forward, m)
+            if input_transform is not None:
+                dense_f = lambda: dense_forward(input_transform(layer_input))
+            else:
+                dense_f = lambda: dense_forward(layer_input)
+            entry["dense_ms"] = _latency(dense_f, iters) * 1e3
+
+            m.register_buffer("sparse_weight", _weight_matrix(m, m.weight).to_sparse_csr())
+            del m.weight
+            m.forward = MethodType(SPARSE_FORWARD_FUNCTIONS[m.__class__], m)
+            entry["sparse_ms"] = _latency(lambda: m(layer_input), iters) * 1e3
+            entry["speedup"] = entry["dense_ms"] / entry["sparse_ms"]
+            if entry["speedup"] < min_speedup:
+                # not worth it, back to the dense layer
+                del m.sparse_weight
+                m.weight, m.bias = dense_params
+                if patched_forward is None:
+                    del m.forward
+                else:
+                    m.forward = patched_forward
+                continue
+            entry["sparse"] = True
+    finally:
+        wrapper.quant_w(w_enabled)
+        wrapper.quant_a(a_enabled)
+    return report
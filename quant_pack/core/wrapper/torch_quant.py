@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+
+import copy
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.fx as fx
+
+try:
+    import torch.ao.nn.quantized as nnq
+except ImportError:  # PyTorch < 1.13
+    import torch.nn.quantized as nnq
+
+from quant_pack.core.fuse.functional import _fold_bn
+
+__all__ = ["TorchQuantLayer", "convert_to_torch_quant"]
+
+
+def _affine_qparams(lo, hi, q_min, q_max):
+    # PyTorch convention, representable range always includes 0
+    lo, hi = min(lo, 0.), max(hi, 0.)
+    scale = max((hi - lo) / (q_max - q_min), 1e-8)
+    zero_point = min(max(int(round(q_min - lo / scale)), q_min), q_max)
+    return scale, zero_point
+
+
+def _grid(qconf, name):
+    params = qconf.grid_params()
+    assert params is not None, \
+        f"{name}: only enabled, linear 2~8-bit quantizers with scalar bounds and without `prune_to_zero` " \
+        f"could be converted to integer kernels"
+    scale, zero_point, offset = (t.item() for t in params)
+    return scale, int(round(zero_point)), offset
+
+
+class TorchQuantLayer(nn.Module):
+    """Conv2d/Linear of a trained `ParametrizedQuantWrapper` on PyTorch quantized CPU kernels.
+
+    Inputs are quantized to k-bit codes in quint8 and weights are int8 (exactly if `exact_weight`).
+    Integer kernels are used if outputs are requantized onto the input grid of the next layer
+    (`output_qparams`, only set with exact weights), or with `requantize_output`, to an 8-bit range
+    calibrated over `out_range`, then dequantized so that ops in between (residual adds, pooling,
+    ...) stay in float. Otherwise k-bit inputs and weights are computed in float, as in the fake-quant
+    evaluation. Layers without grid params (`fp_layers`) stay in float.
+    """
+
+    def __init__(self, layer, weight, bias, input_grid=None, weight_grid=None, bit_width=8, post_scale=None,
+                 post_shift=None):
+        super(TorchQuantLayer, self).__init__()
+        if isinstance(layer, nn.Conv2d):
+            assert layer.padding_mode == "zeros", f"unsupported padding mode: {layer.padding_mode}"
+            self.float_layer = nn.Conv2d(layer.in_channels, layer.out_channels, layer.kernel_size, layer.stride,
+                                         layer.padding, layer.dilation, layer.groups, bias is not None)
+        else:
+            self.float_layer = nn.Linear(layer.in_features, layer.out_features, bias is not None)
+        self.float_layer.requires_grad_(False)
+        self.int_layer = None
+        self.input_grid = input_grid
+        self.input_max_code = 2 ** bit_width - 1
+        self.output_qparams = None
+        self.register_buffer("post_scale", post_scale)
+        self.register_buffer("post_shift", post_shift)
+
+        self.float_layer.weight.copy_(weight)
+        if input_grid is None:
+            self.qweight = None
+        else:
+            self.qweight = torch.quantize_per_tensor(weight, *self._weight_qparams(weight, weight_grid), torch.qint8)
+            # e.g. not for grids with nonzero offsets, or per-channel ones of folded BN
+            self.exact_weight = torch.allclose(self.qweight.dequantize(), weight, rtol=0.,
+                                               atol=self.qweight.q_scale() * 1e-3)
+            self.out_range = (float("inf"), -float("inf"))
+        if bias is not None:
+            self.float_layer.bias.copy_(bias)
+
+    @staticmethod
+    def _weight_qparams(weight, weight_grid):
+        scale, zero_point, offset = weight_grid
+        if offset == 0. and 0 <= zero_point <= 255:
+            # codes `i` of zero-aligned k-bit grids are exactly `i - 128` in int8
+            return scale, zero_point - 128
+        return _affine_qparams(weight.min().item(), weight.max().item(), -128, 127)
+
+    def aligned_input_qparams(self):
+        # quint8 (scale, zero_point) whose codes are exactly the k-bit input codes, if any
+        if self.qweight is None:
+            return None
+        scale, zero_point, offset = self.input_grid
+        if offset == 0. and 0 <= zero_point <= 255:
+            return scale, zero_point
+        return None
+
+    def _snap_input(self, x):
+        # k-bit grid values in float
+        scale, zero_point, offset = self.input_grid
+        codes = ((x - offset) / scale + zero_point).round_().clamp_(0, self.input_max_code)
+        return (codes - zero_point) * scale + offset
+
+    def _quantize_input(self, x):
+        scale, zero_point, offset = self.input_grid
+        if self.aligned_input_qparams() is not None:
+            x = x.clamp(-zero_point * scale, (self.input_max_code - zero_point) * scale)
+        else:
+            # snap to the k-bit grid in float, then represent it with 8 bits
+            x = self._snap_input(x)
+            scale, zero_point = _affine_qparams(offset - zero_point * scale,
+                                                offset + (self.input_max_code - zero_point) * scale, 0, 255)
+        return torch.quantize_per_tensor(x.float(), scale, zero_point, torch.quint8)
+
+    def _post_process(self, y):
+        if self.post_scale is not None:
+            view = (1, -1) + (1, ) * (y.dim() - 2)
+            y = y * self.post_scale.view(view) + self.post_shift.view(view)
+        return y
+
+    def forward(self, x):
+        if self.qweight is None:
+            return self._post_process(self.float_layer(x))
+        if self.int_layer is not None:
+            return self._post_process(self.int_layer(self._quantize_input(x)).dequantize())
+        y = self.float_layer(self._snap_input(x))
+        if self.out_range is not None:
+            # calibration of the output range
+            self.out_range = (min(self.out_range[0], y.min().item()), max(self.out_range[1], y.max().item()))
+        return self._post_process(y)
+
+    def convert(self, requantize_output=False):
+        if self.qweight is None:
+            return
+        if self.output_qparams is None and not requantize_output:
+            self.out_range = None
+            return
+        layer = self.float_layer
+        bias = None if layer.bias is None else layer.bias.float()
+        if isinstance(layer, nn.Conv2d):
+            int_layer = nnq.Conv2d(layer.in_channels, layer.out_channels, layer.kernel_size, layer.stride,
+                                   layer.padding, layer.dilation, layer.groups, bias is not None)
+        else:
+            int_layer = nnq.Linear(layer.in_features, layer.out_features, bias is not None)
+        int_layer.set_weight_bias(self.qweight, bias)
+        if self.output_qparams is not None:
+            int_layer.scale, int_layer.zero_point = self.output_qparams
+        else:
+            int_layer.scale, int_layer.zero_point = _affine_qparams(*self.out_range, 0, 255)
+        self.int_layer = int_layer
+        self.float_layer = None
+
+
+class _Tracer(fx.Tracer):
+
+    def is_leaf_module(self, m, module_qualified_name):
+        return isinstance(m, TorchQuantLayer) or super(_Tracer, self).is_leaf_module(m, module_qualified_name)
+
+
+def _is_relu(node, modules):
+    if node.op == "call_module":
+        return isinstance(modules[node.target], (nn.ReLU, nn.Identity))
+    if node.op == "call_function":
+        return node.target in (torch.relu, F.relu)
+    return node.op == "call_method" and node.target in ("relu", "relu_")
+
+
+def _hand_off_output_grids(model):
+    # 8-bit requantization of outputs loses precision w.r.t. k-bit inputs of the next layer, if
+    # outputs only go through ReLU to the next layer, requantize to its input grid directly,
+    # since rounding to zero-aligned grids commutes with ReLU, this matches fake quantization
+    # as long as weights are exact in int8 and the input grid in quint8
+    try:
+        graph = _Tracer().trace(model)
+    except Exception:
+        return
+    modules = dict(model.named_modules())
+    for node in graph.nodes:
+        if node.op != "call_module" or not isinstance(modules[node.target], TorchQuantLayer):
+            continue
+        producer = modules[node.target]
+        if producer.qweight is None or producer.post_scale is not None or not producer.exact_weight:
+            continue
+        while len(node.users) == 1:
+            node = next(iter(node.users))
+            if node.op == "call_module" and isinstance(modules[node.target], TorchQuantLayer):
+                producer.output_qparams = modules[node.target].aligned_input_qparams()
+                break
+            if not _is_relu(node, modules):
+                break
+
+
+def _set_submodule(module, sub_name, value):
+    parent_name, _, name = sub_name.rpartition(".")
+    for n in parent_name.split(".") if parent_name else []:
+        module = getattr(module, n)
+    setattr(module, name, value)
+
+
+@torch.no_grad()
+def _build_layer(name, m, fused):
+    weight, bias = m.weight, m.bias
+    post_scale = post_shift = None
+    if fused and m.fold_bn:
+        weight, bias = _fold_bn(m, weight, bias, m.alpha, m.beta, m.running_mean, m.running_var)
+    else:
+        weight_transform = m.weight_qconf.transform
+        if weight_transform is not None:
+            weight = weight_transform(weight)
+        if fused:
+            # BN after the quantized layer, applied in float on outputs
+            std = torch.sqrt(m.running_var + m.bn_eps)
+            post_scale = m.alpha / std if m.affine else std.reciprocal()
+            post_shift = (m.beta if m.affine else 0.) - m.running_mean * post_scale
+    weight, bias, post_scale, post_shift = (None if t is None else t.detach().float().cpu()
+                                            for t in (weight, bias, post_scale, post_shift))
+    if m.weight_qconf.retain_fp:
+        return TorchQuantLayer(m, weight, bias, post_scale=post_scale, post_shift=post_shift)
+    return TorchQuantLayer(m, weight, bias, _grid(m.input_qconf, f"{name}.input"),
+                           _grid(m.weight_qconf, f"{name}.weight"), m.input_qconf.bit_width, post_scale, post_shift)
+
+
+@torch.no_grad()
+def convert_to_torch_quant(wrapper, calib_input=None, backend="fbgemm", requantize_outputs=False):
+    """Build an integer inference copy of `wrapper.module`, see `ParametrizedQuantWrapper.to_torch_quant`."""
+    assert not isinstance(wrapper.module, nn.parallel.DistributedDataParallel), "convert before `to_ddp()`"
+    assert backend in torch.backends.quantized.supported_engines, f"unsupported quantized engine: {backend}"
+    torch.backends.quantized.engine = backend
+    w_enabled, a_enabled = wrapper._w_switch.enabled, wrapper._a_switch.enabled
+    wrapper.quant_w()
+    wrapper.quant_a()
+    try:
+        layers = {}
+        for n, m in wrapper.module.named_modules():
+            if m in wrapper._quant_submodules:
+                layers[n] = _build_layer(n, m, m in wrapper._fused_submodules)
+            elif m in wrapper._fused_submodules:
+                # BN folded into (or applied on outputs of) the preceding layer
+                layers[n] = nn.Identity()
+    finally:
+        wrapper.quant_w(w_enabled)
+        wrapper.quant_a(a_enabled)
+
+    model = copy.deepcopy(wrapper.module).cpu().eval()
+    for n, layer in layers.items():
+        _set_submodule(model, n, layer.cpu())
+
+    _hand_off_output_grids(model)
+    if requantize_outputs:
+        assert calib_input is not None, "`calib_input` is required to calibrate ranges of requantized outputs"
+        for x in [calib_input] if torch.is_tensor(calib_input) else calib_input:
+            model(x.cpu())
+    for m in model.modules():
+        if isinstance(m, TorchQuantLayer):
+            m.convert(requantize_outputs)
+    return model
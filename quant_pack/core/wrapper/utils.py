@@ -1,12 +1,59 @@
 # -*- coding: utf-8 -*-
 
+import os
+import json
+import inspect
+import hashlib
 from tempfile import NamedTemporaryFile
 
 import torch
-import onnx
+import torch.nn as nn
+import torch.fx as fx
 
+__all__ = ["track_bn_folding_mapping"]
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "quant_pack", "bn_folding")
+
+# BN type -> types of the preceding layer it could be folded into
+_FOLDABLE_PATTERNS = (
+    ((nn.BatchNorm2d, nn.SyncBatchNorm), nn.Conv2d),
+    ((nn.BatchNorm1d, nn.SyncBatchNorm), nn.Linear),
+)
+
+
+def _architecture_hash(model):
+    # layer hyper-params come from `repr`, connectivity from `forward` sources of all module types
+    sha = hashlib.sha1(repr(model).encode())
+    for cls in sorted({m.__class__ for m in model.modules()}, key=lambda c: f"{c.__module__}.{c.__qualname__}"):
+        sha.update(f"{cls.__module__}.{cls.__qualname__}".encode())
+        try:
+            sha.update(inspect.getsource(cls.forward).encode())
+        except (OSError, TypeError):
+            pass
+    return sha.hexdigest()
+
+
+def _track_by_fx(model):
+    bn_conv_mappings = []
+    graph_module = fx.symbolic_trace(model)
+    modules = dict(graph_module.named_modules())
+    for node in graph_module.graph.nodes:
+        if node.op != "call_module" or len(node.args) != 1:
+            continue
+        prev = node.args[0]
+        if not isinstance(prev, fx.Node) or prev.op != "call_module" or len(prev.users) != 1:
+            # the Conv/FC output is also consumed elsewhere, folding would change it
+            continue
+        bn_layer, conv_layer = modules[node.target], modules[prev.target]
+        if any(isinstance(bn_layer, bn_types) and isinstance(conv_layer, conv_type)
+               for bn_types, conv_type in _FOLDABLE_PATTERNS):
+            bn_conv_mappings.append((node.target, prev.target))
+    return bn_conv_mappings
+
+
+def _track_by_onnx(model, dummy_input):
+    import onnx
 
-def track_bn_folding_mapping(model, dummy_input):
     bn_conv_mappings = []
     with NamedTemporaryFile("wb") as f:
         torch.onnx.export(model, dummy_input, f)
@@ -15,7 +62,37 @@ def track_bn_folding_mapping(model, dummy_input):
             node = onnx_model.graph.node[i]
             if node.op_type == "BatchNormalization":
                 bn_layer_name = node.input[1].replace(".weight", "")
-                if i - 1 >= 0 and onnx_model.graph.node[i - 1].op_type == "Conv":
+                if i - 1 >= 0 and onnx_model.graph.node[i - 1].op_type in ("Conv", "Gemm"):
                     conv_layer_name = onnx_model.graph.node[i - 1].input[1].replace(".weight", "")
                     bn_conv_mappings.append((bn_layer_name, conv_layer_name))
     return bn_conv_mappings
+
+
+def track_bn_folding_mapping(model, dummy_input=None, cache_dir=DEFAULT_CACHE_DIR):
+    """Find (BN layer name, Conv/FC layer name) pairs that BN could be folded into,
+    i.e. Conv2d -> BN2d and Linear -> BN1d, whatever follows (e.g. ReLU).
+
+    `model` is traced symbolically by `torch.fx`, the ONNX export of `dummy_input`
+    is only a fallback for models that are not traceable. Results are cached as
+    JSON under `cache_dir` (disabled if None), keyed by the architecture hash.
+    """
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, f"{_architecture_hash(model)}.json")
+        if os.path.isfile(cache_file):
+            with open(cache_file, "r") as f:
+                return [tuple(pair) for pair in json.load(f)]
+
+    try:
+        bn_conv_mappings = _track_by_fx(model)
+    except Exception:
+        assert dummy_input is not None, f"{model.__class__.__name__} is not fx-traceable, `dummy_input` is required"
+        bn_conv_mappings = _track_by_onnx(model, dummy_input)
+
+    if cache_file is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        # write-then-rename, ranks may discover the same architecture concurrently
+        with NamedTemporaryFile("w", dir=cache_dir, suffix=".tmp", delete=False) as f:
+            json.dump(bn_conv_mappings, f)
+        os.replace(f.name, cache_file)
+    return bn_conv_mappings
@@ -5,8 +5,9 @@ from torchvision import datasets, transforms
 from .cifar import *
 from .imagenet import *
 from .sampler import *
+from .calibration import *
 
-__all__ = ["build_dataset", "IterationSampler"]
+__all__ = ["build_dataset", "build_calibration_store", "IterationSampler", "CalibrationStore"]
 
 _dataset_zoo = {
     "CIFAR100Sub": CIFAR100Sub,
@@ -57,3 +58,12 @@ def build_dataset(name, *args, eval_only=False, **kwargs):
         train_set = _dataset_zoo[name](*args, train=True, transform=train_trans, **kwargs)
         eval_set = _dataset_zoo[name](*args, train=False, transform=eval_trans, **kwargs)
         return train_set, eval_set
+
+
+def build_calibration_store(name, *args, num_samples=1024, batch_size=64, seed=19260817, cache_file=None,
+                            num_workers=0, rank=0, world_size=1, **kwargs):
+    # a seeded subset of the training set with eval transforms, decoded once
+    uint8_trans, (mean, std) = split_uint8_transform(_eval_transforms[name])
+    train_set = _dataset_zoo[name](*args, train=True, transform=uint8_trans, **kwargs)
+    return CalibrationStore(train_set, num_samples, batch_size, mean, std, seed, cache_file, num_workers,
+                            rank, world_size)
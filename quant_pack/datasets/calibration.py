@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Subset
+from torchvision import transforms
+
+__all__ = ["CalibrationStore", "split_uint8_transform"]
+
+
+def split_uint8_transform(transform):
+    """Splits `Compose([..., ToTensor(), Normalize(...)])` into a transform giving uint8 tensors
+    and the (mean, std) of its normalization.
+    """
+    ts = transform.transforms
+    to_tensor = [i for i, t in enumerate(ts) if isinstance(t, transforms.ToTensor)]
+    assert len(to_tensor) == 1, f"expect exactly one ToTensor in {transform}"
+    i = to_tensor[0]
+    post = ts[i + 1:]
+    assert len(post) <= 1 and all(isinstance(t, transforms.Normalize) for t in post), \
+        f"only Normalize is supported after ToTensor, got {post}"
+    if post:
+        mean, std = post[0].mean, post[0].std
+    else:
+        mean, std = (0., ), (1., )
+    return transforms.Compose(ts[:i] + [transforms.PILToTensor()]), (mean, std)
+
+
+class CalibrationStore:
+    """A fixed, seeded subset of `dataset` decoded once into a contiguous uint8 tensor, in memory or
+    memory-mapped from `cache_file` (reused by later runs if built from the same indices), for calibration
+    without decoding and augmentation. `dataset` should give uint8 (C, H, W) images, see `split_uint8_transform`.
+
+    Images are normalized by `mean` / `std` after being moved to the target device, see `batches()`.
+    In distributed runs, each rank keeps its own shard of the subset.
+    """
+
+    def __init__(self, dataset, num_samples, batch_size, mean, std, seed=19260817, cache_file=None,
+                 num_workers=0, rank=0, world_size=1):
+        self.batch_size = batch_size
+        self.mean = torch.tensor(mean, dtype=torch.float32).view(1, -1, 1, 1)
+        self.std = torch.tensor(std, dtype=torch.float32).view(1, -1, 1, 1)
+        indices = np.random.RandomState(seed).choice(len(dataset), min(num_samples, len(dataset)), replace=False)
+        indices = np.sort(indices[rank::world_size])
+
+        if cache_file is not None and world_size > 1:
+            cache_file = f"{cache_file}.rank{rank}"
+        # indices are saved last, thus only exist for complete caches
+        if cache_file is not None and os.path.exists(f"{cache_file}.indices.npy"):
+            assert np.array_equal(np.load(f"{cache_file}.indices.npy"), indices), \
+                f"{cache_file} is not built with the same subset, remove it to rebuild"
+            images = np.load(f"{cache_file}.images.npy", mmap_mode="c")
+            labels = np.load(f"{cache_file}.labels.npy")
+        else:
+            images, labels = self._decode(dataset, indices, batch_size, num_workers, cache_file)
+        self.images = torch.from_numpy(images)
+        self.labels = torch.from_numpy(labels)
+
+    @staticmethod
+    def _decode(dataset, indices, batch_size, num_workers, cache_file):
+        loader = DataLoader(Subset(dataset, indices), batch_size=batch_size, num_workers=num_workers)
+        images = labels = None
+        start = 0
+        for img, label in loader:
+            assert img.dtype == torch.uint8, f"expect uint8 images, got {img.dtype}"
+            if images is None:
+                shape = (len(indices), ) + tuple(img.shape[1:])
+                if cache_file is not None:
+                    images = np.lib.format.open_memmap(f"{cache_file}.images.npy", mode="w+", dtype=np.uint8,
+                                                       shape=shape)
+                else:
+                    images = np.empty(shape, dtype=np.uint8)
+                labels = np.empty(len(indices), dtype=np.int64)
+            images[start:start + len(img)] = img.numpy()
+            labels[start:start + len(img)] = label.numpy()
+            start += len(img)
+        if cache_file is not None:
+            images.flush()
+            np.save(f"{cache_file}.labels.npy", labels)
+            np.save(f"{cache_file}.indices.npy", indices)
+        return images, labels
+
+    def __len__(self):
+        return -(-len(self.images) // self.batch_size)
+
+    def batches(self, device=None):
+        """Yields (normalized float images, labels) on `device`, images are moved as uint8."""
+        mean, std = self.mean.to(device), self.std.to(device)
+        for start in range(0, len(self.images), self.batch_size):
+            img = self.images[start:start + self.batch_size].to(device, non_blocking=True)
+            img = img.float().div_(255.).sub_(mean).div_(std)
+            yield img, self.labels[start:start + self.batch_size]
+
+    def __iter__(self):
+        return self.batches()
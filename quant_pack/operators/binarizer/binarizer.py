@@ -9,8 +9,9 @@ from quant_pack.operators.binarizer._C import binary_forward, binary_backward
 class BinaryFunc(Function):
 
     @staticmethod
-    def forward(ctx, x, lb, ub):
-        with torch.no_grad():
+    def forward(ctx, x, lb, ub, check_bounds=True):
+        if check_bounds:
+            # NOTE: this forces a device-to-host sync
             assert lb.lt(ub), f"invalid binarization range: lb={lb.max().item()}, ub={ub.min().item()}"
         x = x.contiguous()
         qx, mask_x = binary_forward(x, lb, ub)
@@ -19,7 +20,14 @@ class BinaryFunc(Function):
 
     @staticmethod
     def backward(ctx, dy):
-        dy = dy.clone()
-        mask_x = ctx.saved_tensors
+        mask_x, = ctx.saved_tensors
         dx, dlb, dub = binary_backward(dy, mask_x)
-        return dx, dlb, dub
+        return dx, dlb, dub, None
+
+
+def autograd_binary(x, lb, ub):
+    # reference implementation of `BinaryFunc` composed by autograd ops
+    with torch.no_grad():
+        assert lb.lt(ub), f"invalid binarization range: lb={lb.max().item()}, ub={ub.min().item()}"
+    qx = torch.where(x > 0., ub.expand_as(x), lb.expand_as(x))
+    return qx + (x - x.detach())
@@ -8,9 +8,13 @@ std::array<at::Tensor, 2> binary_forward(
   const at::Tensor &lb_t,
   const at::Tensor &ub_t) {
   if (x_t.type().is_cuda()) {
+#ifdef WITH_CUDA
     return binary_forward_cuda(x_t, lb_t, ub_t);
+#else
+    AT_ERROR("binarizer is not compiled with CUDA support");
+#endif
   } else {
-    AT_ERROR("binary forward CPU implementation is not ready yet");
+    return binary_forward_cpu(x_t, lb_t, ub_t);
   }
 }
 
@@ -18,9 +22,13 @@ std::array<at::Tensor, 3> binary_backward(
   const at::Tensor &dy_t,
   const at::Tensor &maskx_t) {
   if (dy_t.type().is_cuda()) {
+#ifdef WITH_CUDA
     return binary_backward_cuda(dy_t, maskx_t);
+#else
+    AT_ERROR("binarizer is not compiled with CUDA support");
+#endif
   } else {
-    AT_ERROR("binary backward CPU implementation is not ready yet");
+    return binary_backward_cpu(dy_t, maskx_t);
   }
 }
 
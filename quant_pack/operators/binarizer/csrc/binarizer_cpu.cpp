@@ -0,0 +1,86 @@
+#include <algorithm>
+#include <array>
+#include <vector>
+
+#include <ATen/ATen.h>
+#include <ATen/AccumulateType.h>
+#include <ATen/Parallel.h>
+#include <ATen/TensorUtils.h>
+
+#include "binarizer.hpp"
+
+// flags on mask_t (uint8_t), keep consistent with binarizer_cuda.cuh
+#define OUTLIER_UPPER    0x01
+#define OUTLIER_LOWER    0x02
+
+// number of elements reduced by a single task in backward
+const int64_t REDUCE_CHUNK_SIZE = 32768;
+
+std::array<at::Tensor, 2> binary_forward_cpu(
+  const at::Tensor &x_t,
+  const at::Tensor &lb_t,
+  const at::Tensor &ub_t) {
+  at::TensorArg x_t_{x_t, "x_t", 1},
+                lb_t_{lb_t, "lb_t", 2},
+                ub_t_{ub_t, "ub_t", 3};
+  at::CheckedFrom f{"binary_forward_cpu"};
+  at::checkDeviceType(f, {x_t, lb_t, ub_t}, at::DeviceType::CPU);
+  at::checkAllSameType(f, {x_t_, lb_t_, ub_t_});
+  at::checkSameDim(f, lb_t_, ub_t_);
+
+  auto upper = at::gt(x_t, 0.);
+  auto qx_t = at::where(upper, ub_t.expand_as(x_t), lb_t.expand_as(x_t));
+  auto maskx_t = at::full_like(x_t, OUTLIER_LOWER, x_t.options().dtype(at::kByte));
+  maskx_t.masked_fill_(upper, OUTLIER_UPPER);
+
+  return {qx_t, maskx_t};
+}
+
+std::array<at::Tensor, 3> binary_backward_cpu(
+  const at::Tensor &dy_t,
+  const at::Tensor &maskx_t) {
+  at::CheckedFrom f{"binary_backward_cpu"};
+  at::checkDeviceType(f, {dy_t, maskx_t}, at::DeviceType::CPU);
+
+  auto dy = dy_t.contiguous();
+  auto maskx = maskx_t.contiguous();
+  auto dx_t = dy.clone();
+  at::Tensor dlb, dub;
+
+  AT_DISPATCH_FLOATING_TYPES_AND_HALF(
+    dy.scalar_type(),
+    "binary_backward_cpu",
+    [&] () -> void {
+      using acc_t = at::acc_type<scalar_t, /*is_cuda=*/false>;
+      const scalar_t *dy_p = dy.data_ptr<scalar_t>();
+      const uint8_t *maskx_p = maskx.data_ptr<uint8_t>();
+      const int64_t numel = dy.numel();
+      const int64_t num_chunks = std::max<int64_t>((numel + REDUCE_CHUNK_SIZE - 1) / REDUCE_CHUNK_SIZE, 1);
+      std::vector<acc_t> dlb_partial(num_chunks), dub_partial(num_chunks);
+
+      at::parallel_for(0, num_chunks, 1, [&](int64_t begin, int64_t end) {
+        for (int64_t c = begin; c < end; ++c) {
+          acc_t dlb = 0, dub = 0;
+          for (int64_t idx = c * REDUCE_CHUNK_SIZE; idx < std::min((c + 1) * REDUCE_CHUNK_SIZE, numel); ++idx) {
+            const acc_t dy = static_cast<acc_t>(dy_p[idx]);
+            dlb += (maskx_p[idx] & OUTLIER_LOWER) ? dy : acc_t(0);
+            dub += (maskx_p[idx] & OUTLIER_UPPER) ? dy : acc_t(0);
+          }
+          dlb_partial[c] = dlb;
+          dub_partial[c] = dub;
+        }
+      });
+
+      // partial sums are combined in a fixed order, results are deterministic
+      acc_t dlb_sum = 0, dub_sum = 0;
+      for (int64_t c = 0; c < num_chunks; ++c) {
+        dlb_sum += dlb_partial[c];
+        dub_sum += dub_partial[c];
+      }
+      dlb = at::scalar_tensor(static_cast<scalar_t>(dlb_sum), dy.options());
+      dub = at::scalar_tensor(static_cast<scalar_t>(dub_sum), dy.options());
+    }
+  );
+
+  return {dx_t, dlb, dub};
+}
@@ -2,6 +2,7 @@
 #include <cmath>
 
 #include <ATen/ATen.h>
+#include <ATen/AccumulateType.h>
 #include <ATen/TensorUtils.h>
 #include <ATen/cuda/CUDAContext.h>
 #include <ATen/cuda/CUDAApplyUtils.cuh>
@@ -33,8 +34,6 @@ std::array<at::Tensor, 2> binary_forward_cuda(
   auto qx_t = at::zeros_like(x_t);
   auto maskx_t = at::zeros_like(x_t, x_t.options().dtype(at::kByte));
 
-  double lb = lb_t.item<double>(), ub = ub_t.item<double>();
-
   AT_DISPATCH_FLOATING_TYPES_AND_HALF(
     x_t.scalar_type(),
     "binary_forward",
@@ -42,11 +41,11 @@ std::array<at::Tensor, 2> binary_forward_cuda(
       binary_forward_kernel<scalar_t>
         <<<grid, block, 0, stream>>>(
           /*nthreads=*/output_size,
-          /*x_t=*/x_t.data<scalar_t>(),
-          /*lb=*/static_cast<scalar_t>(lb),
-          /*ub=*/static_cast<scalar_t>(ub),
-          /*qx_t=*/qx_t.data<scalar_t>(),
-          /*maskx_t=*/maskx_t.data<uint8_t>());
+          /*x_t=*/x_t.data_ptr<scalar_t>(),
+          /*lb_t=*/lb_t.data_ptr<scalar_t>(),
+          /*ub_t=*/ub_t.data_ptr<scalar_t>(),
+          /*qx_t=*/qx_t.data_ptr<scalar_t>(),
+          /*maskx_t=*/maskx_t.data_ptr<uint8_t>());
     }
   );
 
@@ -64,34 +63,39 @@ std::array<at::Tensor, 3> binary_backward_cuda(
   at::cuda::CUDAGuard device_guard(dy_t.device());
 
   const int output_size = dy_t.numel();
+  const int num_blocks = std::max(
+    std::min(at::cuda::ATenCeilDiv(output_size, REDUCE_THREADS_PER_BLOCK),
+             MAX_GRIDS_NUM), 1);
   cudaStream_t stream = at::cuda::getCurrentCUDAStream();
-  dim3 grid(std::min(at::cuda::ATenCeilDiv(output_size, THREADS_PER_BLOCK),
-                     MAX_GRIDS_NUM));
-  dim3 block(THREADS_PER_BLOCK);
+  dim3 grid(num_blocks);
+  dim3 block(REDUCE_THREADS_PER_BLOCK);
 
-  auto dx_t = at::zeros_like(dy_t);
-  auto dlb_buffer = at::zeros_like(dy_t);
-  auto dub_buffer = at::zeros_like(dy_t);
+  auto dy = dy_t.contiguous();
+  auto dx_t = at::empty_like(dy);
+  at::Tensor dlb, dub;
 
   AT_DISPATCH_FLOATING_TYPES_AND_HALF(
-    dy_t.scalar_type(),
+    dy.scalar_type(),
     "binary_backward",
     [&] () -> void {
-      binary_backward_kernel<scalar_t>
+      using acc_t = at::acc_type<scalar_t, /*is_cuda=*/true>;
+      // a few partial sums instead of input-sized buffers
+      auto partial_options = dy.options().dtype(c10::CppTypeToScalarType<acc_t>::value);
+      auto dlb_partial = at::empty({num_blocks}, partial_options);
+      auto dub_partial = at::empty({num_blocks}, partial_options);
+      binary_backward_reduce_kernel<scalar_t, acc_t>
         <<<grid, block, 0, stream>>>(
           /*nthreads=*/output_size,
-          /*dy_t=*/dy_t.data<scalar_t>(),
-          /*maskx_t=*/maskx_t.data<uint8_t>(),
-          /*dx_t=*/dx_t.data<scalar_t>(),
-          /*dlb_t=*/dlb_buffer.data<scalar_t>(),
-          /*dub_t=*/dub_buffer.data<scalar_t>());
+          /*dy_t=*/dy.data_ptr<scalar_t>(),
+          /*maskx_t=*/maskx_t.data_ptr<uint8_t>(),
+          /*dx_t=*/dx_t.data_ptr<scalar_t>(),
+          /*dlb_partial_t=*/dlb_partial.data_ptr<acc_t>(),
+          /*dub_partial_t=*/dub_partial.data_ptr<acc_t>());
+      dlb = dlb_partial.sum().to(dy.scalar_type());
+      dub = dub_partial.sum().to(dy.scalar_type());
     }
   );
 
-  at::Tensor dlb, dub;
-  dlb = dlb_buffer.sum();
-  dub = dub_buffer.sum();
-
   AT_CUDA_CHECK(cudaGetLastError());
   return {dx_t, dlb, dub};
 }
@@ -12,6 +12,8 @@
   const int THREADS_PER_BLOCK = 1024;
 #endif
 const int MAX_GRIDS_NUM = 4096;
+// fixed block size of reduction kernels, independent of the arch macro above
+const int REDUCE_THREADS_PER_BLOCK = 256;
 
 // flags on mask_t (uint8_t)
 #define OUTLIER_UPPER    0x01
@@ -21,10 +23,14 @@ template <typename T>
 __global__ void binary_forward_kernel(
   const int nthreads,
   const T *x_t,
-  const T lb,
-  const T ub,
+  const T *lb_t,
+  const T *ub_t,
   T *qx_t,
   uint8_t *maskx_t) {
+  // read bounds on device, avoid device-to-host sync
+  const T lb = *lb_t;
+  const T ub = *ub_t;
+
   CUDA_1D_KERNEL_LOOP(idx, nthreads) {
     T x = x_t[idx];
 
@@ -33,20 +39,49 @@ __global__ void binary_forward_kernel(
   }
 }
 
-template <typename T>
-__global__ void binary_backward_kernel(
+// sum up `val` over threads of a block, result is valid on thread 0
+template <typename AccT>
+__device__ AccT block_reduce_sum(AccT val, AccT *shared) {
+  shared[threadIdx.x] = val;
+  __syncthreads();
+  for (int s = blockDim.x / 2; s > 0; s >>= 1) {
+    if (threadIdx.x < s) {
+      shared[threadIdx.x] += shared[threadIdx.x + s];
+    }
+    __syncthreads();
+  }
+  return shared[0];
+}
+
+// computes `dx` and reduces `dlb` / `dub` in the same pass, each block writes
+// one partial sum
+template <typename T, typename AccT>
+__global__ void binary_backward_reduce_kernel(
   const int nthreads,
   const T *dy_t,
   const uint8_t *maskx_t,
   T *dx_t,
-  T *dlb_t,
-  T *dub_t) {
+  AccT *dlb_partial_t,
+  AccT *dub_partial_t) {
+  __shared__ AccT shared[REDUCE_THREADS_PER_BLOCK];
+  AccT dlb = 0, dub = 0;
+
   CUDA_1D_KERNEL_LOOP(idx, nthreads) {
-    T dy = dy_t[idx];
-    uint8_t maskx = maskx_t[idx];
+    const T dy = dy_t[idx];
+    const uint8_t maskx = maskx_t[idx];
 
     dx_t[idx] = dy;
-    dlb_t[idx] = dy * static_cast<T>(maskx & OUTLIER_LOWER);
-    dub_t[idx] = dy * static_cast<T>(maskx & OUTLIER_UPPER);
+    dlb += static_cast<AccT>(dy) * static_cast<AccT>((maskx & OUTLIER_LOWER) != 0);
+    dub += static_cast<AccT>(dy) * static_cast<AccT>((maskx & OUTLIER_UPPER) != 0);
+  }
+
+  dlb = block_reduce_sum(dlb, shared);
+  if (threadIdx.x == 0) {
+    dlb_partial_t[blockIdx.x] = dlb;
+  }
+  __syncthreads();
+  dub = block_reduce_sum(dub, shared);
+  if (threadIdx.x == 0) {
+    dub_partial_t[blockIdx.x] = dub;
   }
 }
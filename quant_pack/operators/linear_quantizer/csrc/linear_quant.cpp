@@ -11,10 +11,15 @@ std::array<at::Tensor, 3> linear_quant_forward(
   const bool align_zero,
   const bool channel_quant) {
   if (x_t.type().is_cuda()) {
+#ifdef WITH_CUDA
     return linear_quant_forward_cuda(x_t, lb_t, ub_t, bit_width, align_zero,
                                      channel_quant);
+#else
+    AT_ERROR("linear quant is not compiled with CUDA support");
+#endif
   } else {
-    AT_ERROR("linear quant CPU implementation is not ready yet");
+    return linear_quant_forward_cpu(x_t, lb_t, ub_t, bit_width, align_zero,
+                                    channel_quant);
   }
 }
 
@@ -27,10 +32,15 @@ std::array<at::Tensor, 3> linear_quant_backward(
   const bool align_zero,
   const bool channel_quant) {
   if (dy_t.type().is_cuda()) {
+#ifdef WITH_CUDA
     return linear_quant_backward_cuda(dy_t, di_t, maskx_t, sign_lb_t,
                                       bit_width, align_zero, channel_quant);
+#else
+    AT_ERROR("linear quant is not compiled with CUDA support");
+#endif
   } else {
-    AT_ERROR("linear quant CPU implementation is not ready yet");
+    return linear_quant_backward_cpu(dy_t, di_t, maskx_t, sign_lb_t,
+                                     bit_width, align_zero, channel_quant);
   }
 }
 
@@ -0,0 +1,177 @@
+#include <algorithm>
+#include <array>
+#include <cmath>
+#include <vector>
+
+#include <ATen/ATen.h>
+#include <ATen/AccumulateType.h>
+#include <ATen/Parallel.h>
+#include <ATen/TensorUtils.h>
+
+#include "linear_quant.hpp"
+
+// flags on mask_t (uint8_t), keep consistent with linear_quant_cuda.cuh
+#define OUTLIER_UPPER    0x01
+#define OUTLIER_LOWER    0x02
+
+// number of elements reduced by a single task in backward
+const int64_t REDUCE_CHUNK_SIZE = 32768;
+
+// reshape per-channel bounds (c_out, ) -> (c_out, 1, ...) so they broadcast
+// against 4D (c_out, c_in, k_h, k_w) or 2D (c_out, c_in) params
+static at::Tensor channel_view(const at::Tensor &t, const at::Tensor &x_t) {
+  std::vector<int64_t> shape(x_t.dim(), 1);
+  shape[0] = t.numel();
+  return t.reshape(shape);
+}
+
+std::array<at::Tensor, 3> linear_quant_forward_cpu(
+  const at::Tensor &x_t,
+  const at::Tensor &lb_t,
+  const at::Tensor &ub_t,
+  const int bit_width,
+  const bool align_zero,
+  const bool channel_quant) {
+  at::TensorArg x_t_{x_t, "x_t", 1},
+                lb_t_{lb_t, "lb_t", 2},
+                ub_t_{ub_t, "ub_t", 3};
+  at::CheckedFrom f{"linear_quant_forward_cpu"};
+  at::checkDeviceType(f, {x_t, lb_t, ub_t}, at::DeviceType::CPU);
+  at::checkAllSameType(f, {x_t_, lb_t_, ub_t_});
+  at::checkSameDim(f, lb_t_, ub_t_);
+
+  const double n = std::pow(2., bit_width) - 1.;
+  at::Tensor qx_t, di_t, maskx_t;
+
+  if (align_zero) {
+    TORCH_CHECK(!channel_quant || lb_t.numel() == 1,
+              "align_zero only supports per-tensor quantization");
+    // nudge quantization boundaries, host code in double precision
+    double eps = 1e-2;
+    double lb = lb_t.item<double>(), ub = ub_t.item<double>();
+    ub = std::max(lb + eps, ub);
+    double delta = (ub - lb) / n;
+    double zero_point = std::round(std::abs(lb) / delta);
+    double lb_nudged = (-zero_point) * delta;
+    double ub_nudged = (n - zero_point) * delta;
+
+    auto x_clamped = at::clamp(x_t, lb_nudged, ub_nudged);
+    auto i = at::round((x_clamped - lb_nudged) / delta).sub_(zero_point);
+    qx_t = i * delta;
+    di_t = i - (x_clamped - lb_nudged - std::abs(lb)) / delta;
+    maskx_t = (at::ge(x_t, lb_nudged) * at::le(x_t, ub_nudged)).to(at::kByte);
+
+  } else {
+    at::Tensor lb, ub, delta;
+    if (channel_quant) {
+      lb = channel_view(lb_t, x_t);
+      ub = channel_view(ub_t, x_t);
+      delta = (ub - lb) / n;
+    } else {
+      double lb_d = lb_t.item<double>(), ub_d = ub_t.item<double>();
+      lb = at::scalar_tensor(lb_d, x_t.options());
+      ub = at::scalar_tensor(ub_d, x_t.options());
+      delta = at::scalar_tensor((ub_d - lb_d) / n, x_t.options());
+    }
+
+    auto x_clamped = at::max(at::min(x_t, ub), lb);
+    auto i_real = (x_clamped - lb) / delta;
+    // `rint` in per-tensor CUDA kernel, `round` (half away from zero) in the
+    // per-channel one; `i_real` is non-negative so the latter is floor(i + .5)
+    auto i_round = channel_quant ? at::floor(i_real + 0.5) : at::round(i_real);
+    qx_t = i_round * delta + lb;
+    di_t = (i_round - i_real).div_(n);
+    maskx_t = at::gt(x_t, ub).to(at::kByte);
+    maskx_t.masked_fill_(at::lt(x_t, lb), OUTLIER_LOWER);
+  }
+
+  return {qx_t, di_t, maskx_t};
+}
+
+std::array<at::Tensor, 3> linear_quant_backward_cpu(
+  const at::Tensor &dy_t,
+  const at::Tensor &di_t,
+  const at::Tensor &maskx_t,
+  const at::Tensor &sign_lb_t,
+  const int bit_width,
+  const bool align_zero,
+  const bool channel_quant) {
+  at::CheckedFrom f{"linear_quant_backward_cpu"};
+  at::checkDeviceType(f, {dy_t, di_t, maskx_t}, at::DeviceType::CPU);
+
+  // one group per output channel, or the whole tensor; groups are further
+  // split into chunks so that per-tensor reduction runs in parallel too
+  const int64_t num_groups = channel_quant ? dy_t.size(0) : 1;
+  const int64_t group_size = dy_t.numel() / num_groups;
+  const int64_t chunk_size = std::min(group_size, REDUCE_CHUNK_SIZE);
+  const int64_t chunks_per_group = (group_size + chunk_size - 1) / chunk_size;
+
+  auto dy = dy_t.contiguous();
+  auto di = di_t.contiguous();
+  auto maskx = maskx_t.contiguous();
+  auto dx_t = at::empty_like(dy);
+  auto dlb_t = at::empty({num_groups}, dy.options());
+  auto dub_t = at::empty({num_groups}, dy.options());
+
+  AT_DISPATCH_FLOATING_TYPES_AND_HALF(
+    dy.scalar_type(),
+    "linear_quant_backward_cpu",
+    [&] () -> void {
+      using acc_t = at::acc_type<scalar_t, /*is_cuda=*/false>;
+      const scalar_t *dy_p = dy.data_ptr<scalar_t>();
+      const scalar_t *di_p = di.data_ptr<scalar_t>();
+      const uint8_t *maskx_p = maskx.data_ptr<uint8_t>();
+      scalar_t *dx_p = dx_t.data_ptr<scalar_t>();
+      const acc_t n = std::pow(2., bit_width) - 1.;
+      const acc_t sign_lb = align_zero ? sign_lb_t.item<acc_t>() : acc_t(0);
+      std::vector<acc_t> dlb_partial(num_groups * chunks_per_group);
+      std::vector<acc_t> dub_partial(num_groups * chunks_per_group);
+
+      at::parallel_for(0, num_groups * chunks_per_group, 1, [&](int64_t begin, int64_t end) {
+        for (int64_t task = begin; task < end; ++task) {
+          const int64_t g = task / chunks_per_group;
+          const int64_t lo = g * group_size + (task % chunks_per_group) * chunk_size;
+          const int64_t hi = std::min(lo + chunk_size, (g + 1) * group_size);
+          acc_t dlb = 0, dub = 0;
+          for (int64_t idx = lo; idx < hi; ++idx) {
+            const uint8_t mask = maskx_p[idx];
+            const scalar_t dy = dy_p[idx];
+            const acc_t dy_acc = static_cast<acc_t>(dy);
+            const acc_t d_diff = dy_acc * static_cast<acc_t>(di_p[idx]);
+            if (align_zero) {
+              dx_p[idx] = mask ? dy : scalar_t(0);
+              dub += d_diff / n;
+              dlb -= d_diff / n + dy_acc * sign_lb;
+            } else {
+              dx_p[idx] = mask == 0 ? dy : scalar_t(0);
+              dlb += ((mask & OUTLIER_LOWER) ? dy_acc : acc_t(0)) - d_diff;
+              dub += ((mask & OUTLIER_UPPER) ? dy_acc : acc_t(0)) + d_diff;
+            }
+          }
+          dlb_partial[task] = dlb;
+          dub_partial[task] = dub;
+        }
+      });
+
+      // partial sums are combined in a fixed order, results are deterministic
+      scalar_t *dlb_p = dlb_t.data_ptr<scalar_t>();
+      scalar_t *dub_p = dub_t.data_ptr<scalar_t>();
+      for (int64_t g = 0; g < num_groups; ++g) {
+        acc_t dlb = 0, dub = 0;
+        for (int64_t c = 0; c < chunks_per_group; ++c) {
+          dlb += dlb_partial[g * chunks_per_group + c];
+          dub += dub_partial[g * chunks_per_group + c];
+        }
+        dlb_p[g] = static_cast<scalar_t>(dlb);
+        dub_p[g] = static_cast<scalar_t>(dub);
+      }
+    }
+  );
+
+  if (!channel_quant) {
+    dlb_t = dlb_t.squeeze(0);
+    dub_t = dub_t.squeeze(0);
+  }
+
+  return {dx_t, dlb_t, dub_t};
+}
@@ -2,6 +2,7 @@
 #include <cmath>
 
 #include <ATen/ATen.h>
+#include <ATen/AccumulateType.h>
 #include <ATen/TensorUtils.h>
 #include <ATen/cuda/CUDAContext.h>
 #include <ATen/cuda/CUDAApplyUtils.cuh>
@@ -46,17 +47,8 @@ std::array<at::Tensor, 3> linear_quant_forward_cuda(
   auto di_t = at::zeros_like(x_t);
   auto maskx_t = at::zeros_like(x_t, x_t.options().dtype(at::kByte));
 
+  const double n = std::pow(2., bit_width) - 1.;
   if (align_zero) {
-    // nudge quantization boundaries, host code in double precision
-    double eps = 1e-2;
-    double lb = lb_t.item<double>(), ub = ub_t.item<double>();
-    ub = std::max(lb + eps, ub);
-    double n = std::pow(2., bit_width) - 1.;
-    double delta = (ub - lb) / n;
-    double zero_point = std::round(std::abs(lb) / delta);
-    double lb_nudged = (-zero_point) * delta;
-    double ub_nudged = (n - zero_point) * delta;
-
     AT_DISPATCH_FLOATING_TYPES_AND_HALF(
       x_t.scalar_type(),
       "linear_quant_align_zero_forward",
@@ -64,61 +56,53 @@ std::array<at::Tensor, 3> linear_quant_forward_cuda(
         linear_quant_align_zero_forward_kernel<scalar_t>
           <<<grid, block, 0, stream>>>(
             /*nthreads=*/output_size,
-            /*x_t=*/x_t.data<scalar_t>(),
-            /*delta=*/static_cast<scalar_t>(delta),
-            /*zero_point=*/static_cast<scalar_t>(zero_point),
-            /*lb=*/static_cast<scalar_t>(lb),
-            /*lb_nudged=*/static_cast<scalar_t>(lb_nudged),
-            /*ub_nudged=*/static_cast<scalar_t>(ub_nudged),
-            /*qx_t=*/qx_t.data<scalar_t>(),
-            /*di_t=*/di_t.data<scalar_t>(),
-            /*maskx_t*/maskx_t.data<uint8_t>());
+            /*x_t=*/x_t.data_ptr<scalar_t>(),
+            /*lb_t=*/lb_t.data_ptr<scalar_t>(),
+            /*ub_t=*/ub_t.data_ptr<scalar_t>(),
+            /*n=*/n,
+            /*qx_t=*/qx_t.data_ptr<scalar_t>(),
+            /*di_t=*/di_t.data_ptr<scalar_t>(),
+            /*maskx_t*/maskx_t.data_ptr<uint8_t>());
+      }
+    );
+
+  } else if (channel_quant) {
+    AT_DISPATCH_FLOATING_TYPES_AND_HALF(
+      x_t.scalar_type(),
+      "linear_channel_quant_forward",
+      [&] () -> void {
+        linear_channel_quant_forward_kernel<scalar_t>
+          <<<grid, block, 0, stream>>>(
+            /*nthreads=*/output_size,
+            /*num_channels=*/num_channels,
+            /*spatial_size=*/spatial_size,
+            /*x_t=*/x_t.data_ptr<scalar_t>(),
+            /*lb_t=*/lb_t.data_ptr<scalar_t>(),
+            /*ub_t=*/ub_t.data_ptr<scalar_t>(),
+            /*quant_levels=*/static_cast<scalar_t>(n),
+            /*qx_t=*/qx_t.data_ptr<scalar_t>(),
+            /*diff_i_t=*/di_t.data_ptr<scalar_t>(),
+            /*maskx_t=*/maskx_t.data_ptr<uint8_t>());
       }
     );
 
   } else {
-    double n = std::pow(2., bit_width) - 1.;
-    if (channel_quant) {
-      AT_DISPATCH_FLOATING_TYPES_AND_HALF(
-        x_t.scalar_type(),
-        "linear_channel_quant_forward",
-        [&] () -> void {
-          linear_channel_quant_forward_kernel<scalar_t>
-            <<<grid, block, 0, stream>>>(
-              /*nthreads=*/output_size,
-              /*num_channels=*/num_channels,
-              /*spatial_size=*/spatial_size,
-              /*x_t=*/x_t.data<scalar_t>(),
-              /*lb_t=*/lb_t.data<scalar_t>(),
-              /*ub_t=*/ub_t.data<scalar_t>(),
-              /*quant_levels=*/static_cast<scalar_t>(n),
-              /*qx_t=*/qx_t.data<scalar_t>(),
-              /*diff_i_t=*/di_t.data<scalar_t>(),
-              /*maskx_t=*/maskx_t.data<uint8_t>());
-        }
-      );
-
-    } else {
-      double lb = lb_t.item<double>(), ub = ub_t.item<double>();
-      double delta = (ub - lb) / n;
-      AT_DISPATCH_FLOATING_TYPES_AND_HALF(
-        x_t.scalar_type(),
-        "linear_quant_forward",
-        [&] () -> void {
-          linear_quant_forward_kernel<scalar_t>
-            <<<grid, block, 0, stream>>>(
-              /*nthreads=*/output_size,
-              /*x_t=*/x_t.data<scalar_t>(),
-              /*delta=*/static_cast<scalar_t>(delta),
-              /*lb=*/static_cast<scalar_t>(lb),
-              /*ub=*/static_cast<scalar_t>(ub),
-              /*n=*/static_cast<scalar_t>(n),
-              /*qx_t=*/qx_t.data<scalar_t>(),
-              /*diff_i_t=*/di_t.data<scalar_t>(),
-              /*maskx_t=*/maskx_t.data<uint8_t>());
-        }
-      );
-    }
+    AT_DISPATCH_FLOATING_TYPES_AND_HALF(
+      x_t.scalar_type(),
+      "linear_quant_forward",
+      [&] () -> void {
+        linear_quant_forward_kernel<scalar_t>
+          <<<grid, block, 0, stream>>>(
+            /*nthreads=*/output_size,
+            /*x_t=*/x_t.data_ptr<scalar_t>(),
+            /*lb_t=*/lb_t.data_ptr<scalar_t>(),
+            /*ub_t=*/ub_t.data_ptr<scalar_t>(),
+            /*quant_levels=*/n,
+            /*qx_t=*/qx_t.data_ptr<scalar_t>(),
+            /*diff_i_t=*/di_t.data_ptr<scalar_t>(),
+            /*maskx_t=*/maskx_t.data_ptr<uint8_t>());
+      }
+    );
   }
 
   AT_CUDA_CHECK(cudaGetLastError());
@@ -141,63 +125,49 @@ std::array<at::Tensor, 3> linear_quant_backward_cuda(
 
   at::cuda::CUDAGuard device_guard(dy_t.device());
 
-  const int output_size = dy_t.numel();
+  // one group per output channel, or the whole tensor
+  const int num_groups = channel_quant ? dy_t.size(0) : 1;
+  const int group_size = dy_t.numel() / num_groups;
+  const int blocks_per_group = std::max(
+    std::min(at::cuda::ATenCeilDiv(group_size, REDUCE_THREADS_PER_BLOCK),
+             MAX_GRIDS_NUM / num_groups), 1);
   cudaStream_t stream = at::cuda::getCurrentCUDAStream();
-  dim3 grid(std::min(at::cuda::ATenCeilDiv(output_size, THREADS_PER_BLOCK),
-                     MAX_GRIDS_NUM));
-  dim3 block(THREADS_PER_BLOCK);
+  dim3 grid(blocks_per_group, num_groups);
+  dim3 block(REDUCE_THREADS_PER_BLOCK);
 
-  auto dx_t = at::zeros_like(dy_t);
-  auto dlb_buffer = at::zeros_like(dy_t);
-  auto dub_buffer = at::zeros_like(dy_t);
-
-  if (align_zero) {
-    AT_DISPATCH_FLOATING_TYPES_AND_HALF(
-      dy_t.scalar_type(),
-      "linear_quant_align_zero_backward",
-      [&] () -> void {
-        linear_quant_align_zero_backward_kernel<scalar_t>
-          <<<grid, block, 0, stream>>>(
-            /*nthreads=*/output_size,
-            /*dy_t=*/dy_t.data<scalar_t>(),
-            /*di_t=*/di_t.data<scalar_t>(),
-            /*maskx_t=*/maskx_t.data<uint8_t>(),
-            /*n=*/static_cast<scalar_t>(std::pow(2., bit_width) - 1.),
-            /*sign_lb=*/sign_lb_t.item<scalar_t>(),
-            /*dx_t=*/dx_t.data<scalar_t>(),
-            /*dlb_t=*/dlb_buffer.data<scalar_t>(),
-            /*dub_t=*/dub_buffer.data<scalar_t>());
-      }
-    );
+  auto dy = dy_t.contiguous();
+  auto dx_t = at::empty_like(dy);
+  at::Tensor dlb, dub;
 
-  } else {
-    AT_DISPATCH_FLOATING_TYPES_AND_HALF(
-      dy_t.scalar_type(),
-      "linear_quant_backward",
-      [&] () -> void {
-        linear_quant_backward_kernel<scalar_t>
-          <<<grid, block, 0, stream>>>(
-            /*nthreads=*/output_size,
-            /*dy_t=*/dy_t.data<scalar_t>(),
-            /*diff_i_t=*/di_t.data<scalar_t>(),
-            /*maskx_t=*/maskx_t.data<uint8_t>(),
-            /*dx_t=*/dx_t.data<scalar_t>(),
-            /*dlb_t=*/dlb_buffer.data<scalar_t>(),
-            /*dub_t=*/dub_buffer.data<scalar_t>());
-      }
-    );
-  }
+  AT_DISPATCH_FLOATING_TYPES_AND_HALF(
+    dy.scalar_type(),
+    "linear_quant_backward",
+    [&] () -> void {
+      using acc_t = at::acc_type<scalar_t, /*is_cuda=*/true>;
+      // a few partial sums per group instead of input-sized buffers
+      auto partial_options = dy.options().dtype(c10::CppTypeToScalarType<acc_t>::value);
+      auto dlb_partial = at::empty({num_groups, blocks_per_group}, partial_options);
+      auto dub_partial = at::empty({num_groups, blocks_per_group}, partial_options);
+      linear_quant_backward_reduce_kernel<scalar_t, acc_t>
+        <<<grid, block, 0, stream>>>(
+          /*group_size=*/group_size,
+          /*dy_t=*/dy.data_ptr<scalar_t>(),
+          /*di_t=*/di_t.data_ptr<scalar_t>(),
+          /*maskx_t=*/maskx_t.data_ptr<uint8_t>(),
+          /*sign_lb_t=*/sign_lb_t.data_ptr<scalar_t>(),
+          /*n=*/static_cast<acc_t>(std::pow(2., bit_width) - 1.),
+          /*align_zero=*/align_zero,
+          /*dx_t=*/dx_t.data_ptr<scalar_t>(),
+          /*dlb_partial_t=*/dlb_partial.data_ptr<acc_t>(),
+          /*dub_partial_t=*/dub_partial.data_ptr<acc_t>());
+      dlb = dlb_partial.sum(/*dim=*/1).to(dy.scalar_type());
+      dub = dub_partial.sum(/*dim=*/1).to(dy.scalar_type());
+    }
+  );
 
-  at::Tensor dlb, dub;
-  if (channel_quant && dx_t.dim() == 4) {
-    dlb = dlb_buffer.sum(/*dim=*/{1, 2, 3});
-    dub = dub_buffer.sum(/*dim=*/{1, 2, 3});
-  } else if (channel_quant && dx_t.dim() == 2) {
-    dlb = dlb_buffer.sum(/*dim=*/{1});
-    dub = dub_buffer.sum(/*dim=*/{1});
-  } else {
-    dlb = dlb_buffer.sum();
-    dub = dub_buffer.sum();
+  if (!channel_quant) {
+    dlb = dlb.squeeze(0);
+    dub = dub.squeeze(0);
   }
 
   AT_CUDA_CHECK(cudaGetLastError());
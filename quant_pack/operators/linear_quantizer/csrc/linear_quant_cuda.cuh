@@ -12,23 +12,37 @@
   const int THREADS_PER_BLOCK = 1024;
 #endif
 const int MAX_GRIDS_NUM = 4096;
+// fixed block size of reduction kernels, independent of the arch macro above
+const int REDUCE_THREADS_PER_BLOCK = 256;
 
 // flags on mask_t (uint8_t)
 #define OUTLIER_UPPER    0x01
 #define OUTLIER_LOWER    0x02
 
+// quantization params are derived from `lb_t` / `ub_t` on device in double
+// precision, same as host code did before, so no device-to-host sync occurs
 template <typename T>
 __global__ void linear_quant_align_zero_forward_kernel(
   const int nthreads,
   const T *x_t,
-  const T delta,
-  const T zero_point,
-  const T lb,
-  const T lb_nudged,
-  const T ub_nudged,
+  const T *lb_t,
+  const T *ub_t,
+  const double n,
   T *qx_t,
   T *di_t,
   uint8_t *maskx_t) {
+  // nudge quantization boundaries
+  const double eps = 1e-2;
+  const double lb_d = static_cast<double>(*lb_t);
+  const double ub_d = max(lb_d + eps, static_cast<double>(*ub_t));
+  const double delta_d = (ub_d - lb_d) / n;
+  const double zero_point_d = round(abs(lb_d) / delta_d);
+  const T delta = static_cast<T>(delta_d);
+  const T zero_point = static_cast<T>(zero_point_d);
+  const T lb = static_cast<T>(lb_d);
+  const T lb_nudged = static_cast<T>((-zero_point_d) * delta_d);
+  const T ub_nudged = static_cast<T>((n - zero_point_d) * delta_d);
+
   CUDA_1D_KERNEL_LOOP(idx, nthreads) {
     const T x = x_t[idx];
     T x_clamped = CLAMP(x, lb_nudged, ub_nudged);
@@ -40,40 +54,21 @@ __global__ void linear_quant_align_zero_forward_kernel(
   }
 }
 
-template <typename T>
-__global__ void linear_quant_align_zero_backward_kernel(
-  const int nthreads,
-  const T *dy_t,
-  const T *di_t,
-  const uint8_t *maskx_t,
-  const T n,
-  const T sign_lb,
-  T *dx_t,
-  T *dlb_t,
-  T *dub_t) {
-  CUDA_1D_KERNEL_LOOP(idx, nthreads) {
-    T dy = dy_t[idx], di = di_t[idx];
-    T ddelta = dy * di;
-    T dub = ddelta / n;
-    T dlb = - dub - dy * sign_lb;
-
-    dx_t[idx] = dy * static_cast<T>(maskx_t[idx]);
-    dlb_t[idx] = dlb;
-    dub_t[idx] = dub;
-  }
-}
-
 template <typename T>
 __global__ void linear_quant_forward_kernel(
   const int nthreads,
   const T *x_t,
-  const T delta,
-  const T lb,
-  const T ub,
-  const T n,
+  const T *lb_t,
+  const T *ub_t,
+  const double quant_levels,
   T *qx_t,
   T *diff_i_t,
   uint8_t *maskx_t) {
+  const T lb = *lb_t;
+  const T ub = *ub_t;
+  const T delta = static_cast<T>((static_cast<double>(ub) - static_cast<double>(lb)) / quant_levels);
+  const T n = static_cast<T>(quant_levels);
+
   CUDA_1D_KERNEL_LOOP(idx, nthreads) {
     const T x = x_t[idx];
     T x_clamped = CLAMP(x, lb, ub);
@@ -94,27 +89,6 @@ __global__ void linear_quant_forward_kernel(
   }
 }
 
-template <typename T>
-__global__ void linear_quant_backward_kernel(
-  const int nthreads,
-  const T *dy_t,
-  const T *diff_i_t,
-  const uint8_t *maskx_t,
-  T *dx_t,
-  T *dlb_t,
-  T *dub_t) {
-  CUDA_1D_KERNEL_LOOP(idx, nthreads) {
-    const uint8_t maskx = maskx_t[idx];
-    const T dy = dy_t[idx], diff_i = diff_i_t[idx];
-    T not_outlier = !((maskx & OUTLIER_LOWER) || (maskx & OUTLIER_UPPER));
-    T d_diff = dy * diff_i;
-
-    dx_t[idx] = dy * not_outlier;
-    dlb_t[idx] = dy * static_cast<T>(maskx & OUTLIER_LOWER) - d_diff;
-    dub_t[idx] = dy * static_cast<T>(maskx & OUTLIER_UPPER) + d_diff;
-  }
-}
-
 template <typename T>
 __global__ void linear_channel_quant_forward_kernel(
   const int numel,
@@ -150,3 +124,65 @@ __global__ void linear_channel_quant_forward_kernel(
     }
   }
 }
+
+// sum up `val` over threads of a block, result is valid on thread 0
+template <typename AccT>
+__device__ AccT block_reduce_sum(AccT val, AccT *shared) {
+  shared[threadIdx.x] = val;
+  __syncthreads();
+  for (int s = blockDim.x / 2; s > 0; s >>= 1) {
+    if (threadIdx.x < s) {
+      shared[threadIdx.x] += shared[threadIdx.x + s];
+    }
+    __syncthreads();
+  }
+  return shared[0];
+}
+
+// computes `dx` and reduces `dlb` / `dub` in the same pass, blockIdx.y
+// indexes the group (channel) and each block writes one partial sum per group
+template <typename T, typename AccT>
+__global__ void linear_quant_backward_reduce_kernel(
+  const int group_size,
+  const T *dy_t,
+  const T *di_t,
+  const uint8_t *maskx_t,
+  const T *sign_lb_t,
+  const AccT n,
+  const bool align_zero,
+  T *dx_t,
+  AccT *dlb_partial_t,
+  AccT *dub_partial_t) {
+  __shared__ AccT shared[REDUCE_THREADS_PER_BLOCK];
+  const int offset = blockIdx.y * group_size;
+  const AccT sign_lb = align_zero ? static_cast<AccT>(*sign_lb_t) : AccT(0);
+  AccT dlb = 0, dub = 0;
+
+  CUDA_1D_KERNEL_LOOP(i, group_size) {
+    const int idx = offset + i;
+    const uint8_t maskx = maskx_t[idx];
+    const T dy = dy_t[idx];
+    const AccT dy_acc = static_cast<AccT>(dy);
+    const AccT d_diff = dy_acc * static_cast<AccT>(di_t[idx]);
+    if (align_zero) {
+      dx_t[idx] = dy * static_cast<T>(maskx);
+      dub += d_diff / n;
+      dlb -= d_diff / n + dy_acc * sign_lb;
+    } else {
+      dx_t[idx] = dy * static_cast<T>(maskx == 0);
+      dlb += dy_acc * static_cast<AccT>((maskx & OUTLIER_LOWER) != 0) - d_diff;
+      dub += dy_acc * static_cast<AccT>((maskx & OUTLIER_UPPER) != 0) + d_diff;
+    }
+  }
+
+  const int partial_idx = blockIdx.y * gridDim.x + blockIdx.x;
+  dlb = block_reduce_sum(dlb, shared);
+  if (threadIdx.x == 0) {
+    dlb_partial_t[partial_idx] = dlb;
+  }
+  __syncthreads();
+  dub = block_reduce_sum(dub, shared);
+  if (threadIdx.x == 0) {
+    dub_partial_t[partial_idx] = dub;
+  }
+}
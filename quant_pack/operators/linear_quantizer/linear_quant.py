@@ -9,23 +9,34 @@ from quant_pack.operators.linear_quantizer._C import linear_quant_forward, linea
 class LinearQuantFunc(Function):
 
     @staticmethod
-    def forward(ctx, x, lb, ub, bit_width, align_zero):
-        with torch.no_grad():
+    def forward(ctx, x, lb, ub, bit_width, align_zero, low_memory=False, check_bounds=True):
+        if check_bounds:
+            # NOTE: this forces a device-to-host sync
             assert lb.lt(ub).all(), f"invalid quantization range: lb={lb.max().item()}, ub={ub.min().item()}"
         x = x.contiguous()
         channel_quant = lb.dim() > 0
         qx, di, mask_x = linear_quant_forward(x, lb, ub, bit_width, align_zero, channel_quant)
-        ctx.save_for_backward(di, mask_x, lb.sign())
-        ctx.cfg = (bit_width, align_zero, channel_quant)
+        if low_memory:
+            # `x` is kept alive by its producer in most cases (parameters, ReLU
+            # outputs), so only referencing it here is much cheaper than saving
+            # the float `di` and byte `mask_x`, both are recomputed in backward
+            ctx.save_for_backward(x, lb, ub)
+        else:
+            ctx.save_for_backward(di, mask_x, lb.sign())
+        ctx.cfg = (bit_width, align_zero, channel_quant, low_memory)
         return qx
 
     @staticmethod
     def backward(ctx, dy):
-        dy = dy.clone()
-        di, mask_x, sign_lb = ctx.saved_tensors
-        bit_width, align_zero, channel_quant = ctx.cfg
+        bit_width, align_zero, channel_quant, low_memory = ctx.cfg
+        if low_memory:
+            x, lb, ub = ctx.saved_tensors
+            _, di, mask_x = linear_quant_forward(x, lb, ub, bit_width, align_zero, channel_quant)
+            sign_lb = lb.sign()
+        else:
+            di, mask_x, sign_lb = ctx.saved_tensors
         dx, dlb, dub = linear_quant_backward(dy, di, mask_x, sign_lb, bit_width, align_zero, channel_quant)
-        return dx, dlb, dub, None, None
+        return dx, dlb, dub, None, None, None, None
 
 
 class RoundSTE(Function):
@@ -64,9 +75,20 @@ class AlignZeroSTE(Function):
 
 
 def autograd_linear_quant(x, lb, ub, bit_width, align_zero):
+    # reference implementation of `LinearQuantFunc` composed by autograd ops, its
+    # gradients w.r.t. `x`, `lb` and `ub` are identical to the extension kernels
     with torch.no_grad():
         assert lb.lt(ub).all(), f"invalid quantization range: lb={lb.max().item()}, ub={ub.min().item()}"
-        n = 2 ** bit_width - 1
-        delta = (ub - lb) / n
+    n = 2 ** bit_width - 1
+    delta = (ub - lb) / n
     if align_zero:
-        lb, ub, zp = AlignZeroSTE.apply(lb, ub, delta, n)
+        with torch.no_grad():
+            zero_point = lb.abs().div(delta).round()
+            lb_nudged = zero_point.neg() * delta
+            ub_nudged = (n - zero_point) * delta
+        x_clamped = torch.max(torch.min(x, ub_nudged), lb_nudged)
+        qx = delta * (RoundSTE.apply((x_clamped - lb_nudged) / delta) - RoundSTE.apply(lb.abs() / delta))
+    else:
+        x_clamped = torch.max(torch.min(x, ub), lb)
+        qx = RoundSTE.apply((x_clamped - lb) / delta) * delta + lb
+    return qx
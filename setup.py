@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
 
-from setuptools import setup, find_packages
+import os
 
-from torch.utils.cpp_extension import BuildExtension, CUDAExtension
+import torch
+from setuptools import setup, find_packages
+from torch.utils.cpp_extension import BuildExtension, CppExtension, CUDAExtension, CUDA_HOME
 
 
 def _get_requirements():
@@ -13,7 +15,22 @@ def _get_requirements():
     return requirements
 
 
-# TODO: add check for CUDA availability
+def _make_extension(name, csrc_dir, sources, cuda_sources):
+    if (torch.cuda.is_available() and CUDA_HOME is not None) or os.getenv("FORCE_CUDA", "0") == "1":
+        extension = CUDAExtension
+        sources = sources + cuda_sources
+        define_macros = [("WITH_CUDA", None)]
+    else:
+        extension = CppExtension
+        define_macros = []
+    return extension(
+        name=name,
+        sources=[os.path.join(csrc_dir, src) for src in sources],
+        include_dirs=[csrc_dir],
+        define_macros=define_macros,
+    )
+
+
 setup(
     name="quant_pack",
     version="0.1.1",
@@ -22,27 +39,17 @@ setup(
     description="codebase for neural network quant research",
     packages=find_packages(exclude=("configs", "tests", "tools")),
     ext_modules=[
-        CUDAExtension(
+        _make_extension(
             name="quant_pack.operators.linear_quantizer._C",
-            sources=[
-                "quant_pack/operators/linear_quantizer/csrc/linear_quant.cpp",
-                "quant_pack/operators/linear_quantizer/csrc/linear_quant_cuda.cu",
-            ],
-            include_dirs=[
-                "quant_pack/operators/linear_quantizer/csrc",
-            ],
-            define_macros=[("WITH_CUDA", None)],
+            csrc_dir="quant_pack/operators/linear_quantizer/csrc",
+            sources=["linear_quant.cpp", "linear_quant_cpu.cpp"],
+            cuda_sources=["linear_quant_cuda.cu"],
         ),
-        CUDAExtension(
+        _make_extension(
             name="quant_pack.operators.binarizer._C",
-            sources=[
-                "quant_pack/operators/binarizer/csrc/binarizer.cpp",
-                "quant_pack/operators/binarizer/csrc/binarizer_cuda.cu",
-            ],
-            include_dirs=[
-                "quant_pack/operators/binarizer/csrc",
-            ],
-            define_macros=[("WITH_CUDA", None)],
+            csrc_dir="quant_pack/operators/binarizer/csrc",
+            sources=["binarizer.cpp", "binarizer_cpu.cpp"],
+            cuda_sources=["binarizer_cuda.cu"],
         ),
     ],
     cmdclass={"build_ext": BuildExtension},
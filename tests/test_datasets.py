@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+import torch
+from torchvision import datasets, transforms
+
+from quant_pack.datasets import CalibrationStore
+from quant_pack.datasets.calibration import split_uint8_transform
+
+SEED = 19260817
+
+
+def test_calibration_store(tmp_path):
+    normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+    eval_trans = transforms.Compose([transforms.CenterCrop(24), transforms.ToTensor(), normalize])
+    uint8_trans, (mean, std) = split_uint8_transform(eval_trans)
+    dataset = datasets.FakeData(64, (3, 32, 32), transform=uint8_trans, random_offset=SEED)
+    ref_set = datasets.FakeData(64, (3, 32, 32), transform=eval_trans, random_offset=SEED)
+
+    stores = [CalibrationStore(dataset, 20, 8, mean, std, seed=SEED, cache_file=str(tmp_path / "calib"))
+              for _ in range(2)]  # the 2nd one is loaded from the cache file
+    assert isinstance(stores[1].images, torch.Tensor) and stores[1].images.dtype == torch.uint8
+    assert stores[0].images.shape == (20, 3, 24, 24)
+    assert torch.equal(stores[0].images, stores[1].images)
+
+    batches = list(stores[1].batches())
+    assert [len(img) for img, _ in batches] == [8, 8, 4]
+    indices = np.sort(np.random.RandomState(SEED).choice(64, 20, replace=False))
+    img, label = batches[0]
+    # the seeded subset, normalized the same as the eval transform
+    ref_img, ref_label = ref_set[indices[0]]
+    assert torch.allclose(img[0], ref_img, atol=1e-5) and label[0].item() == ref_label
+
+
+def test_calibration_store_cache_subset(tmp_path):
+    dataset = datasets.FakeData(64, (3, 8, 8), transform=transforms.PILToTensor(), random_offset=SEED)
+    cache_file = str(tmp_path / "calib")
+    CalibrationStore(dataset, 20, 8, (0., ), (1., ), seed=SEED, cache_file=cache_file)
+    # the same number of samples, but another subset
+    with pytest.raises(AssertionError):
+        CalibrationStore(dataset, 20, 8, (0., ), (1., ), seed=SEED + 1, cache_file=cache_file)
+    # an incomplete cache is rebuilt
+    (tmp_path / "calib.indices.npy").unlink()
+    store = CalibrationStore(dataset, 20, 8, (0., ), (1., ), seed=SEED + 1, cache_file=cache_file)
+    indices = np.sort(np.random.RandomState(SEED + 1).choice(64, 20, replace=False))
+    assert torch.equal(store.images[0], dataset[indices[0]][0])
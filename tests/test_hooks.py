@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from quant_pack.core.quant.config import QuantMode
+from quant_pack.core.wrapper.hook.activation_builder import SaveActivationBuilder
+from quant_pack.core.wrapper.hook.activation_store import ActivationStore
+from quant_pack.core.wrapper.hook.offload import AsyncOffloader
+from quant_pack.core.wrapper.hook.runtime_hook import RuntimeHook
+from quant_pack.core.wrapper.hook.activation_post_process import conv2d_input_weight_analysis, \
+    fc_input_weight_analysis
+
+SEED = 19260817
+
+torch.manual_seed(SEED)
+
+
+def _concat_mean_std(input_rows, weight_rows):
+    # reference: rows of (N, ..., R) and (C, R) expanded to (N, C, ..., 2R)
+    input_rows = input_rows.unsqueeze(1).expand(-1, weight_rows.size(0), *input_rows.shape[1:])
+    weight_rows = weight_rows.view(1, weight_rows.size(0), *(1, ) * (input_rows.dim() - 3), -1) \
+        .expand(*input_rows.shape)
+    rows = torch.cat([input_rows, weight_rows], dim=-1)
+    return rows.mean(dim=-1), rows.std(dim=-1)
+
+
+def test_conv2d_input_weight_analysis():
+    input_err, weight_err = torch.randn(2, 3, 7, 7), torch.randn(5, 3, 3, 3)
+    mean, std = conv2d_input_weight_analysis(input_err, weight_err, 3, padding=1, stride=2)
+    cols = F.unfold(input_err, 3, padding=1, stride=2).transpose(1, 2)
+    ref_mean, ref_std = _concat_mean_std(cols, weight_err.reshape(5, -1))
+    assert mean.shape == (2, 5, 16)
+    assert torch.allclose(mean, ref_mean, atol=1e-6)
+    assert torch.allclose(std, ref_std, atol=1e-5)
+
+
+def test_fc_input_weight_analysis():
+    input_err, weight_err = torch.randn(4, 10), torch.randn(6, 10)
+    mean, std = fc_input_weight_analysis(input_err, weight_err)
+    ref_mean, ref_std = _concat_mean_std(input_err, weight_err)
+    assert mean.shape == (4, 6)
+    assert torch.allclose(mean, ref_mean, atol=1e-6)
+    assert torch.allclose(std, ref_std, atol=1e-5)
+
+
+def test_runtime_hook_lazy_attach():
+    model = nn.Sequential(nn.Conv2d(3, 4, 3), nn.ReLU())
+    runtime_hook = RuntimeHook(2, [dict(name="act", type="SaveActivation",
+                                        args=dict(need_reg=True, target_cls="Conv2d", inject_at_mode="fp",
+                                                  var_names=[]))])
+    runner = SimpleNamespace(model=SimpleNamespace(module=model), inner_iter=0)
+    runtime_hook.before_run(runner)
+    for i in range(4):
+        runner.inner_iter = i
+        runtime_hook.before_iter(runner)
+        enabled = i % 2 == 1
+        assert bool(model[0]._forward_hooks) == bool(model[0]._forward_pre_hooks) == enabled
+        assert not model[1]._forward_hooks
+        runtime_hook.update_hooks(QuantMode.FWFA)
+        model(torch.randn(1, 3, 5, 5))
+        assert ("0" in runtime_hook.hook_regs["act"]) == enabled
+        runtime_hook.hook_regs["act"].clear()
+        runtime_hook.after_iter(runner)
+        assert not model[0]._forward_hooks and not runtime_hook.named_handles
+
+
+def test_runtime_hook_remove_builder():
+    model = nn.Sequential(nn.Conv2d(3, 4, 3), nn.ReLU())
+    builder_args = dict(target_cls="Conv2d", inject_at_mode="fp", var_names=[])
+    # the name of one builder is a prefix of the other's
+    runtime_hook = RuntimeHook(1, [dict(name="act", type="SaveActivation", args=dict(builder_args, need_reg=True)),
+                                   dict(name="act2", type="SaveActivation", args=dict(builder_args, need_reg=True))])
+    runner = SimpleNamespace(model=SimpleNamespace(module=model), inner_iter=0)
+    runtime_hook.before_run(runner)
+    runtime_hook.remove_builder("act")
+    assert [t[0] for t in runtime_hook._lazy_targets] == ["act2", "act2"]
+    runtime_hook.before_iter(runner)
+    runtime_hook.update_hooks(QuantMode.FWFA)
+    model(torch.randn(1, 3, 5, 5))
+    assert list(runtime_hook.hook_regs) == ["act2"] and "0" in runtime_hook.hook_regs["act2"]
+    runtime_hook.remove_builder("act2")
+    assert not runtime_hook.named_handles and not model[0]._forward_hooks
+
+
+@pytest.mark.parametrize("device", ["cpu", pytest.param("cuda", marks=pytest.mark.skipif(
+    not torch.cuda.is_available(), reason="CUDA is not available"))])
+@pytest.mark.parametrize("offload_cpu", [False, True])
+def test_async_offloader(device, offload_cpu):
+    offloader = AsyncOffloader(num_slots=2, slot_bytes=4 * 64, offload_cpu=offload_cpu)
+    # the last one is split over 4 slots, i.e. more pieces than slots
+    xs = [torch.randn(4, 16, device=device), torch.randn(3, 5, device=device).t(), torch.randn(13, 16, device=device)]
+    reg = {}
+    for _ in range(3):  # more captures than slots
+        for i, x in enumerate(xs):
+            offloader.copy(x * 1., lambda t, i=i: reg.__setitem__(i, t))
+    offloader.flush()
+    for i, x in enumerate(xs):
+        assert reg[i].device.type == "cpu"
+        assert torch.equal(reg[i], x.cpu())
+    if device == "cuda" or offload_cpu:
+        assert offloader._thread is not None and offloader._thread.is_alive()
+    else:
+        assert offloader._thread is None
+
+
+def test_async_offloader_error():
+    offloader = AsyncOffloader(num_slots=2, slot_bytes=4 * 64, offload_cpu=True)
+    reg = {}
+
+    def fail(t):
+        raise ValueError("callback failed")
+
+    offloader.copy(torch.randn(4, 16), fail)
+    for i in range(4):  # the thread keeps draining after the failure
+        offloader.copy(torch.full((8, 16), float(i)), lambda t, i=i: reg.__setitem__(i, t))
+    with pytest.raises(ValueError):
+        offloader.flush()
+    assert sorted(reg) == [0, 1, 2, 3] and torch.equal(reg[3], torch.full((8, 16), 3.))
+    offloader.copy(torch.ones(2), lambda t: reg.__setitem__("after", t))
+    offloader.flush()  # the error is raised once
+    assert torch.equal(reg["after"], torch.ones(2))
+
+
+def test_activation_store(tmp_path):
+    store = ActivationStore(str(tmp_path), chunk_mb=1)
+    xs = [torch.randn(n, 64, 64) for n in (40, 50, 100)]  # 16 KB rows, chunks of at least 1 MB
+    for x in xs:
+        store.append("layer1.conv", x)
+    store.append("fc/weight", torch.randn(10, 4))
+    store.flush()
+    ref = torch.cat(xs).numpy()
+
+    for s in (store, ActivationStore(str(tmp_path), mode="r")):
+        layer = s["layer1.conv"]
+        assert len(layer) == 190 and layer.shape == (64, 64) and len(s.index["layer1.conv"]["chunks"]) > 1
+        assert np.array_equal(layer[30:130], ref[30:130])
+        rows = np.array([189, 0, 64, 63, -1])
+        assert np.array_equal(layer[rows], ref[rows])
+        assert np.array_equal(layer[5], ref[5])
+        assert sorted(s.keys()) == ["fc/weight", "layer1.conv"]
+
+
+def test_activation_store_iterations(tmp_path):
+    store = ActivationStore(str(tmp_path))
+    store.append("fc/weight", torch.zeros(10, 4))
+    store.append("fc/input", torch.zeros(3, 4))
+    store.append("fc/input", torch.ones(2, 4))
+    store.end_iteration()
+    store.end_iteration()  # nothing appended, stays at iteration 1
+    store.append("fc/weight", torch.ones(10, 4))
+    store.flush()
+
+    store = ActivationStore(str(tmp_path), mode="r")
+    assert store["fc/weight"].iteration_rows(1) == slice(10, 20)
+    assert np.array_equal(store["fc/weight"][store["fc/weight"].iteration_rows(1)], np.ones((10, 4)))
+    assert store["fc/input"].iteration_rows(0) == slice(0, 5)
+    with pytest.raises(KeyError):
+        store["fc/input"].iteration_rows(1)
+    assert ActivationStore(str(tmp_path)).iteration == 2
+
+
+def test_save_activation_store_reg(tmp_path):
+    # post-processes read `hook_reg` of builders writing to a store as well
+    hook_reg = OrderedDict()
+    builder = SaveActivationBuilder(hook_reg, None, "Linear", "fp", None, store_dir=str(tmp_path))
+    fc = nn.Linear(4, 3)
+    assert builder.match("fc", fc)
+    for i in range(2):
+        x = torch.randn(5, 4)
+        builder.forward_hook(fc, (x, ), fc(x))
+        builder.flush()
+        builder.flush()
+        assert torch.allclose(hook_reg["fc"], fc(x))
+        hook_reg.clear()
+    assert len(builder.store["fc"]) == 10
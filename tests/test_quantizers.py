@@ -1,17 +1,42 @@
 # -*- coding: utf-8 -*-
 
+import pytest
 import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn.functional as F
 from torch.nn import Parameter
 
-from quant_pack.core.quant.functional import fake_linear_quant as cuda_fake_linear_quant
+from quant_pack.core.quant.config import QuantConfig
+from quant_pack.core.quant.functional import fake_linear_quant as ext_fake_linear_quant
+from quant_pack.core.quant.functional import conv2d as quant_conv2d, linear as quant_linear
+from quant_pack.core.quant.packing import container_bits, pack_codes, unpack_codes
+from quant_pack.core.quant.observer import HistogramObserver, MinMaxObserver, all_reduce_histograms, \
+    search_mse_bounds
+from quant_pack.core.quant.binary import BinaryWeight, binary_conv2d, binary_linear, pack_bits, popcount
+from quant_pack.operators.binarizer.binarizer import autograd_binary
+from quant_pack.operators.linear_quantizer.linear_quant import autograd_linear_quant, RoundSTE
 
 SEED = 19260817
-DEVICE = torch.device("cuda:0")
+DEVICES = [torch.device("cpu")]
+if torch.cuda.is_available():
+    DEVICES.append(torch.device("cuda:0"))
 DTYPE = torch.float64
 
 torch.manual_seed(SEED)
 
 
+def fake_linear_quant(x, lb, ub, k, align_zero=False):
+    if k == 1:
+        return autograd_binary(x, lb, ub)
+    else:
+        return autograd_linear_quant(x, lb, ub, k, align_zero)
+
+
+def clamp(x, lb, ub):
+    return torch.max(torch.min(x, ub), lb)
+
+
 def _make_broadcast(t, x):
     if t.dim() == 0:
         return t
@@ -52,9 +77,10 @@ def d_x(dy, mask_x):
     return dy.clone() * mask_x.to(dy.dtype)
 
 
-def test_quant_num_grad_align_zero():
+@pytest.mark.parametrize("device", DEVICES)
+def test_quant_num_grad_align_zero(device):
     # TODO: we should add gradients to `clamp` op here
-    x = torch.randn(1, 3, 224, 224, requires_grad=True, dtype=DTYPE, device=DEVICE)
+    x = torch.randn(1, 3, 224, 224, requires_grad=True, dtype=DTYPE, device=device)
     d_qx = torch.randn_like(x).detach()
     lb = Parameter(x.detach().min() + 0.1)
     ub = Parameter(x.detach().max() - 0.1)
@@ -70,27 +96,27 @@ def test_quant_num_grad_align_zero():
     d_ub_gt = ub.grad.detach()
     d_x_gt = x.grad.detach()
 
-    # CUDA numerical implementation
+    # extension numerical implementation
     lb.grad.data.zero_()
     ub.grad.data.zero_()
     x.grad.data.zero_()
 
-    qx = cuda_fake_linear_quant(x, lb, ub, k, align_zero=True)
+    qx = ext_fake_linear_quant(x, lb, ub, k, align_zero=True)
     qx.backward(d_qx)
 
-    qx_cuda = qx.detach()
-    d_lb_cuda = lb.grad.detach()
-    d_ub_cuda = ub.grad.detach()
-    d_x_cuda = x.grad.detach()
+    qx_ext = qx.detach()
+    d_lb_ext = lb.grad.detach()
+    d_ub_ext = ub.grad.detach()
+    d_x_ext = x.grad.detach()
 
-    assert torch.allclose(qx_cuda, qx_gt)
-    assert torch.allclose(d_lb_cuda, d_lb_gt)
-    assert torch.allclose(d_ub_cuda, d_ub_gt)
-    assert torch.allclose(d_x_cuda, d_x_gt)
+    assert torch.allclose(qx_ext, qx_gt)
+    assert torch.allclose(d_lb_ext, d_lb_gt)
+    assert torch.allclose(d_ub_ext, d_ub_gt)
+    assert torch.allclose(d_x_ext, d_x_gt)
 
     # numerical grad implementation
     with torch.no_grad():
-        N = torch.tensor(2 ** k - 1, dtype=DTYPE, device=DEVICE)
+        N = torch.tensor(2 ** k - 1, dtype=DTYPE, device=device)
         delta = ub.sub(lb).div(N)
         z = torch.round(lb.abs().div(delta))
         lb_ = z.neg().mul(delta)
@@ -110,9 +136,9 @@ def test_quant_num_grad_align_zero():
         assert torch.allclose(dx, d_x_gt)
 
 
-def test_quant_num_grad_no_align_zero():
-    from quant_pack.core.quant.quantizers import RoundSTE
-    x = torch.randn(1, 3, 224, 224, requires_grad=True, dtype=DTYPE, device=DEVICE)
+@pytest.mark.parametrize("device", DEVICES)
+def test_quant_num_grad_no_align_zero(device):
+    x = torch.randn(1, 3, 224, 224, requires_grad=True, dtype=DTYPE, device=device)
     d_qx = torch.randn_like(x).detach()
     lb = Parameter(x.detach().min() + 0.1)
     ub = Parameter(x.detach().max() - 0.1)
@@ -152,27 +178,26 @@ def test_quant_num_grad_no_align_zero():
     assert torch.isclose(d_ub, d_ub_gt)
     assert torch.isclose(d_lb, d_lb_gt)
 
-    # CUDA numerical implementation
+    # extension numerical implementation
     lb.grad.data.zero_()
     ub.grad.data.zero_()
     x.grad.data.zero_()
 
-    qx = cuda_fake_linear_quant(x, lb, ub, k, align_zero=False)
+    qx = ext_fake_linear_quant(x, lb, ub, k, align_zero=False)
     qx.backward(d_qx)
 
-    d_lb_cuda = lb.grad.detach()
-    d_ub_cuda = ub.grad.detach()
-    d_x_cuda = x.grad.detach()
-
-    assert torch.allclose(d_lb_cuda, d_lb_gt)
-    assert torch.allclose(d_ub_cuda, d_ub_gt)
-    assert torch.allclose(d_x_cuda, d_x_gt)
+    d_lb_ext = lb.grad.detach()
+    d_ub_ext = ub.grad.detach()
+    d_x_ext = x.grad.detach()
 
+    assert torch.allclose(d_lb_ext, d_lb_gt)
+    assert torch.allclose(d_ub_ext, d_ub_gt)
+    assert torch.allclose(d_x_ext, d_x_gt)
 
-def test_channel_quant_4d_param_grad():
-    from quant_pack.core.quant.quantizers import RoundSTE
 
-    x = torch.randn(32, 16, 5, 5, requires_grad=True, dtype=DTYPE, device=DEVICE)
+@pytest.mark.parametrize("device", DEVICES)
+def test_channel_quant_4d_param_grad(device):
+    x = torch.randn(32, 16, 5, 5, requires_grad=True, dtype=DTYPE, device=device)
     xc = x.detach().reshape(32, -1)
     xc_lb, _ = xc.min(dim=1)
     xc_ub, _ = xc.max(dim=1)
@@ -208,27 +233,26 @@ def test_channel_quant_4d_param_grad():
     assert torch.allclose(d_ub, d_ub_gt)
     assert torch.allclose(d_lb, d_lb_gt)
 
-    # CUDA numerical implementation
+    # extension numerical implementation
     lbp.grad.detach_().zero_()
     ubp.grad.detach_().zero_()
     x.grad.detach_().zero_()
 
-    qx = cuda_fake_linear_quant(x, lbp, ubp, k, align_zero=False)
+    qx = ext_fake_linear_quant(x, lbp, ubp, k, align_zero=False)
     qx.backward(d_qx)
 
-    d_lb_cuda = lbp.grad.detach()
-    d_ub_cuda = ubp.grad.detach()
-    d_x_cuda = x.grad.detach()
-
-    assert torch.allclose(d_lb_cuda, d_lb_gt)
-    assert torch.allclose(d_ub_cuda, d_ub_gt)
-    assert torch.allclose(d_x_cuda, d_x_gt)
+    d_lb_ext = lbp.grad.detach()
+    d_ub_ext = ubp.grad.detach()
+    d_x_ext = x.grad.detach()
 
+    assert torch.allclose(d_lb_ext, d_lb_gt)
+    assert torch.allclose(d_ub_ext, d_ub_gt)
+    assert torch.allclose(d_x_ext, d_x_gt)
 
-def test_channel_quant_2d_param_grad():
-    from quant_pack.core.quant.quantizers import RoundSTE
 
-    x = torch.randn(32, 16, requires_grad=True, dtype=DTYPE, device=DEVICE)
+@pytest.mark.parametrize("device", DEVICES)
+def test_channel_quant_2d_param_grad(device):
+    x = torch.randn(32, 16, requires_grad=True, dtype=DTYPE, device=device)
     xc = x.detach()
     xc_lb, _ = xc.min(dim=1)
     xc_ub, _ = xc.max(dim=1)
@@ -264,25 +288,26 @@ def test_channel_quant_2d_param_grad():
     assert torch.allclose(d_ub, d_ub_gt)
     assert torch.allclose(d_lb, d_lb_gt)
 
-    # CUDA numerical implementation
+    # extension numerical implementation
     lbp.grad.detach_().zero_()
     ubp.grad.detach_().zero_()
     x.grad.detach_().zero_()
 
-    qx = cuda_fake_linear_quant(x, lbp, ubp, k, align_zero=False)
+    qx = ext_fake_linear_quant(x, lbp, ubp, k, align_zero=False)
     qx.backward(d_qx)
 
-    d_lb_cuda = lbp.grad.detach()
-    d_ub_cuda = ubp.grad.detach()
-    d_x_cuda = x.grad.detach()
+    d_lb_ext = lbp.grad.detach()
+    d_ub_ext = ubp.grad.detach()
+    d_x_ext = x.grad.detach()
 
-    assert torch.allclose(d_lb_cuda, d_lb_gt)
-    assert torch.allclose(d_ub_cuda, d_ub_gt)
-    assert torch.allclose(d_x_cuda, d_x_gt)
+    assert torch.allclose(d_lb_ext, d_lb_gt)
+    assert torch.allclose(d_ub_ext, d_ub_gt)
+    assert torch.allclose(d_x_ext, d_x_gt)
 
 
-def test_clamp_num_grad():
-    x = torch.randn(1, 3, 224, 224, requires_grad=True, dtype=DTYPE, device=DEVICE)
+@pytest.mark.parametrize("device", DEVICES)
+def test_clamp_num_grad(device):
+    x = torch.randn(1, 3, 224, 224, requires_grad=True, dtype=DTYPE, device=device)
     d_qx = torch.randn_like(x).detach()
     lb = Parameter(x.detach().min() + 0.1)
     ub = Parameter(x.detach().max() - 0.1)
@@ -299,8 +324,9 @@ def test_clamp_num_grad():
     assert torch.isclose(d_lb, lb.grad.detach())
 
 
-def test_binary_quant():
-    x = torch.randn(1, 3, 224, 224, requires_grad=True, dtype=DTYPE, device=DEVICE)
+@pytest.mark.parametrize("device", DEVICES)
+def test_binary_quant(device):
+    x = torch.randn(1, 3, 224, 224, requires_grad=True, dtype=DTYPE, device=device)
     d_bx = torch.randn_like(x).detach()
     lb = Parameter(x.detach().min() + 0.1)
     ub = Parameter(x.detach().max() - 0.1)
@@ -318,14 +344,264 @@ def test_binary_quant():
     lb.grad.detach_().zero_()
     ub.grad.detach_().zero_()
 
-    # CUDA numerical
-    bx_cuda = cuda_fake_linear_quant(x, lb, ub, k=1, align_zero=True)
-    bx_cuda.backward(d_bx)
-
-    dx_cuda = x.grad.detach()
-    d_lb_cuda = lb.grad.detach()
-    d_ub_cuda = ub.grad.detach()
-
-    assert torch.allclose(dx_cuda, dx)
-    assert torch.isclose(d_lb_cuda, d_lb)
-    assert torch.isclose(d_ub_cuda, d_ub)
+    # extension numerical
+    bx_ext = ext_fake_linear_quant(x, lb, ub, k=1, align_zero=True)
+    bx_ext.backward(d_bx)
+
+    dx_ext = x.grad.detach()
+    d_lb_ext = lb.grad.detach()
+    d_ub_ext = ub.grad.detach()
+
+    assert torch.allclose(dx_ext, dx)
+    assert torch.isclose(d_lb_ext, d_lb)
+    assert torch.isclose(d_ub_ext, d_ub)
+
+
+@pytest.mark.parametrize("device", DEVICES)
+@pytest.mark.parametrize("align_zero", [False, True])
+@pytest.mark.parametrize("channel_quant", [False, True])
+def test_low_memory_grad(device, align_zero, channel_quant):
+    if align_zero and channel_quant:
+        pytest.skip("align_zero only supports per-tensor quantization")
+    x = torch.randn(32, 16, 5, 5, requires_grad=True, dtype=DTYPE, device=device)
+    if channel_quant:
+        xc = x.detach().reshape(32, -1)
+        lb = Parameter(xc.min(dim=1)[0] + 0.1)
+        ub = Parameter(xc.max(dim=1)[0] - 0.1)
+    else:
+        lb = Parameter(x.detach().min() + 0.1)
+        ub = Parameter(x.detach().max() - 0.1)
+    d_qx = torch.randn_like(x).detach()
+    k = 4
+
+    grads = []
+    for low_memory in (False, True):
+        qx = ext_fake_linear_quant(x, lb, ub, k, align_zero=align_zero, low_memory=low_memory)
+        qx.backward(d_qx)
+        grads.append((qx.detach(), x.grad.clone(), lb.grad.clone(), ub.grad.clone()))
+        for t in (x, lb, ub):
+            t.grad = None
+
+    for t_default, t_low_mem in zip(*grads):
+        assert torch.allclose(t_default, t_low_mem)
+
+
+def _backward_allocated_bytes(y, dy):
+    if dy.is_cuda:
+        torch.cuda.synchronize(dy.device)
+        torch.cuda.reset_peak_memory_stats(dy.device)
+        base = torch.cuda.memory_allocated(dy.device)
+        y.backward(dy)
+        torch.cuda.synchronize(dy.device)
+        return torch.cuda.max_memory_allocated(dy.device) - base
+    else:
+        # sum of all allocations, an upper bound of the peak
+        with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as prof:
+            y.backward(dy)
+        return sum(max(evt.self_cpu_memory_usage, 0) for evt in prof.key_averages())
+
+
+@pytest.mark.parametrize("device", DEVICES)
+@pytest.mark.parametrize("k, align_zero, channel_quant", [
+    (1, False, False), (4, False, False), (4, True, False), (4, False, True),
+])
+def test_backward_peak_memory(device, k, align_zero, channel_quant):
+    x = torch.randn(64, 64, 16, 16, requires_grad=True, device=device)
+    if channel_quant:
+        lb = Parameter(torch.full((64, ), -1., device=device))
+        ub = Parameter(torch.full((64, ), 1., device=device))
+    else:
+        lb = Parameter(torch.tensor(-1., device=device))
+        ub = Parameter(torch.tensor(1., device=device))
+    d_qx = torch.randn_like(x)
+
+    # reference: autograd keeps input-sized intermediates for dlb / dub
+    qx = fake_linear_quant(x, _make_broadcast(lb, x), _make_broadcast(ub, x), k, align_zero)
+    ref_bytes = _backward_allocated_bytes(qx, d_qx)
+    x.grad = lb.grad = ub.grad = None
+
+    qx = ext_fake_linear_quant(x, lb, ub, k, align_zero=align_zero)
+    ext_bytes = _backward_allocated_bytes(qx, d_qx)
+
+    # only `dx` is input-sized, `dlb` and `dub` are reduced in the same pass
+    assert ext_bytes < 2 * x.nelement() * x.element_size()
+    assert ext_bytes < ref_bytes
+
+
+@pytest.mark.parametrize("device", DEVICES)
+@pytest.mark.parametrize("lb, ub", [(-0.7, 1.3), (0.2, 1.3), (-1.3, -0.2)])
+def test_sync_free_prune_to_zero(device, lb, ub):
+    x = torch.randn(4, 16, 8, 8, device=device)
+    lb = Parameter(torch.tensor(lb, device=device))
+    ub = Parameter(torch.tensor(ub, device=device))
+    qx = []
+    for sync_free in (False, True):
+        qconf = QuantConfig("linear", 4, lb, ub, align_zero=False, prune_to_zero=True, sync_free=sync_free)
+        with torch.no_grad():
+            qx.append(qconf.transform(x))
+    assert torch.equal(qx[0], qx[1])
+
+
+@pytest.mark.parametrize("k", [1, 2, 3, 4, 8])
+def test_pack_codes(k):
+    codes = torch.randint(0, 2 ** k, (1001, ), dtype=torch.uint8)
+    packed = pack_codes(codes, k)
+    assert packed.numel() == -(-codes.numel() * container_bits(k) // 8)
+    assert torch.equal(unpack_codes(packed, k, codes.numel()), codes)
+
+
+@pytest.mark.parametrize("device", DEVICES)
+@pytest.mark.parametrize("k, align_zero", [(2, False), (4, False), (4, True)])
+def test_compressed_saved_input_grad(device, k, align_zero):
+    conv = torch.nn.Conv2d(8, 16, 3, padding=1).to(device=device, dtype=DTYPE)
+    fc = torch.nn.Linear(8, 16).to(device=device, dtype=DTYPE)
+    lb = Parameter(torch.tensor(-0.7, device=device, dtype=DTYPE))
+    ub = Parameter(torch.tensor(1.1, device=device, dtype=DTYPE))
+    for m, x in ((conv, torch.randn(4, 8, 6, 6)), (fc, torch.randn(4, 5, 8))):
+        x = x.to(device=device, dtype=DTYPE).requires_grad_()
+        m.input_qconf = QuantConfig("linear", k, lb, ub, align_zero=align_zero)
+        forward = quant_conv2d if m is conv else quant_linear
+
+        grads = []
+        for compress in (False, True):
+            m.compress_saved_input = compress
+            y = forward(m, m.input_qconf.transform(x), m.weight, m.bias)
+            y.backward(torch.ones_like(y))
+            grads.append([y.detach()] + [t.grad.clone() for t in (x, m.weight, m.bias, lb, ub)])
+            for t in (x, m.weight, m.bias, lb, ub):
+                t.grad = None
+        for t_fp, t_packed in zip(*grads):
+            assert torch.allclose(t_fp, t_packed)
+
+
+def test_pack_bits_popcount():
+    bits = torch.rand(7, 200) > 0.5
+    words = pack_bits(bits)
+    assert words.shape == (7, 4)
+    assert torch.equal(popcount(words).sum(dim=-1), bits.sum(dim=-1))
+    # bit i of a row is bit i % 64 of word i // 64
+    for i in (0, 3, 70, 199):
+        assert torch.equal((words[:, i // 64] >> (i % 64)) & 1, bits[:, i].long())
+    assert torch.equal(words[:, 0] < 0, bits[:, 63])
+
+
+@pytest.mark.parametrize("per_channel", [False, True])
+@pytest.mark.parametrize("stride, padding, dilation, groups", [
+    (1, 1, 1, 1), (2, 0, 1, 1), (1, 2, 2, 1), (2, 1, 1, 3),
+])
+def test_binary_conv2d(per_channel, stride, padding, dilation, groups):
+    x = torch.randn(2, 12, 9, 11, dtype=DTYPE)
+    a_lb, a_ub = torch.tensor(-0.3, dtype=DTYPE), torch.tensor(0.8, dtype=DTYPE)
+    w_lb, w_ub = torch.tensor(-0.5, dtype=DTYPE), torch.tensor(0.7, dtype=DTYPE)
+    weight = torch.where(torch.randn(9, 12 // groups, 3, 3) > 0, w_ub, w_lb)
+    bias = torch.randn(9, dtype=DTYPE)
+    center, radius = (w_ub + w_lb) / 2, (w_ub - w_lb) / 2
+    if per_channel:
+        scale = torch.randn(9, dtype=DTYPE)
+        weight = weight * scale.view(-1, 1, 1, 1)
+        center, radius = center * scale, radius * scale
+    packed = BinaryWeight(weight, center, radius, groups)
+    stride, padding, dilation = (stride, stride), (padding, padding), (dilation, dilation)
+
+    y = F.conv2d(autograd_binary(x, a_lb, a_ub), weight, bias, stride, padding, dilation, groups)
+    cache = {}
+    for _ in range(2):  # valid masks are cached in the 2nd run
+        assert torch.allclose(binary_conv2d(x, a_lb, a_ub, packed, bias, stride, padding, dilation, cache), y)
+
+    fc_weight = weight.flatten(1)[:, :100] if groups == 1 else weight.flatten(1)
+    fc_x = torch.randn(3, 5, fc_weight.size(1), dtype=DTYPE)
+    y = F.linear(autograd_binary(fc_x, a_lb, a_ub), fc_weight, bias)
+    assert torch.allclose(binary_linear(fc_x, a_lb, a_ub, BinaryWeight(fc_weight, center, radius), bias), y)
+
+
+def _calib_batches():
+    # heavy-tailed batches with growing ranges, so that histograms are widened several times
+    return [torch.randn(4096).mul_(i + 1) * torch.rand(4096).pow_(4).mul_(8).add_(1) for i in range(4)]
+
+
+def _quant_mse(x, lb, ub, k):
+    lb, ub = torch.as_tensor(lb, dtype=x.dtype), torch.as_tensor(ub, dtype=x.dtype)
+    return (fake_linear_quant(x, lb, ub, k) - x).pow(2).mean().item()
+
+
+def test_histogram_observer():
+    batches = _calib_batches()
+    x = torch.cat(batches)
+    observer = HistogramObserver(4, bins=512)
+    for batch in batches:
+        observer.update(batch)
+    assert observer.hist.sum().item() == x.numel()
+    assert observer.lo <= x.min() and x.max() <= observer.hi
+    bin_width = ((observer.hi - observer.lo) / observer.bins).item()
+    lb, ub = observer.compute_bounds()
+    assert abs(lb.item() - torch.quantile(x, 0.01).item()) < bin_width * 2
+    assert abs(ub.item() - torch.quantile(x, 0.99).item()) < bin_width * 2
+
+
+@pytest.mark.parametrize("method", ["mse", "kl"])
+@pytest.mark.parametrize("seed", [SEED, 1, 2])  # KL bounds degenerated to ranges in tails for seeds 1 and 2
+def test_histogram_search(method, seed):
+    torch.manual_seed(seed)
+    batches = _calib_batches()
+    x = torch.cat(batches)
+    observer = HistogramObserver(4, method=method, bins=512)
+    minmax = MinMaxObserver(4)
+    for batch in batches:
+        observer.update(batch)
+        minmax.update(batch)
+    lb, ub = observer.compute_bounds()
+    assert minmax.lb <= lb < ub <= minmax.ub
+    # outliers are clipped
+    assert _quant_mse(x, lb, ub, 4) < _quant_mse(x, *minmax.compute_bounds(), 4)
+
+
+def _merge_histograms_worker(rank, world_size, init_file, batches, result_file):
+    dist.init_process_group("gloo", init_method=f"file://{init_file}", rank=rank, world_size=world_size)
+    observers = [HistogramObserver(4, bins=512), HistogramObserver(4, bins=256)]
+    for batch in batches[rank::world_size]:
+        for i, o in enumerate(observers):
+            o.update(batch * (i + 1))
+    all_reduce_histograms(observers)
+    if rank == 0:
+        torch.save([(o.hist, o.lo, o.exponent, o.compute_bounds()) for o in observers], result_file)
+    dist.destroy_process_group()
+
+
+@pytest.mark.skipif(not dist.is_available(), reason="requires torch.distributed")
+def test_all_reduce_histograms(tmp_path):
+    batches = _calib_batches()
+    result_file = tmp_path / "merged.pth"
+    mp.spawn(_merge_histograms_worker, args=(2, tmp_path / "init", batches, result_file), nprocs=2)
+    merged = torch.load(result_file)
+    for i, bins in enumerate((512, 256)):
+        # merged histograms are exactly the ones of all batches observed in one process
+        observer = HistogramObserver(4, bins=bins)
+        for batch in batches:
+            observer.update(batch * (i + 1))
+        hist, lo, exponent, (lb, ub) = merged[i]
+        assert torch.equal(hist, observer.hist)
+        assert lo == observer.lo and exponent == observer.exponent
+        assert (lb, ub) == observer.compute_bounds()
+
+
+@pytest.mark.parametrize("align_zero", [False, True])
+@pytest.mark.parametrize("per_channel", [False, True])
+def test_search_mse_bounds(align_zero, per_channel):
+    w = torch.randn(16, 8, 3, 3, dtype=DTYPE)
+    w[:, 0, 0, 0] *= 8  # outliers
+    # small blocks, so that ratios are evaluated in multiple blocks
+    lb, ub = search_mse_bounds(w, 4, align_zero, per_channel, num_ratios=20, block_numel=4096)
+    rows = w.reshape(16 if per_channel else 1, -1)
+    best = []
+    for row in rows:
+        errors = []
+        for r in torch.linspace(0.2, 1., 20, dtype=DTYPE):
+            q = autograd_linear_quant(row, r * row.min(), r * row.max(), 4, align_zero)
+            errors.append((q - row).pow(2).sum())
+        r = torch.linspace(0.2, 1., 20, dtype=DTYPE)[torch.stack(errors).argmin()]
+        best.append(torch.stack([r * row.min(), r * row.max()]))
+    best = torch.stack(best)
+    if not per_channel:
+        best = best[0]
+        assert lb.dim() == 0
+    assert torch.allclose(torch.stack([lb, ub], dim=-1), best)
@@ -0,0 +1,392 @@
+# -*- coding: utf-8 -*-
+
+import copy
+
+import pytest
+import torch
+import torch.nn as nn
+
+from quant_pack.core.ptq import calibrate_activations, find_blocks, reconstruct_blocks
+from quant_pack.core.wrapper import ParametrizedQuantWrapper, track_bn_folding_mapping
+
+SEED = 19260817
+QUANT_CONF = dict(method="linear", bit_width=4, align_zero=False)
+BN_FOLDING_MAPPING = [("bn1", "conv1"), ("bn2", "conv2")]
+
+torch.manual_seed(SEED)
+
+
+class _ConvNet(nn.Module):
+
+    def __init__(self):
+        super(_ConvNet, self).__init__()
+        self.conv1 = nn.Conv2d(3, 8, 3, padding=1, bias=False)
+        self.bn1 = nn.BatchNorm2d(8)
+        self.conv2 = nn.Conv2d(8, 16, 3, padding=1, bias=False)
+        self.bn2 = nn.BatchNorm2d(16)
+        self.fc = nn.Linear(16, 10)
+
+    def forward(self, x):
+        x = torch.relu(self.bn1(self.conv1(x)))
+        x = torch.relu(self.bn2(self.conv2(x)))
+        return self.fc(x.mean(dim=(2, 3)))
+
+
+def _build_wrapper(model, do_fold_bn, **kwargs):
+    model = ParametrizedQuantWrapper(copy.deepcopy(model), QUANT_CONF, BN_FOLDING_MAPPING, do_fold_bn, **kwargs)
+    for m in model.module.modules():
+        if hasattr(m, "_running_var_q"):
+            # non-trivial BN statistics
+            m._running_mean_q.uniform_(-0.1, 0.1)
+            m._running_var_q.uniform_(0.5, 1.5)
+    model.quant_w()
+    model.quant_a()
+    return model
+
+
+@pytest.mark.parametrize("do_fold_bn", [False, True])
+def test_weight_cache(do_fold_bn):
+    torch.manual_seed(SEED)
+    model = _ConvNet()
+    x = torch.randn(4, 3, 8, 8)
+    ref = _build_wrapper(model, do_fold_bn)
+    cached = _build_wrapper(model, do_fold_bn, cache_weight=True)
+    cached.load_state_dict(ref.state_dict())
+    ref.eval()
+    cached.eval()
+
+    with torch.no_grad():
+        y_ref = ref(x)
+        assert torch.equal(cached(x), y_ref)
+        # hit
+        assert torch.equal(cached(x), y_ref)
+        # bounds changed in-place, cache should be invalidated
+        for m in (ref.module.conv2, cached.module.conv2):
+            m.w_ub.mul_(0.5)
+        y_ref = ref(x)
+        assert torch.equal(cached(x), y_ref)
+
+    # in grad mode, cached weights are shared by forwards within a step (e.g. multiple quant
+    # modes in `batch_processor`) which are backwarded together, but not across steps
+    ref.train()
+    cached.train()
+    for _ in range(2):
+        cached._transform_cache.next_step()
+        for model in (ref, cached):
+            model.zero_grad()
+            (model(x) + model(x)).sum().backward()
+        for p_ref, p_cached in zip(ref.parameters(), cached.parameters()):
+            if p_ref.grad is not None:
+                assert torch.allclose(p_ref.grad, p_cached.grad)
+
+
+def test_validate_quant_bounds():
+    model = ParametrizedQuantWrapper(_ConvNet(), dict(QUANT_CONF, sync_free=True), BN_FOLDING_MAPPING, False)
+    model.validate_quant_bounds()
+    with torch.no_grad():
+        model.module.conv2.a_ub.fill_(-1.)
+    with pytest.raises(AssertionError, match="conv2.a"):
+        model.validate_quant_bounds()
+
+
+@pytest.mark.parametrize("quant_a", [False, True])
+def test_single_pass_fold_bn(quant_a):
+    torch.manual_seed(SEED)
+    model = _ConvNet()
+    x = torch.randn(8, 3, 8, 8, dtype=torch.float64)
+    two_pass = _build_wrapper(model, do_fold_bn=True).double()
+    single_pass = _build_wrapper(model, do_fold_bn=True, fold_bn_mode="single_pass").double()
+    single_pass.load_state_dict(two_pass.state_dict())
+    for m in (two_pass, single_pass):
+        # without weight quantization, both modes are mathematically identical
+        m.fp_w()
+        m.quant_a(quant_a)
+        m.train()
+
+    for _ in range(2):
+        outputs = []
+        for m in (two_pass, single_pass):
+            m.zero_grad()
+            y = m(x)
+            y.sum().backward()
+            outputs.append(y.detach())
+        assert torch.allclose(*outputs)
+        for (n, p_two), p_single in zip(two_pass.named_parameters(), single_pass.parameters()):
+            if p_two.grad is not None:
+                assert torch.allclose(p_two.grad, p_single.grad), n
+        for (n, b_two), b_single in zip(two_pass.named_buffers(), single_pass.buffers()):
+            assert torch.allclose(b_two, b_single), n
+
+    two_pass.eval()
+    single_pass.eval()
+    with torch.no_grad():
+        assert torch.allclose(two_pass(x), single_pass(x))
+
+
+class _ConvFCNet(nn.Module):
+    # Conv2d without BN and Linear + BatchNorm1d
+
+    def __init__(self):
+        super(_ConvFCNet, self).__init__()
+        self.conv1 = nn.Conv2d(3, 8, 3, padding=1, bias=False)
+        self.bn1 = nn.BatchNorm2d(8)
+        self.conv2 = nn.Conv2d(8, 8, 3, padding=1, groups=8)
+        self.fc1 = nn.Linear(8, 16)
+        self.bn3 = nn.BatchNorm1d(16)
+        self.fc2 = nn.Linear(16, 10)
+
+    def forward(self, x):
+        x = torch.relu(self.bn1(self.conv1(x)))
+        x = torch.relu(self.conv2(x))
+        x = torch.relu(self.bn3(self.fc1(x.mean(dim=(2, 3)))))
+        return self.fc2(x)
+
+
+@pytest.mark.parametrize("fold_bn_mode", ["two_pass", "single_pass"])
+def test_fc_bn_and_conv_forward(fold_bn_mode):
+    torch.manual_seed(SEED)
+    model = _ConvFCNet()
+    x = torch.randn(8, 3, 8, 8, dtype=torch.float64)
+    mapping = [("bn1", "conv1"), ("bn3", "fc1")]
+    unfolded = ParametrizedQuantWrapper(copy.deepcopy(model), QUANT_CONF, mapping, False).double()
+    folded = ParametrizedQuantWrapper(copy.deepcopy(model), QUANT_CONF, mapping, True,
+                                      fold_bn_mode=fold_bn_mode, cache_weight=True).double()
+    unfolded.module.fc1._running_mean_fp.uniform_(-0.1, 0.1)
+    unfolded.module.fc1._running_var_fp.uniform_(0.5, 1.5)
+    folded.load_state_dict(unfolded.state_dict())
+    for m in (unfolded, folded):
+        m.fp_w()
+        m.fp_a()
+        m.eval()
+
+    with torch.no_grad():
+        assert torch.allclose(folded(x), unfolded(x))
+
+    # quantized forward/backward of all paths
+    folded.quant_w()
+    folded.quant_a()
+    folded.train()
+    folded._transform_cache.next_step()
+    folded(x).sum().backward()
+    for n, p in folded.named_parameters():
+        if n.endswith(("weight", "_lb", "_ub")):
+            assert p.grad is not None and torch.isfinite(p.grad).all(), n
+
+
+def test_track_bn_folding_mapping(tmp_path):
+    model = _ConvFCNet()
+    expected = [("bn1", "conv1"), ("bn3", "fc1")]
+    assert track_bn_folding_mapping(model, cache_dir=None) == expected
+    assert track_bn_folding_mapping(model, cache_dir=tmp_path) == expected
+    assert len(list(tmp_path.glob("*.json"))) == 1
+    # the cached result is reused, even if tracing is impossible
+    model.forward = None
+    assert track_bn_folding_mapping(model, cache_dir=tmp_path) == expected
+
+
+@pytest.mark.skipif("fbgemm" not in torch.backends.quantized.supported_engines, reason="requires fbgemm")
+@pytest.mark.parametrize("align_zero", [False, True])
+def test_to_torch_quant(align_zero):
+    torch.manual_seed(SEED)
+    x = torch.randn(16, 3, 8, 8)
+    model = ParametrizedQuantWrapper(_ConvFCNet(), dict(QUANT_CONF, align_zero=align_zero),
+                                     [("bn1", "conv1"), ("bn3", "fc1")], True)
+    with torch.no_grad():
+        model.module.conv1.a_lb.fill_(-2.)
+        model.module.conv1.a_ub.fill_(2.)
+        # the input grid of fc2 has a nonzero offset unless zero-aligned, that of conv2 starts at 0
+        model.module.fc2.a_lb.fill_(-0.5)
+    model.eval()
+    model.quant_w()
+    model.quant_a()
+
+    def errors(int_model):
+        with torch.no_grad():
+            y, y_int = model(x), int_model(x)
+        agreement = (y.argmax(dim=1) == y_int.argmax(dim=1)).float().mean().item()
+        return ((y_int - y).norm() / y.norm()).item(), agreement
+
+    int_model = model.to_torch_quant()
+    # conv1 / fc1 outputs are requantized onto input grids of conv2 / fc2 if weights are exact in int8
+    # and those grids in quint8 (zero-aligned, or starting at 0), others stay float
+    assert int_model.conv1.exact_weight == int_model.fc1.exact_weight == align_zero
+    assert int_model.conv2.aligned_input_qparams() is not None
+    assert (int_model.fc2.aligned_input_qparams() is not None) == align_zero
+    assert isinstance(int_model.conv1.int_layer, torch.ao.nn.quantized.Conv2d) == align_zero
+    assert isinstance(int_model.fc1.int_layer, torch.ao.nn.quantized.Linear) == align_zero
+    assert int_model.conv2.int_layer is None and int_model.fc2.int_layer is None
+    error, agreement = errors(int_model)
+    assert error < 1e-5 and agreement == 1.
+
+    # all layers requantized to 8-bit ranges calibrated over batches
+    int_model = model.to_torch_quant([x[:8], x[8:]], requantize_outputs=True)
+    assert all(getattr(int_model, n).int_layer is not None for n in ("conv1", "conv2", "fc1", "fc2"))
+    with pytest.raises(AssertionError):
+        model.to_torch_quant(requantize_outputs=True)
+
+
+@pytest.mark.parametrize("do_fold_bn", [False, True])
+@pytest.mark.parametrize("bit_width", [2, 4])
+def test_to_packed(do_fold_bn, bit_width):
+    torch.manual_seed(SEED)
+    x = torch.randn(4, 3, 8, 8)
+    model = ParametrizedQuantWrapper(_ConvFCNet(), dict(QUANT_CONF, bit_width=bit_width),
+                                     [("bn1", "conv1"), ("bn3", "fc1")], do_fold_bn)
+    model.module.fc1._running_var_q.uniform_(0.5, 1.5)
+    model.eval()
+    model.quant_w()
+    model.quant_a()
+    with torch.no_grad():
+        y = model(x)
+        # small blocks, so that layers are unpacked in multiple blocks
+        model.to_packed(block_numel=32)
+        assert torch.allclose(model(x), y, atol=1e-5)
+    for n in ("conv1", "conv2", "fc1", "fc2"):
+        m = getattr(model.module, n)
+        assert "weight" not in m._parameters
+        packed = m.packed_weight
+        assert packed.codes.shape == (packed.shape[0], -(-packed.row_numel * bit_width // 8))
+
+
+@pytest.mark.parametrize("do_fold_bn", [False, True])
+def test_to_packed_binary(do_fold_bn):
+    torch.manual_seed(SEED)
+    x = torch.randn(4, 3, 8, 8)
+    model = ParametrizedQuantWrapper(_ConvFCNet(), dict(QUANT_CONF, bit_width=1),
+                                     [("bn1", "conv1"), ("bn3", "fc1")], do_fold_bn)
+    model.module.fc1._running_var_q.uniform_(0.5, 1.5)
+    with torch.no_grad():
+        # negative BN gammas flip signs of per-channel radii
+        model.module.conv1.alpha[::2].neg_()
+        model.module.fc1.alpha[::3].neg_()
+    model.eval()
+    model.quant_w()
+    model.quant_a()
+    with torch.no_grad():
+        y = model(x)
+        model.to_packed(binary=True)
+        assert torch.allclose(model(x), y, atol=1e-5)
+    for n in ("conv1", "conv2", "fc1", "fc2"):
+        m = getattr(model.module, n)
+        assert "weight" not in m._parameters
+        assert m.binary_weight.words.shape[-1] == -(-m.binary_weight.row_numel // 64)
+
+
+@pytest.mark.parametrize("do_fold_bn", [False, True])
+@pytest.mark.parametrize("min_speedup", [0., float("inf")])
+def test_to_sparse(do_fold_bn, min_speedup):
+    torch.manual_seed(SEED)
+    x = torch.randn(4, 3, 8, 8)
+    model = ParametrizedQuantWrapper(_ConvFCNet(), dict(QUANT_CONF, bit_width=2, prune_to_zero=True),
+                                     [("bn1", "conv1"), ("bn3", "fc1")], do_fold_bn)
+    model.module.fc1._running_var_q.uniform_(0.5, 1.5)
+    model.eval()
+    model.quant_w()
+    model.quant_a()
+    params = dict(model.named_parameters())
+    forwards = {n: m.__dict__.get("forward") for n, m in model.module.named_children()}
+    with torch.no_grad():
+        y = model(x)
+        report = model.to_sparse(x, threshold=0.1, iters=1, min_speedup=min_speedup)
+        assert torch.allclose(model(x), y, atol=1e-5)
+    assert set(report) == {"conv1", "conv2", "fc1", "fc2"}
+    assert any(entry["sparsity"] >= 0.1 for entry in report.values())
+    for n, entry in report.items():
+        m = getattr(model.module, n)
+        if entry["sparsity"] >= 0.1:
+            assert entry["speedup"] == entry["dense_ms"] / entry["sparse_ms"] > 0.
+        # all candidates are converted with `min_speedup` 0, none with inf
+        assert entry["sparse"] == (entry["sparsity"] >= 0.1 and min_speedup == 0.)
+        if entry["sparse"]:
+            assert "weight" not in m._parameters and "sparse_weight" in m._buffers
+        else:
+            # dense layers are left untouched
+            assert m.weight is params[f"module.{n}.weight"] and "sparse_weight" not in m._buffers
+            assert m.__dict__.get("forward") is forwards[n]
+
+
+@pytest.mark.parametrize("per_channel", [False, True])
+def test_calibrate_weights_mse(per_channel):
+    torch.manual_seed(SEED)
+    model = ParametrizedQuantWrapper(_ConvNet(), QUANT_CONF, BN_FOLDING_MAPPING, False)
+    model.quant_w()
+    errors = {}
+    for method in ("minmax", "mse"):
+        model.calibrate_weights(method, per_channel)
+        errors[method] = [(m.weight_qconf.transform(m.weight) - m.weight).pow(2).sum().item()
+                          for m in (model.module.conv1, model.module.conv2, model.module.fc)]
+    assert model.module.conv2.w_lb.shape == ((16, ) if per_channel else ())
+    assert all(e_mse <= e_minmax for e_mse, e_minmax in zip(errors["mse"], errors["minmax"]))
+
+
+def test_calibrate_weights_per_channel_align_zero():
+    model = ParametrizedQuantWrapper(_ConvNet(), dict(QUANT_CONF, align_zero=True), BN_FOLDING_MAPPING, False)
+    with pytest.raises(AssertionError):
+        model.calibrate_weights("mse", per_channel=True)
+
+
+@pytest.mark.parametrize("do_fold_bn", [False, True])
+def test_reconstruct_blocks(do_fold_bn, tmp_path):
+    torch.manual_seed(SEED)
+    data = [(torch.randn(8, 3, 8, 8), torch.zeros(8, dtype=torch.long)) for _ in range(4)]
+    model = ParametrizedQuantWrapper(_ConvNet(), dict(QUANT_CONF, bit_width=2), BN_FOLDING_MAPPING, do_fold_bn)
+    model.eval()
+    model.calibrate_weights()
+    calibrate_activations(model, data, "cpu", observer="minmax")
+    assert [n for n, _ in find_blocks(model, data[0][0])] == ["conv1", "conv2", "fc"]
+
+    def error():
+        with torch.no_grad():
+            model.fp_w()
+            model.fp_a()
+            y = [model(x) for x, _ in data]
+            model.quant_w()
+            model.quant_a()
+            return sum((model(x) - y_i).pow(2).sum().item() for (x, _), y_i in zip(data, y))
+
+    before = error()
+    reconstruct_blocks(model, data, "cpu", str(tmp_path), iters=50, batch_size=16, rounding_lr=1e-2)
+    assert error() < before
+    assert not list(tmp_path.iterdir())
+    assert all(m.weight_qconf.rounding_offset is None and m.weight.requires_grad
+               for m in model._quant_submodules)
+
+
+@pytest.mark.parametrize("do_fold_bn", [False, True])
+def test_reestimate_bn_stats(do_fold_bn):
+    torch.manual_seed(SEED)
+    data = [(torch.randn(8, 3, 8, 8), None) for _ in range(3)]
+    model = _build_wrapper(_ConvNet(), do_fold_bn)
+    model.train()
+    conv1 = model.module.conv1
+    running_mean_fp = conv1._running_mean_fp.clone()
+    assert model.reestimate_bn_stats(data * 2, "cpu", num_batches=3) == 3
+    # equally sized batches, the average of batch means is the mean of all inputs
+    mean_q = conv1._running_mean_q.clone()
+    model.reestimate_bn_stats([(torch.cat([x for x, _ in data]), None)], "cpu")
+    assert torch.allclose(mean_q, conv1._running_mean_q, atol=1e-5)
+    assert torch.equal(conv1._running_mean_fp, running_mean_fp)
+    assert model.training and conv1.bn_momentum == 0.1
+    assert model._w_switch.enabled and model._a_switch.enabled
+
+
+def test_runtime_hook_targets():
+    from quant_pack.core.wrapper.hook.activation_builder import SaveActivationBuilder
+
+    class _CountingBuilder(SaveActivationBuilder):
+
+        def match(self, name, module):
+            self.num_matches = getattr(self, "num_matches", 0) + 1
+            return super(_CountingBuilder, self).match(name, module)
+
+    model = ParametrizedQuantWrapper(_ConvNet(), QUANT_CONF, BN_FOLDING_MAPPING, False)
+    ddp_like = nn.Module()
+    ddp_like.module = model.module  # `module.module` as under DDP
+    model.module = ddp_like
+    builder = _CountingBuilder({}, None, r"Conv2d$", "fp", [])
+    targets = model._runtime_hook_targets(builder)
+    num_matches = builder.num_matches
+    assert model._runtime_hook_targets(builder) == targets and builder.num_matches == num_matches
+    assert len(targets) == 2 * 2  # forward pre and forward hooks of conv1 and conv2
+    del builder, targets
+    assert not model._hook_targets
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# helpers shared by benchmark scripts, quantize torchvision models without the
+# full `ParametrizedQuantWrapper` machinery
+
+import torch
+import torch.nn as nn
+
+import quant_pack.core.quant.functional as quant_f
+from quant_pack.core.quant.config import QuantConfig
+
+
+def _conv2d_forward(module, input):
+    input = module.input_qconf.transform(input)
+    weight = module.weight_qconf.transform(module.weight)
+    return quant_f.conv2d(module, input, weight, module.bias)
+
+
+def _linear_forward(module, input):
+    input = module.input_qconf.transform(input)
+    weight = module.weight_qconf.transform(module.weight)
+    return quant_f.linear(module, input, weight, module.bias)
+
+
+def quantize_model(model, bit_width, compress_saved_input=False, **quant_conf):
+    for m in model.modules():
+        if isinstance(m, (nn.Conv2d, nn.Linear)):
+            w_lb = nn.Parameter(m.weight.detach().min() * 0.9)
+            w_ub = nn.Parameter(m.weight.detach().max() * 0.9)
+            a_lb = nn.Parameter(torch.tensor(0.))
+            a_ub = nn.Parameter(torch.tensor(4.))
+            m.weight_qconf = QuantConfig("linear", bit_width, w_lb, w_ub, align_zero=False, **quant_conf)
+            m.input_qconf = QuantConfig("linear", bit_width, a_lb, a_ub, align_zero=False, **quant_conf)
+            m.compress_saved_input = compress_saved_input
+            forward = _conv2d_forward if isinstance(m, nn.Conv2d) else _linear_forward
+            m.forward = forward.__get__(m)
+    return model
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+import time
+from argparse import ArgumentParser
+
+import torch
+import torch.nn.functional as F
+
+from quant_pack.core.quant.binary import BinaryWeight, binary_conv2d
+from quant_pack.operators.binarizer.binarizer import autograd_binary
+
+# (C_in, C_out, H/W, stride) of 3x3 conv layers in ResNet-18
+LAYERS = [
+    (64, 64, 56, 1),
+    (64, 128, 56, 2),
+    (128, 128, 28, 1),
+    (256, 256, 14, 1),
+    (512, 512, 7, 1),
+]
+
+
+@torch.no_grad()
+def throughput(f, batch_size, iters):
+    for _ in range(2):  # warm up
+        f()
+    start = time.perf_counter()
+    for _ in range(iters):
+        f()
+    return batch_size * iters / (time.perf_counter() - start)
+
+
+def main():
+    parser = ArgumentParser("CPU throughput of binarized 3x3 conv layers, XOR / popcount vs. F.conv2d.")
+    parser.add_argument("--batch-size", "-b", type=int, default=8)
+    parser.add_argument("--iters", "-n", type=int, default=10)
+    parser.add_argument("--threads", "-j", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(19260817)
+    a_lb, a_ub = torch.tensor(0.), torch.tensor(1.)
+    w_lb, w_ub = -0.05, 0.05
+    print(f"batch {args.batch_size}, {torch.get_num_threads()} threads, images/s")
+    for c_in, c_out, size, stride in LAYERS:
+        x = torch.randn(args.batch_size, c_in, size, size)
+        weight = torch.where(torch.randn(c_out, c_in, 3, 3) > 0, w_ub, w_lb)
+        packed = BinaryWeight(weight, (w_ub + w_lb) / 2, (w_ub - w_lb) / 2)
+        stride, padding, dilation = (stride, stride), (1, 1), (1, 1)
+        valid_cache = {}
+
+        def dense():
+            return F.conv2d(autograd_binary(x, a_lb, a_ub), weight, None, stride, padding, dilation)
+
+        def binary():
+            return binary_conv2d(x, a_lb, a_ub, packed, None, stride, padding, dilation, valid_cache)
+
+        with torch.no_grad():
+            err = (binary() - dense()).abs().max().item()
+        t_dense = throughput(dense, args.batch_size, args.iters)
+        t_binary = throughput(binary, args.batch_size, args.iters)
+        print(f"{c_in:4d} -> {c_out:4d}, {size:3d}x{size:<3d} /{stride[0]}: F.conv2d {t_dense:9.1f}, "
+              f"xor-popcount {t_binary:9.1f}, speedup {t_binary / t_dense:.2f}x, max |diff|: {err:.2e}")
+
+
+if __name__ == "__main__":
+    main()
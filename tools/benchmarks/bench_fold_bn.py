@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+import time
+from argparse import ArgumentParser
+
+import torch
+import torchvision.models as models
+
+from quant_pack.core.quant.config import QuantMode
+from quant_pack.core.wrapper import ParametrizedQuantWrapper, track_bn_folding_mapping
+
+
+def _sync(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def train_throughput(model, data_batch, device, iters):
+    model.train()
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.)
+    quant_mode = (QuantMode.QWQA, )
+
+    def step():
+        optimizer.zero_grad()
+        outputs = model.batch_processor(model, data_batch, True, device, None, quant_mode=quant_mode)
+        outputs[f"{QuantMode.QWQA}"].sum().backward()
+        optimizer.step()
+
+    for _ in range(2):  # warm up
+        step()
+    _sync(device)
+    start = time.perf_counter()
+    for _ in range(iters):
+        step()
+    _sync(device)
+    return iters * data_batch[0].size(0) / (time.perf_counter() - start)
+
+
+def main():
+    parser = ArgumentParser("Training throughput of a quantized ResNet with BN folded in two / single pass.")
+    parser.add_argument("--arch", "-a", default="resnet18")
+    parser.add_argument("--batch-size", "-b", type=int, default=32)
+    parser.add_argument("--bit-width", "-k", type=int, default=4)
+    parser.add_argument("--iters", "-n", type=int, default=20)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    data_batch = (torch.randn(args.batch_size, 3, 224, 224), torch.zeros(args.batch_size, dtype=torch.long))
+    quant_conf = dict(method="linear", bit_width=args.bit_width, align_zero=False)
+    results = {}
+    for fold_bn_mode in ("two_pass", "single_pass"):
+        torch.manual_seed(19260817)
+        model = models.__dict__[args.arch]()
+        model = ParametrizedQuantWrapper(model, quant_conf, track_bn_folding_mapping(model), do_fold_bn=True,
+                                         fold_bn_mode=fold_bn_mode)
+        model.to(device)
+        results[fold_bn_mode] = train_throughput(model, data_batch, device, args.iters)
+
+    for fold_bn_mode, throughput in results.items():
+        print(f"{args.arch} fold_bn_mode={fold_bn_mode:11}: {throughput:8.1f} images/s")
+    print(f"speedup: {results['single_pass'] / results['two_pass']:.3f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+import time
+from argparse import ArgumentParser
+
+import torch
+import torchvision.models as models
+
+from quant_pack.core.wrapper import ParametrizedQuantWrapper, track_bn_folding_mapping
+
+
+def _sync(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def resident_bytes(model):
+    tensors = {t.data_ptr(): t.numel() * t.element_size() for t in model.state_dict().values()}
+    return sum(tensors.values())
+
+
+@torch.no_grad()
+def latency(model, input, iters):
+    for _ in range(2):  # warm up
+        model(input)
+    _sync(input.device)
+    start = time.perf_counter()
+    for _ in range(iters):
+        model(input)
+    _sync(input.device)
+    return (time.perf_counter() - start) / iters
+
+
+def main():
+    parser = ArgumentParser("Resident memory and latency of quantized models with packed k-bit weights.")
+    parser.add_argument("--arch", "-a", default="resnet18")
+    parser.add_argument("--batch-size", "-b", type=int, default=1)
+    parser.add_argument("--bit-width", "-k", type=int, default=4)
+    parser.add_argument("--block-numel", type=int, default=2 ** 20)
+    parser.add_argument("--iters", "-n", type=int, default=20)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    torch.manual_seed(19260817)
+    model = models.__dict__[args.arch]()
+    quant_conf = dict(method="linear", bit_width=args.bit_width, align_zero=False)
+    model = ParametrizedQuantWrapper(model, quant_conf, track_bn_folding_mapping(model), do_fold_bn=True).to(device)
+    model.eval()
+    model.quant_w()
+    model.quant_a()
+    input = torch.randn(args.batch_size, 3, 224, 224, device=device)
+
+    results = {}
+    with torch.no_grad():
+        y = model(input)
+    results["fake-quant"] = resident_bytes(model), latency(model, input, args.iters)
+    model.to_packed(args.block_numel)
+    with torch.no_grad():
+        err = (model(input) - y).abs().max().item()
+    results["packed"] = resident_bytes(model), latency(model, input, args.iters)
+
+    mb = 1024 ** 2
+    print(f"{args.arch} W{args.bit_width}A{args.bit_width}, batch {args.batch_size}, {args.device}")
+    for name, (nbytes, t) in results.items():
+        print(f"{name:10}: resident {nbytes / mb:8.2f} MiB, {t * 1000:8.2f} ms")
+    print(f"memory reduction: {results['fake-quant'][0] / results['packed'][0]:.2f}x, "
+          f"latency ratio: {results['packed'][1] / results['fake-quant'][1]:.3f}, max |diff|: {err:.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+from argparse import ArgumentParser
+
+import torch
+import torchvision.models as models
+
+from _utils import quantize_model
+
+
+def measure(model, input):
+    storages = {}
+
+    def pack_hook(t):
+        storage = t.untyped_storage()
+        storages[storage.data_ptr()] = storage.nbytes()
+        return t
+
+    model.zero_grad()
+    if input.is_cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+    with torch.autograd.graph.saved_tensors_hooks(pack_hook, lambda t: t):
+        loss = model(input).sum()
+    peak = torch.cuda.max_memory_allocated() - base if input.is_cuda else None
+    loss.backward()
+    return sum(storages.values()), peak
+
+
+SETTINGS = (
+    ("default", dict()),
+    ("low_memory", dict(low_memory=True)),
+    ("low_memory + compress_saved_input", dict(low_memory=True, compress_saved_input=True)),
+)
+
+
+def main():
+    parser = ArgumentParser("Memory saved for backward by quantized ResNet-18 under different memory settings.")
+    parser.add_argument("--batch-size", "-b", type=int, default=32)
+    parser.add_argument("--bit-width", "-k", type=int, default=4)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    input = torch.randn(args.batch_size, 3, 224, 224, device=device)
+    results = {}
+    for name, setting in SETTINGS:
+        torch.manual_seed(19260817)
+        model = quantize_model(models.resnet18(), args.bit_width, **setting).to(device)
+        measure(model, input)  # warm up
+        results[name] = measure(model, input)
+
+    mb = 1024 ** 2
+    saved_default = results["default"][0]
+    for name, (saved, peak) in results.items():
+        msg = f"{name:35}: saved tensors {saved / mb:8.1f} MiB ({saved / saved_default * 100:5.1f}%)"
+        if peak is not None:
+            msg += f", peak forward memory {peak / mb:8.1f} MiB"
+        print(msg)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+import time
+from argparse import ArgumentParser
+from collections import OrderedDict
+from types import MethodType
+
+import torch.distributed as dist
+import torchvision.models as models
+from torch.nn.parallel import DistributedDataParallel
+
+from quant_pack.core.wrapper import ParametrizedQuantWrapper, track_bn_folding_mapping
+from quant_pack.core.wrapper.hook.activation_builder import SaveActivationBuilder, SaveAllValueBuilder
+
+
+def _legacy_inject(model, runtime_hooks):
+    # per-forward walk over `named_modules()` matching every builder, as before the match-index cache
+    def _ddp_forward(_module, *_args, **_kwargs):
+        _handles = []
+        for _n, _m in _module.named_modules():
+            for _builder in runtime_hooks:
+                if _builder.match(_n, _m):
+                    for _method, _hook in _builder.get_hooks():
+                        _handles.append(getattr(_m, _method)(_hook))
+        _outputs = model._module_forward(_module, *_args, **_kwargs)
+        for _handle in _handles:
+            _handle.remove()
+        return _outputs
+    model.module.module.forward = MethodType(_ddp_forward, model.module.module)
+
+
+def per_iter_overhead(f, iters):
+    f()  # warm up, also builds the match index
+    start = time.perf_counter()
+    for _ in range(iters):
+        f()
+    return (time.perf_counter() - start) / iters
+
+
+def main():
+    parser = ArgumentParser("Per-iteration overhead of injecting runtime hooks under DDP, the forward itself "
+                            "is replaced by a no-op to isolate matching and (un)registering hooks.")
+    parser.add_argument("--arch", "-a", default="resnet101")
+    parser.add_argument("--iters", "-n", type=int, default=100)
+    parser.add_argument("--port", "-p", type=int, default=29513)
+    args = parser.parse_args()
+
+    dist.init_process_group("gloo", init_method=f"tcp://127.0.0.1:{args.port}", rank=0, world_size=1)
+    model = models.__dict__[args.arch]()
+    model = ParametrizedQuantWrapper(model, dict(method="linear", bit_width=4, align_zero=False),
+                                     track_bn_folding_mapping(model), False)
+    model.module = DistributedDataParallel(model.module)
+    model._module_forward = lambda module, *inputs, **kwargs: None
+
+    enable_reg = OrderedDict()
+    builders = [
+        SaveActivationBuilder(OrderedDict(), enable_reg, r"(Conv2d|Linear)$", "fp", ["pre_activation"]),
+        SaveAllValueBuilder(OrderedDict(), enable_reg, r"(Conv2d|Linear)$", "quant", ["input", "weight"]),
+    ]
+    for builder in builders:
+        enable_reg[id(builder)] = False
+    num_targets = sum(len(model._runtime_hook_targets(b)) for b in builders)
+    num_modules = len(list(model.module.module.modules()))
+
+    def cached():
+        with model._inject_runtime_hooks(builders):
+            model.module.module.forward(None)
+
+    def legacy():
+        _legacy_inject(model, builders)
+        model.module.module.forward(None)
+
+    t_cached = per_iter_overhead(cached, args.iters)
+    t_legacy = per_iter_overhead(legacy, args.iters)
+    print(f"{args.arch}: {num_modules} modules, {num_targets} hooks injected per forward")
+    print(f"walk and match per forward: {t_legacy * 1e3:8.3f} ms/iter")
+    print(f"cached match index:         {t_cached * 1e3:8.3f} ms/iter, speedup {t_legacy / t_cached:.2f}x")
+    dist.destroy_process_group()
+
+
+if __name__ == "__main__":
+    main()
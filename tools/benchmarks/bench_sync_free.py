@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+import time
+from argparse import ArgumentParser
+
+import torch
+import torchvision.models as models
+
+from _utils import quantize_model
+
+
+def _sync(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def time_iters(model, input, iters, prune_to_zero):
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.)
+    _sync(input.device)
+    start = time.perf_counter()
+    for _ in range(iters):
+        model.train()
+        optimizer.zero_grad()
+        model(input).sum().backward()
+        optimizer.step()
+        if prune_to_zero:
+            # evaluation forward, where prune thresholds are computed
+            model.eval()
+            with torch.no_grad():
+                model(input)
+    _sync(input.device)
+    return (time.perf_counter() - start) / iters
+
+
+def main():
+    parser = ArgumentParser("Iteration time of quantized deep models, with and without host-sync-free quantizers.")
+    parser.add_argument("--arch", "-a", default="resnet101")
+    parser.add_argument("--batch-size", "-b", type=int, default=16)
+    parser.add_argument("--bit-width", "-k", type=int, default=4)
+    parser.add_argument("--iters", "-n", type=int, default=20)
+    parser.add_argument("--prune-to-zero", action="store_true")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    input = torch.randn(args.batch_size, 3, 224, 224, device=device)
+    results = {}
+    for sync_free in (False, True):
+        torch.manual_seed(19260817)
+        model = quantize_model(models.__dict__[args.arch](), args.bit_width,
+                               prune_to_zero=args.prune_to_zero, sync_free=sync_free).to(device)
+        time_iters(model, input, 2, args.prune_to_zero)  # warm up
+        results[sync_free] = time_iters(model, input, args.iters, args.prune_to_zero)
+
+    for sync_free, t in results.items():
+        print(f"{args.arch} sync_free={sync_free!s:5}: {t * 1000:8.2f} ms/iter")
+    print(f"speedup: {results[False] / results[True]:.3f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+import time
+from argparse import ArgumentParser
+
+import torch
+import torch.nn as nn
+
+from quant_pack.models import resnet_cifar, mobilenet_v1, init_utils
+from quant_pack.core.wrapper import ParametrizedQuantWrapper, track_bn_folding_mapping
+
+ARCHS = {
+    "resnet20_cifar": (resnet_cifar.resnet20_cifar, dict(num_classes=10), 32),
+    "resnet56_cifar": (resnet_cifar.resnet56_cifar, dict(num_classes=10), 32),
+    "mobilenet_v1": (mobilenet_v1.mobilenet_v1, dict(num_classes=1000), 224),
+}
+
+
+@torch.no_grad()
+def init_bn_stats(model, input):
+    # BN statistics of randomly initialized models, otherwise activations vanish in deep models
+    for m in model.modules():
+        if isinstance(m, nn.modules.batchnorm._BatchNorm):
+            m.reset_running_stats()
+            m.momentum = None
+    model.train()
+    model(input)
+    model.eval()
+
+
+@torch.no_grad()
+def calibrate_bounds(model, input):
+    # activation bounds from a FP forward, in place of QAT-learned ones
+    handles = []
+    for m in model.module.modules():
+        if hasattr(m, "a_ub"):
+            def hook(module, inputs):
+                module.a_lb.fill_(min(inputs[0].min().item(), 0.))
+                module.a_ub.fill_(inputs[0].max().item())
+            handles.append(m.register_forward_pre_hook(hook))
+    model.fp_w()
+    model.fp_a()
+    model(input)
+    for handle in handles:
+        handle.remove()
+
+
+@torch.no_grad()
+def latency(model, input, iters):
+    for _ in range(2):  # warm up
+        model(input)
+    start = time.perf_counter()
+    for _ in range(iters):
+        model(input)
+    return (time.perf_counter() - start) / iters
+
+
+def main():
+    parser = ArgumentParser("CPU latency and output parity of integer models from `to_torch_quant` "
+                            "against the fake-quant evaluation.")
+    parser.add_argument("--arch", "-a", default="resnet20_cifar", choices=ARCHS.keys())
+    parser.add_argument("--batch-size", "-b", type=int, default=1)
+    parser.add_argument("--bit-width", "-k", type=int, default=4)
+    parser.add_argument("--iters", "-n", type=int, default=50)
+    parser.add_argument("--backend", default="fbgemm")
+    parser.add_argument("--align-zero", action="store_true")
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--requantize-outputs", action="store_true",
+                        help="run all layers on integer kernels, with output ranges calibrated on 8 batches")
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    torch.manual_seed(19260817)
+    model_f, model_args, size = ARCHS[args.arch]
+    model = model_f(**model_args)
+    calib_input = torch.randn(32, 3, size, size)
+    init_utils.kaiming_normal_init_(model)
+    init_bn_stats(model, calib_input)
+    test_input = torch.randn(128, 3, size, size)
+    quant_conf = dict(method="linear", bit_width=args.bit_width, align_zero=args.align_zero)
+    model = ParametrizedQuantWrapper(model, quant_conf, track_bn_folding_mapping(model), do_fold_bn=True)
+    model.eval()
+    calibrate_bounds(model, calib_input)
+    with torch.no_grad():
+        y_fp = model(test_input)
+    model.quant_w()
+    model.quant_a()
+    calib_batches = [torch.randn(32, 3, size, size) for _ in range(8)]
+    int_model = model.to_torch_quant(calib_batches, args.backend, args.requantize_outputs)
+
+    with torch.no_grad():
+        y_fake, y_int = model(test_input), int_model(test_input)
+    err_int = (y_int - y_fake).norm() / y_fake.norm()
+    err_fake = (y_fake - y_fp).norm() / y_fp.norm()
+    agreement = (y_fake.argmax(dim=1) == y_int.argmax(dim=1)).float().mean()
+
+    input = torch.randn(args.batch_size, 3, size, size)
+    t_fake, t_int = latency(model, input, args.iters), latency(int_model, input, args.iters)
+    print(f"{args.arch} W{args.bit_width}A{args.bit_width} align_zero={args.align_zero}, "
+          f"requantize_outputs={args.requantize_outputs}, {args.backend}, "
+          f"batch {args.batch_size}, {args.threads} thread(s)")
+    print(f"fake-quant: {t_fake * 1000:8.2f} ms")
+    print(f"integer   : {t_int * 1000:8.2f} ms")
+    print(f"speedup: {t_fake / t_int:.3f}x")
+    print(f"relative L2 error of logits, integer vs. fake-quant: {err_int:.4f} "
+          f"(fake-quant vs. FP: {err_fake:.4f}), top-1 agreement: {agreement * 100:.1f}%")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+import time
+from argparse import ArgumentParser
+
+import torch
+import torchvision.models as models
+
+from quant_pack.core.quant.config import QuantMode
+from quant_pack.core.wrapper import ParametrizedQuantWrapper, track_bn_folding_mapping
+
+
+def _sync(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+@torch.no_grad()
+def eval_throughput(model, data_batch, device, iters):
+    model.eval()
+    quant_mode = (QuantMode.QWQA, )
+    for _ in range(2):  # warm up
+        model.batch_processor(model, data_batch, False, device, None, quant_mode=quant_mode)
+    _sync(device)
+    start = time.perf_counter()
+    for _ in range(iters):
+        model.batch_processor(model, data_batch, False, device, None, quant_mode=quant_mode)
+    _sync(device)
+    return iters * data_batch[0].size(0) / (time.perf_counter() - start)
+
+
+def main():
+    parser = ArgumentParser("Eval throughput of a quantized ResNet, with and without the weight cache.")
+    parser.add_argument("--arch", "-a", default="resnet18")
+    parser.add_argument("--batch-size", "-b", type=int, default=32)
+    parser.add_argument("--bit-width", "-k", type=int, default=4)
+    parser.add_argument("--iters", "-n", type=int, default=20)
+    parser.add_argument("--fold-bn", action="store_true")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    data_batch = (torch.randn(args.batch_size, 3, 224, 224), torch.zeros(args.batch_size, dtype=torch.long))
+    quant_conf = dict(method="linear", bit_width=args.bit_width, align_zero=False)
+    results = {}
+    for cache_weight in (False, True):
+        torch.manual_seed(19260817)
+        model = models.__dict__[args.arch]()
+        model = ParametrizedQuantWrapper(model, quant_conf, track_bn_folding_mapping(model), args.fold_bn,
+                                         cache_weight=cache_weight)
+        model.to(device)
+        results[cache_weight] = eval_throughput(model, data_batch, device, args.iters)
+
+    for cache_weight, throughput in results.items():
+        print(f"{args.arch} cache_weight={cache_weight!s:5}: {throughput:8.1f} images/s")
+    print(f"speedup: {results[True] / results[False]:.3f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+import time
+from argparse import ArgumentParser
+
+import torch
+import torchvision.models as models
+
+from quant_pack.core.wrapper import ParametrizedQuantWrapper, track_bn_folding_mapping
+
+
+def _sync(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def main():
+    parser = ArgumentParser("Time of weight bound calibration, min/max vs. MSE search.")
+    parser.add_argument("--arch", "-a", default="resnet50")
+    parser.add_argument("--bit-width", "-k", type=int, default=4)
+    parser.add_argument("--num-ratios", type=int, default=32)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    torch.manual_seed(19260817)
+    model = models.__dict__[args.arch]()
+    quant_conf = dict(method="linear", bit_width=args.bit_width, align_zero=False)
+    model = ParametrizedQuantWrapper(model, quant_conf, track_bn_folding_mapping(model), do_fold_bn=True).to(device)
+    model.quant_w()
+    layers = list(model._quant_submodules)
+
+    print(f"{args.arch} W{args.bit_width}, {len(layers)} layers, {args.device}")
+    for method, per_channel in (("minmax", False), ("mse", False), ("mse", True)):
+        _sync(device)
+        start = time.perf_counter()
+        model.calibrate_weights(method, per_channel, **({} if method == "minmax" else
+                                                        dict(num_ratios=args.num_ratios)))
+        _sync(device)
+        elapsed = time.perf_counter() - start
+        with torch.no_grad():
+            mse = sum((m.weight_qconf.transform(m.weight) - m.weight).pow(2).sum().item() for m in layers)
+        granularity = "per-channel" if per_channel else "per-tensor"
+        print(f"{method:6} {granularity:11}: {elapsed:7.2f} s, total squared error of raw weights {mse:.4e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+
+from argparse import ArgumentParser
+
+import numpy as np
+
+from quant_pack.core.wrapper.hook import ActivationStore
+
+
+def main():
+    parser = ArgumentParser("`quant-pack` CLI for inspecting activations dumped by runtime hooks with `store_dir`.")
+    parser.add_argument("--root", "-r", required=True, help="directory of the activation store")
+    parser.add_argument("--keys", "-k", nargs="*", help="keys to inspect, all if not given")
+    parser.add_argument("--rows", "-n", type=int, default=1024,
+                        help="inspect at most this many leading rows of each key")
+    parser.add_argument("--iteration", "-i", type=int, help="inspect rows appended at this iteration only")
+    args = parser.parse_args()
+
+    store = ActivationStore(args.root, mode="r")
+    for key in args.keys or store.keys():
+        layer = store[key]
+        rows = layer.iteration_rows(args.iteration) if args.iteration is not None else slice(None)
+        rows = layer[rows][:args.rows].astype(np.float64)
+        print(f"{key}: {len(layer)} rows of {layer.shape} {layer.dtype} in {len(layer.iterations)} iterations, "
+              f"first {len(rows)} rows: "
+              f"mean {rows.mean():.4e}, std {rows.std():.4e}, min {rows.min():.4e}, max {rows.max():.4e}")
+
+
+if __name__ == "__main__":
+    main()
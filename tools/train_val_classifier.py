@@ -16,6 +16,8 @@ def main():
                         help="training in distributed environment (SLURM)")
     parser.add_argument("--eval-only", "-e", action="store_true",
                         help="only do evaluation")
+    parser.add_argument("--ptq", dest="do_ptq", action="store_true",
+                        help="post-training quantization of the pre-trained model, then evaluation")
     parser.add_argument("--port", "-p", type=int,
                         help="distributed communication port")
     parser.add_argument("--seed", "-s", type=int, default=19260817,
@@ -24,7 +26,9 @@ def main():
     cfg = qapi.build_cfg(args)
 
     qapi.init_environment(cfg)
-    if cfg.eval_only:
+    if cfg.do_ptq:
+        qapi.ptq_classifier(cfg)
+    elif cfg.eval_only:
         qapi.eval_classifier(cfg)
     else:
         qapi.train_classifier(cfg)